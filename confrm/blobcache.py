@@ -0,0 +1,171 @@
+"""In-memory cache of the binaries most recently sent to nodes
+
+Copyright 2020 confrm.io
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+During a rollout the same few binaries are downloaded by every node. The
+cache holds their decoded bytes, and MD5, by blob_id within a budget of
+bytes, evicting the least recently used first. Blobs never change once
+written, so entries are only removed to make room or when their version is
+deleted. Entries are immutable and shared by every response sending them,
+concurrent misses for the same blob wait for a single read of the file.
+
+The cache is disabled unless a budget is configured.
+"""
+
+import asyncio
+import hashlib
+import logging
+
+from collections import OrderedDict
+
+from confrm.metrics import REGISTRY
+
+logger = logging.getLogger('confrm')
+
+CACHE_HITS = REGISTRY.counter(
+    "confrm_blob_cache_hits_total",
+    "Package binary downloads served from the blob cache")
+CACHE_MISSES = REGISTRY.counter(
+    "confrm_blob_cache_misses_total",
+    "Package binary downloads read from disk")
+CACHE_EVICTIONS = REGISTRY.counter(
+    "confrm_blob_cache_evictions_total",
+    "Package binaries removed from the blob cache to make room")
+CACHE_BYTES = REGISTRY.gauge(
+    "confrm_blob_cache_bytes",
+    "Bytes of package binaries held in the blob cache")
+
+
+class CachedBlob:  # pylint: disable=R0903
+    """Decoded bytes of a blob and their MD5"""
+
+    __slots__ = ("data", "md5")
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.md5 = hashlib.md5(data).hexdigest()
+
+
+class BlobCache:
+    """Byte budgeted LRU cache of blobs
+
+    Attributes:
+        budget (int): Bytes held at most, 0 disables the cache
+        max_size (int): Largest blob cached, larger ones are always read
+    """
+
+    def __init__(self):
+        self.budget = 0
+        self.max_size = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._prewarming = set()
+
+    def configure(self, config: dict):
+        """Sets the settings from the [blob_cache] config, empties the cache"""
+
+        self.budget = config.get("budget", 0)
+        self.max_size = config.get("max_size", self.budget // 4)
+        self._entries = OrderedDict()
+        self._loading = {}
+        self.size = 0
+        CACHE_BYTES.set(value=0)
+
+    def _put(self, blob_id: str, blob: CachedBlob):
+        if len(blob.data) > min(self.budget, self.max_size) or blob_id in self._entries:
+            return
+        while self.size + len(blob.data) > self.budget:
+            (_, evicted) = self._entries.popitem(last=False)
+            self.size -= len(evicted.data)
+            CACHE_EVICTIONS.inc()
+        self._entries[blob_id] = blob
+        self.size += len(blob.data)
+        CACHE_BYTES.set(value=self.size)
+
+    def discard(self, blob_id: str):
+        """Removes a blob from the cache"""
+        blob = self._entries.pop(blob_id, None)
+        if blob is not None:
+            self.size -= len(blob.data)
+            CACHE_BYTES.set(value=self.size)
+
+    async def _load(self, blob_id: str, load):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._loading[blob_id] = future
+        try:
+            blob = CachedBlob(await loop.run_in_executor(None, load))
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as err:
+            future.set_exception(err)
+            # Waiters see the error, marks it retrieved if there are none
+            future.exception()
+            raise
+        finally:
+            del self._loading[blob_id]
+        self._put(blob_id, blob)
+        future.set_result(blob)
+        return blob
+
+    async def get(self, blob_id: str, load):
+        """Returns the CachedBlob of blob_id, calling load() in the executor to
+        read its bytes if it is not cached
+
+        Attributes:
+            blob_id (str): Id of the blob
+            load (callable): Returns the decoded bytes of the blob, blocks on I/O
+        """
+
+        if not self.budget:
+            loop = asyncio.get_event_loop()
+            return CachedBlob(await loop.run_in_executor(None, load))
+
+        blob = self._entries.get(blob_id)
+        if blob is not None:
+            self._entries.move_to_end(blob_id)
+            CACHE_HITS.inc()
+            return blob
+
+        # Another request is already reading this blob
+        if blob_id in self._loading:
+            CACHE_HITS.inc()
+            return await asyncio.shield(self._loading[blob_id])
+
+        CACHE_MISSES.inc()
+        return await self._load(blob_id, load)
+
+    def prewarm(self, blob_id: str, load):
+        """Starts reading a blob in to the cache ahead of its downloads, if it
+        is not already cached, returns the task or None
+
+        Errors are logged, the blob is read again by its first download.
+        """
+
+        if not self.budget or blob_id in self._entries or blob_id in self._loading:
+            return None
+        task = asyncio.ensure_future(self._prewarm(blob_id, load))
+        # The loop only holds weak references to tasks
+        self._prewarming.add(task)
+        task.add_done_callback(self._prewarming.discard)
+        return task
+
+    async def _prewarm(self, blob_id: str, load):
+        try:
+            await self._load(blob_id, load)
+        except Exception as err:  # pylint: disable=W0703
+            logger.warning("Could not read blob %s in to the cache: %s", blob_id, err)
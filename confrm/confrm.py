@@ -46,11 +46,34 @@ Codes:
     027
     028
     029
+    030 ERROR    -           -                       Admin token missing or invalid
+    031 ERROR    PUT         /profile/               Invalid profile settings
+    032 ERROR    GET         /profile/download/      No profile data collected
+    033 ERROR    -           -                       Primary not reachable (replica)
+    034 ERROR    -           /upload/                Upload session not found
+    035 ERROR    PUT         /upload/                Chunk offset does not match upload
+    036 ERROR    POST        /upload/finalize/       Upload hash does not match
+    037 ERROR    PUT         /set_active_version/    Package version has not been processed
+    038 WARNING  POST        /package_version/       Version stored but not activated
+    039 ERROR    PUT         /import/                Invalid archive
+    040 ERROR    PUT         /import/                Import not possible
+    041 ERROR    POST        /snapshots/             Snapshot already running
+    042 ERROR    POST        /batch/                 Batch not applied
+    043 ERROR    POST        /batch/                 Unsupported batch operation
+    044 ERROR    -           -                       Package version is quarantined
+    045 ERROR    PUT         /shaping/               Invalid bandwidth limits
+    046 ERROR    -           -                       Too many requests (device endpoints)
+    047 ERROR    POST        /batch/                 Batch mixes replicated and local data (replica)
+    048 ERROR    DELETE      /upload/                Upload is receiving a chunk
 
 """
 
+import asyncio
 import base64
 import datetime
+import hashlib
+import hmac
+import inspect
 import logging
 import os
 import re
@@ -63,14 +86,18 @@ import toml
 
 from Crypto.Hash import SHA256
 from fastapi import FastAPI, File, Depends, Response, Request, status
-from fastapi.responses import FileResponse
-from fastapi.staticfiles import StaticFiles
-from tinydb import TinyDB, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from tinydb import Query
 from tinydb.operations import delete
+from tinydb.table import Document
 from markupsafe import escape
 from pydantic import BaseModel  # pylint: disable=E0611
 
-from confrm.responses import ConfrmFileResponse
+from confrm import blobcache, history, metrics, presence, polling, processing, profiling, \
+    ratelimit, replication, scrubber, shaping, snapshots, static, sweeper, transfer, uploads, warmup
+from confrm.responses import ConfrmFileResponse, ConfrmJSONResponse
+from confrm import storage
 from confrm.zeroconf import ConfrmZeroconf
 
 logger = logging.getLogger('confrm')
@@ -98,17 +125,39 @@ class PackageVersion(BaseModel):  # pylint: disable=R0903
     revision: int
 
 
-APP = FastAPI()
+REPLICA = replication.Replica()
+LIMITER = ratelimit.RateLimiter()
+
+APP = FastAPI(default_response_class=ConfrmJSONResponse)
+APP.add_middleware(replication.ForwardMiddleware, replica=REPLICA)
+APP.add_middleware(ratelimit.RateLimitMiddleware, limiter=LIMITER)
+APP.add_middleware(metrics.MetricsMiddleware)
+APP.add_middleware(storage.QueryAccountingMiddleware)
+APP.add_middleware(profiling.ProfilingMiddleware)
 CONFIG = None
 DB = None
+CHANGE_LOG = None
 ZEROCONF = ConfrmZeroconf()
+PRESENCE = presence.PresenceTracker()
+HISTORY = history.HistoryStore()
+WARMUP = warmup.Warmup()
+UPLOADS = uploads.UploadStore()
+PIPELINE = processing.Pipeline()
+IMPORT_LOCK = asyncio.Lock()
+SNAPSHOTS = snapshots.Snapshots()
+SWEEPER = sweeper.BlobSweeper()
+SCRUBBER = scrubber.BlobScrubber()
+BLOB_CACHE = blobcache.BlobCache()
+SHAPER = shaping.Shaper()
+POLLING = polling.PollScheduler()
+BACKGROUND_TASKS = []
 
 
 def do_config():
     """Gets the config based on an environment variable and sets up global
     objects as required """
 
-    global CONFIG, DB  # pylint: disable=W0603
+    global CONFIG, DB, CHANGE_LOG  # pylint: disable=W0603
 
     if "CONFRM_CONFIG" not in os.environ.keys():
         msg = "CONFRM_CONFIG not set in os.environ"
@@ -124,16 +173,86 @@ def do_config():
 
     CONFIG = toml.load(config_file)
 
-    # Create the database from the data store
-    DB = TinyDB(os.path.join(CONFIG["storage"]["data_dir"], "confrm_db.json"))
+    # Create the database from the data store, recording changes for replicas
+    DB = storage.ConfrmDB(os.path.join(CONFIG["storage"]["data_dir"], "confrm_db.json"),
+                          storage=storage.ConfrmStorage)
+    CHANGE_LOG = storage.ChangeLog()
+    storage.ConfrmTable.change_log = CHANGE_LOG
+
+    # Follow a primary server if one is set, CONFRM_PRIMARY is set by confrm_srv --primary
+    replica_config = CONFIG.get("replica", {})
+    REPLICA.configure(os.environ.get("CONFRM_PRIMARY", replica_config.get("primary", "")),
+                      replica_config.get("token", ""),
+                      replica_config.get("interval", 10))
+
+    debug = CONFIG.get("debug", {})
+    storage.configure_accounting(header=debug.get("query_header", False),
+                                 warn_queries=debug.get("warn_queries", 50))
+
+    # Which nodes are online is rebuilt from the database by warm_presence
+    PRESENCE.timeout = CONFIG.get("presence", {}).get("timeout", presence.DEFAULT_TIMEOUT)
+    PRESENCE.reset()
+    WARMUP.reset()
+
+    # Load the node history, resized to the configured number of entries
+    history_config = CONFIG.get("history", {})
+    HISTORY.heartbeat_capacity = history_config.get("heartbeats", history.DEFAULT_HEARTBEATS)
+    HISTORY.version_capacity = history_config.get("versions", history.DEFAULT_VERSIONS)
+    if HISTORY.heartbeat_capacity < 1 or HISTORY.version_capacity < 1:
+        msg = "History heartbeats and versions must be at least 1"
+        logging.error(msg)
+        raise ValueError(msg)
+    HISTORY.load(history_path())
+
+    offload = CONFIG.get("blob", {}).get("offload", "")
+    if offload not in BLOB_OFFLOAD_MODES:
+        msg = f"Blob offload must be one of {BLOB_OFFLOAD_MODES}"
+        logging.error(msg)
+        raise ValueError(msg)
 
     # Check a blob folder exists
     blob_dir = os.path.join(CONFIG["storage"]["data_dir"], "blob")
     if not os.path.isdir(blob_dir):
         os.mkdir(blob_dir)
 
+    # Replicas follow the encoding the primary gives its versions
+    if offload and not REPLICA.primary:
+        convert_legacy_blobs()
 
-def get_package_versions(name: str, package: {} = None):
+    BLOB_CACHE.configure(CONFIG.get("blob_cache", {}))
+    LIMITER.configure(CONFIG.get("rate_limit", {}))
+    POLLING.configure(CONFIG.get("polling", {}))
+    POLLING.refresh(DB.table("packages").all())
+
+    try:
+        SHAPER.configure(CONFIG.get("shaping", {}))
+    except ValueError as err:
+        msg = f"Invalid [shaping] config: {err}"
+        logging.error(msg)
+        raise ValueError(msg) from err
+
+    # Jobs processing uploaded versions, unfinished ones resume at startup. They
+    # hold the chunk digests of every version so are kept in their own file,
+    # jobs of older servers are moved out of the main database
+    jobs_db = storage.ConfrmDB(os.path.join(CONFIG["storage"]["data_dir"], "confrm_jobs.json"),
+                               storage=storage.ConfrmStorage)
+    if "jobs" in DB.tables():
+        jobs_db.table("jobs").insert_multiple(
+            [Document(doc, doc_id=doc.doc_id) for doc in DB.table("jobs").all()])
+        DB.drop_table("jobs")
+    PIPELINE.configure(jobs_db.table("jobs"), blob_dir, CONFIG.get("processing", {}))
+
+    SNAPSHOTS.configure(DB.storage, CONFIG["storage"]["data_dir"], CONFIG.get("snapshot", {}))
+    SWEEPER.configure(DB.storage, blob_dir, CONFIG.get("blob_gc", {}))
+    SCRUBBER.configure(DB.table("package_versions"), CONFIG["storage"]["data_dir"],
+                       CONFIG.get("scrub", {}))
+
+    # Sessions of chunked uploads do not survive a restart
+    UPLOADS.configure(os.path.join(CONFIG["storage"]["data_dir"], "uploads"),
+                      CONFIG.get("upload", {}).get("expiry", 3600))
+
+
+def get_package_versions(name: str, package: {} = None, versions_raw: list = None):
     """Handles the version ordering logic
 
     Versions are sorted to be in descending order, with the currently
@@ -142,6 +261,7 @@ def get_package_versions(name: str, package: {} = None):
     Attributes:
         name (str): package name string
         package ({}): [Optional] package dict, saves looking up the entry again
+        versions_raw (list): [Optional] version docs of the package, saves searching
     """
 
     query = Query()
@@ -149,8 +269,9 @@ def get_package_versions(name: str, package: {} = None):
     if package is None:
         package = DB.table("packages").search(query.name == name)
 
-    package_versions = DB.table("package_versions")
-    versions_raw = package_versions.search(query.name == name)
+    if versions_raw is None:
+        package_versions = DB.table("package_versions")
+        versions_raw = package_versions.search(query.name == name)
 
     versions = []
     current_version = None
@@ -163,25 +284,25 @@ def get_package_versions(name: str, package: {} = None):
             date_str = datetime.datetime.fromtimestamp(entry["date"])
 
         version_str = f'{entry["major"]}.{entry["minor"]}.{entry["revision"]}'
+        version = {
+            "number": version_str,
+            "date": date_str,
+            "blob": entry["blob_id"]
+        }
+        if "quarantined" in entry:
+            version["quarantined"] = entry["quarantined"]
+
         if "current_version" in package.keys() and \
                 version_str == package["current_version"]:
-            current_version = {
-                "number": version_str,
-                "date": date_str,
-                "blob": entry["blob_id"]
-            }
+            current_version = version
         else:
-            versions.append({
-                "number": version_str,
-                "date": date_str,
-                "blob": entry["blob_id"]
-            })
-            versions = sorted(
-                versions,
-                key=lambda x: [int(i) if i.isdigit()
-                               else i for i in x["number"].split('.')],
-                reverse=True
-            )
+            versions.append(version)
+
+    versions.sort(
+        key=lambda x: [int(i) if i.isdigit()
+                       else i for i in x["number"].split('.')],
+        reverse=True
+    )
 
     if current_version is not None:
         versions.insert(0, current_version)
@@ -189,7 +310,7 @@ def get_package_versions(name: str, package: {} = None):
     return versions
 
 
-def format_package_info(package: dict, lite: bool = False):
+def format_package_info(package: dict, lite: bool = False, versions_raw: list = None):
     """Formats data in to correct dict form
 
     Can generate long form (for UI) or short form  / lite (for nodes)
@@ -197,6 +318,7 @@ def format_package_info(package: dict, lite: bool = False):
     Attributes:
         package (dict): package dict from DB
         lite (bool): if true a reduced response is generated
+        versions_raw (list): [Optional] version docs of the package, saves searching
     """
 
     current_version = ""
@@ -209,7 +331,7 @@ def format_package_info(package: dict, lite: bool = False):
             "current_version": current_version,
         }
 
-    versions = get_package_versions(package["name"], package)
+    versions = get_package_versions(package["name"], package, versions_raw)
 
     latest_version = current_version
     if len(versions) > 0:
@@ -226,6 +348,32 @@ def format_package_info(package: dict, lite: bool = False):
     }
 
 
+def format_nodes(node_list: list):
+    """Returns copies of node docs with the times formatted for display
+
+    Attributes:
+        node_list (list): node docs from DB
+    """
+
+    # Make a new copy of list so we can make changes to elements for display layer without
+    # changing the values in the database
+    node_list = deepcopy(node_list)
+
+    for node in node_list:
+        if node["last_updated"] != -1:
+            value = datetime.datetime.fromtimestamp(node["last_updated"])
+            node["last_updated"] = f"{value:%Y-%m-%d %H:%M:%S}"
+        else:
+            node["last_updated"] = "Unknown"
+        if node["last_seen"] != -1:
+            value = datetime.datetime.fromtimestamp(node["last_seen"])
+            node["last_seen"] = f"{value:%Y-%m-%d %H:%M:%S}"
+        else:
+            node["last_seen"] = "Unknown"
+
+    return node_list
+
+
 def get_package_version_by_version_string(package_name: str, version: str):
     """Get package version using string name and string version number"""
 
@@ -239,52 +387,151 @@ def get_package_version_by_version_string(package_name: str, version: str):
         (query.revision == int(parts[2])))
 
 
-def sort_configs(configs):  # pylint: disable=R0912
-    """Sort configs by global/package/node, then by package name, then by node name
+# Ways of handing blob downloads to a reverse proxy, empty to serve them here
+BLOB_OFFLOAD_MODES = ["", "x-accel-redirect", "x-sendfile"]
+
+
+def blob_path(blob_id: str):
+    """Returns the path of a blob file"""
+    return os.path.join(CONFIG["storage"]["data_dir"], "blob", blob_id)
+
+
+def write_blob(blob_id: str, data: bytes):
+    """Writes a blob file, raw, replacing any existing file atomically"""
+    path = blob_path(blob_id)
+    with open(path + ".tmp", "wb") as ptr:
+        ptr.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def read_blob(version_entry: dict):
+    """Returns the binary of a package version
+
+    Blobs are stored raw, those stored before the encoding field was added to
+    package versions are base64 encoded.
+
+    Attributes:
+        version_entry (dict): package version doc from DB
+    """
+    with open(blob_path(version_entry["blob_id"]), "rb") as ptr:
+        data = ptr.read()
+    if version_entry.get("encoding", "base64") == "base64":
+        try:
+            data = base64.b64decode(data, validate=True)
+        except ValueError:
+            # A replica fetches the blob again once the primary converted it,
+            # version_entry may have been read before that
+            if hashlib.sha256(data).hexdigest() != version_entry["hash"]:
+                raise
+    return data
+
+
+def convert_legacy_blobs():
+    """Rewrites base64 encoded blobs raw so the reverse proxy can send them
+
+    Runs once at startup, before any request can read a blob. A blob is only
+    replaced once its decoded content matches the hash of its version, a blob
+    left raw by an earlier run which stopped before updating its version is
+    only marked raw.
+    """
+
+    versions = DB.table("package_versions")
+    converted = {}
+    for doc in versions.all():
+        if doc.get("encoding", "base64") != "base64":
+            continue
+        try:
+            with open(blob_path(doc["blob_id"]), "rb") as ptr:
+                data = ptr.read()
+        except FileNotFoundError:
+            continue
+        if hashlib.sha256(data).hexdigest() != doc["hash"]:
+            try:
+                data = base64.b64decode(data)
+            except ValueError:
+                data = b""
+            if hashlib.sha256(data).hexdigest() != doc["hash"]:
+                # Left for the scrubber to quarantine
+                logging.warning("Blob %s does not match its hash, not converted", doc["blob_id"])
+                continue
+            write_blob(doc["blob_id"], data)
+        converted[doc.doc_id] = hashlib.md5(data).hexdigest()
+
+    with DB.transaction():
+        for (doc_id, md5) in converted.items():
+            versions.update({"encoding": "raw", "md5": md5}, doc_ids=[doc_id])
+    if converted:
+        logging.info("Converted %d base64 blobs to raw", len(converted))
+
+
+def next_check_in(node_id: str, rollout: bool):
+    """Seconds a node should wait before checking in again, from the number of
+    nodes online and the event loop lag
+
+    Attributes:
+        node_id (str): Id of the node
+        rollout (bool): The node is to be given a new version soon
+    """
+    return POLLING.next_check_in(node_id, rollout, PRESENCE.online_count(),
+                                 metrics.LOOP_LAG.get())
+
+
+def processing_wait():
+    """Seconds to wait for the processing of a version before activating it"""
+    return CONFIG.get("processing", {}).get("activate_wait", 30)
+
+
+def warm_presence():
+    """Rebuilds which nodes are online from when they were last seen"""
+    PRESENCE.rebuild(DB.storage.snapshot().get("nodes", {}).values())
+
+
+WARMUP.add("presence", warm_presence)
+
+
+def history_path():
+    """Returns the path of the node history file"""
+    return os.path.join(CONFIG["storage"]["data_dir"], "history.bin")
+
+
+# Ordering of config types within a key, globals first then packages then nodes
+CONFIG_TYPE_RANK = {"global": 0, "package": 1, "node": 2}
+
+
+def sort_configs(configs):
+    """Sort configs by key, then by global/package/node, then by package name or node id
+
+    Configs of an unknown type are dropped from the result.
 
     Attributes:
         configs (list): List of config dicts
     """
 
-    result = []
-
-    # Find all unique keys and sort alphabetically
-    _keys = []
-    for config in configs:
-        if config["key"] not in _keys:
-            _keys.append(config["key"])
-    _keys = sorted(_keys, key=str.lower)
-
-    # For each key find globals, then packages, then nodes
-    for key in _keys:
-        _packages = []
-        _nodes = []
-        for config in configs:
-            if config["key"] == key:
-                if config["type"] == "global":
-                    result.append(config)
-                elif config["type"] == "package":
-                    _packages.append(config)
-                elif config["type"] == "node":
-                    _nodes.append(config)
-
-        # Sort the package end node elements alphabetically
-        _package_ids = sorted([_package["id"]
-                               for _package in _packages], key=str.lower)
-        for package in _package_ids:
-            for config in configs:
-                if config["key"] == key and config["type"] == "package" and config["id"] == package:
-                    result.append(config)
-                    break
-
-        _node_ids = sorted([_node["id"] for _node in _nodes], key=str.lower)
-        for node in _node_ids:
-            for config in configs:
-                if config["key"] == key and config["type"] == "node" and config["id"] == node:
-                    result.append(config)
-                    break
+    return sorted(
+        (config for config in configs if config["type"] in CONFIG_TYPE_RANK),
+        key=lambda x: (x["key"].lower(),
+                       x["key"],
+                       CONFIG_TYPE_RANK[x["type"]],
+                       x["id"].lower()))
 
-    return result
+
+def add_config_titles(configs: list, package_titles: dict, node_titles: dict):
+    """Returns copies of config docs with the package / node titles added
+
+    Attributes:
+        configs (list): config docs from DB
+        package_titles (dict): package name to title
+        node_titles (dict): node id to title
+    """
+
+    # Do deepcopy to save changing database by accident
+    configs = deepcopy(configs)
+    for doc in configs:
+        if doc["type"] == "package" and doc["id"] in package_titles:
+            doc["package_title"] = package_titles[doc["id"]]
+        elif doc["type"] == "node" and doc["id"] in node_titles:
+            doc["node_title"] = node_titles[doc["id"]]
+    return configs
 
 
 def set_canary(node_id: str, package: str, version: str):
@@ -307,7 +554,7 @@ def set_canary(node_id: str, package: str, version: str):
     # Check for existing node entry and delete if it exists
     canary_list = canaries.search(query.node_id == node_id)
     for canary in canary_list:
-        canaries.remote(doc_ids=[canary.doc_id])
+        canaries.remove(doc_ids=[canary.doc_id])
 
     # Check for existing entries for the given package, delete if exists
     packages_list = canaries.search(query.package == package)
@@ -432,12 +679,92 @@ def node_exists(node_id: str):
     return (node_doc, None, None)
 
 
+def version_available(version_doc: dict):
+    """ Checks the blob of a version can be sent to nodes, returns tuple of (ok, status, error_dict)
+
+    Versions are quarantined by the scrubber when their blob does not match
+    their hash.
+
+    Attributes:
+        version_doc (dict): package version doc from DB
+    """
+
+    if "quarantined" in version_doc:
+        msg = "Package version is quarantined"
+        logging.info(msg)
+        return (False, status.HTTP_409_CONFLICT, {
+            "error": "confrm-044",
+            "message": msg,
+            "detail": "The stored binary of the package version failed its integrity check " +
+            f"({version_doc['quarantined']['reason']}) and cannot be sent to nodes, upload " +
+            "it again as a new version",
+            "quarantined": version_doc["quarantined"]
+        })
+    return (True, None, None)
+
+
+BATCH_OPERATIONS = {}
+
+
+def batchable(method: str, path: str, status_code: int = status.HTTP_200_OK):
+    """Registers a handler as the endpoint of method and path, and as an
+    operation of /batch/
+
+    Batched operations run within a database transaction, which belongs to the
+    thread it was started on, so handlers are plain functions: nothing in them
+    can suspend and let another request write into the transaction.
+
+    Attributes:
+        method (str): HTTP method
+        path (str): Path of the endpoint
+        status_code (int): Status code of a successful response
+    """
+
+    def decorator(handler):
+        async def endpoint(*args, **kwargs):
+            return handler(*args, **kwargs)
+        endpoint.__name__ = handler.__name__
+        endpoint.__doc__ = handler.__doc__
+        endpoint.__signature__ = inspect.signature(handler)
+
+        APP.add_api_route(path, endpoint, methods=[method], status_code=status_code)
+        BATCH_OPERATIONS[(method, path)] = (handler, status_code)
+        return handler
+    return decorator
+
+
+def admin_check(request: Request):
+    """ Checks the request carries the admin token, returns tuple of (ok, status, error_dict)
+
+    The token is set by the optional "token" entry of the [admin] config
+    section and is sent in the X-Confrm-Admin-Token header. If no token is
+    configured the admin API is disabled.
+
+    Attributes:
+        request (Request): Starlette request object
+    """
+
+    token = ""
+    if CONFIG is not None and "admin" in CONFIG.keys():
+        token = CONFIG["admin"].get("token", "")
+
+    given = request.headers.get("x-confrm-admin-token", "")
+    if not token or not hmac.compare_digest(given.encode(), token.encode()):
+        msg = "Admin token missing or invalid"
+        logging.info(msg)
+        return (False, status.HTTP_403_FORBIDDEN, {
+            "error": "confrm-030",
+            "message": msg,
+            "detail": "This endpoint requires the admin token to be set in the"
+            " X-Confrm-Admin-Token header, and an admin token to be configured"
+        })
+    return (True, None, None)
+
+
 # Files server in /static will point to ./dashboard (with respect to the running
 # script)
-APP.mount("/static",
-          StaticFiles(directory=os.path.join(os.path.dirname(__file__), "dashboard")
-                      ),
-          name="home")
+DASHBOARD = static.DashboardFiles()
+APP.mount("/static", DASHBOARD, name="home")
 
 
 @APP.on_event("startup")
@@ -446,20 +773,51 @@ async def startup_event():
 
     do_config()
 
+    BACKGROUND_TASKS.append(asyncio.ensure_future(WARMUP.run()))
+    BACKGROUND_TASKS.append(asyncio.ensure_future(metrics.monitor_event_loop()))
+    BACKGROUND_TASKS.append(asyncio.ensure_future(presence.run_expiry(PRESENCE)))
+    BACKGROUND_TASKS.append(asyncio.ensure_future(history.run_flush(
+        HISTORY, history_path(), CONFIG.get("history", {}).get("flush_interval", 60))))
+    BACKGROUND_TASKS.append(asyncio.ensure_future(uploads.run_expiry(UPLOADS)))
+    BACKGROUND_TASKS.append(asyncio.ensure_future(PIPELINE.run()))
+    BACKGROUND_TASKS.append(asyncio.ensure_future(SWEEPER.run()))
+    # Replicas hold the primary's quarantine marks and do not scrub themselves
+    if not REPLICA.primary and CONFIG.get("scrub", {}).get("enabled", True):
+        BACKGROUND_TASKS.append(asyncio.ensure_future(SCRUBBER.run()))
+    if SNAPSHOTS.interval:
+        BACKGROUND_TASKS.append(asyncio.ensure_future(snapshots.run_schedule(SNAPSHOTS)))
+
+    if REPLICA.primary:
+        BACKGROUND_TASKS.append(asyncio.ensure_future(REPLICA.run(
+            DB, os.path.join(CONFIG["storage"]["data_dir"], "blob"), POLLING.refresh)))
+
+    # Advertise the server and packages, registration runs in the background
+    zeroconf_config = CONFIG.get("zeroconf", {})
+    if zeroconf_config.get("enabled", True):
+        port = zeroconf_config.get("port", CONFIG.get("basic", {}).get("port", 80))
+        ZEROCONF.start(port, DB.table("packages").all(), zeroconf_config.get("address", ""))
+
 
 @APP.on_event("shutdown")
 async def shutdown_event():
     """Is called on application shutdown"""
 
-    ZEROCONF.close()
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    BACKGROUND_TASKS.clear()
+
+    if HISTORY.changes:
+        HISTORY.save(history_path())
+
+    PIPELINE.close()
+
+    await ZEROCONF.close()
 
 
 @APP.get("/")
-async def index():
+async def index(request: Request):
     """Returns index page for UI"""
-    return FileResponse(
-        os.path.join(os.path.dirname(__file__), "dashboard/index.html")
-    )
+    return await DASHBOARD.get_response("index.html", request.scope)
 
 
 @APP.get("/info/")
@@ -477,6 +835,398 @@ async def info():
     return ret
 
 
+@APP.get("/ready/", status_code=status.HTTP_200_OK)
+async def get_ready(response: Response):
+    """Returns 200 once the in-memory state has been warmed up after startup,
+    503 before, with the state of each component"""
+
+    ready = WARMUP.is_ready()
+    if not ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {"ready": ready, "components": WARMUP.status}
+
+
+@APP.get("/changes/", status_code=status.HTTP_200_OK)
+async def get_changes(request: Request, response: Response, instance: str = "",
+                      since: int = 0, limit: int = 1000):
+    """Returns changes to the replicated tables for replicas to follow
+
+    If instance matches this server and the changes after since are still in
+    the change log they are returned, otherwise a full copy of the replicated
+    tables. Requires the admin token, so a primary must have one configured
+    for replicas to follow it.
+
+    Attributes:
+        instance (str): Instance id returned by the previous call
+        since (int): Sequence number returned by the previous call
+        limit (int): Maximum number of changes to return
+    """
+
+    (ok, status_code, err) = admin_check(request)
+    if not ok:
+        response.status_code = status_code
+        return err
+
+    changes = None
+    if instance == CHANGE_LOG.instance:
+        changes = CHANGE_LOG.since(since, limit)
+
+    if changes is None:
+        tables = DB.storage.read() or {}
+        return {
+            "instance": CHANGE_LOG.instance,
+            "seq": CHANGE_LOG.seq,
+            "snapshot": {name: tables.get(name, {}) for name in CHANGE_LOG.tables}
+        }
+
+    seq = changes[-1][0] if changes else since
+    return {
+        "instance": CHANGE_LOG.instance,
+        "seq": seq,
+        "changes": changes,
+        "more": seq < CHANGE_LOG.seq
+    }
+
+
+@APP.get("/export/", status_code=status.HTTP_200_OK)
+@APP.post("/export/", status_code=status.HTTP_200_OK)
+async def get_export(request: Request, response: Response):
+    """Streams a tar archive of the packages, versions, blobs, configs and
+    canaries, requires the admin token
+
+    A POST may send {"have": [sha256, ...]}, blobs with those hashes are
+    left out of the archive.
+    """
+
+    (ok, status_code, err) = admin_check(request)
+    if not ok:
+        response.status_code = status_code
+        return err
+
+    have = []
+    if request.method == "POST" and await request.body():
+        have = (await request.json()).get("have", [])
+
+    tables = DB.storage.snapshot()
+    filename = f"confrm-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.tar"
+    return StreamingResponse(
+        transfer.export_archive(tables, os.path.join(CONFIG["storage"]["data_dir"], "blob"),
+                                have),
+        media_type="application/x-tar",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+@APP.post("/snapshots/", status_code=status.HTTP_201_CREATED)
+async def post_snapshot(request: Request, response: Response):
+    """Takes a snapshot of the database and blobs, requires the admin token
+
+    Returns the manifest of the snapshot, see confrm/snapshots.py.
+    """
+
+    (ok, status_code, err) = admin_check(request)
+    if not ok:
+        response.status_code = status_code
+        return err
+
+    loop = asyncio.get_event_loop()
+    try:
+        return await loop.run_in_executor(None, SNAPSHOTS.take)
+    except snapshots.SnapshotBusy:
+        msg = "Snapshot already running"
+        logging.info(msg)
+        response.status_code = status.HTTP_409_CONFLICT
+        return {
+            "error": "confrm-041",
+            "message": msg,
+            "detail": "Another snapshot is being taken, try again when it has finished"
+        }
+
+
+@APP.get("/snapshots/", status_code=status.HTTP_200_OK)
+async def get_snapshots(request: Request, response: Response):
+    """Lists the snapshots, oldest first, requires the admin token"""
+
+    (ok, status_code, err) = admin_check(request)
+    if not ok:
+        response.status_code = status_code
+        return err
+
+    return SNAPSHOTS.list()
+
+
+@APP.get("/blob_gc/", status_code=status.HTTP_200_OK)
+async def get_blob_gc():
+    """Returns the state of the removal of unreferenced blobs"""
+    return SWEEPER.status
+
+
+@APP.post("/blob_gc/", status_code=status.HTTP_200_OK)
+async def post_blob_gc(request: Request, response: Response, grace: float = None):
+    """Removes unreferenced blobs now, requires the admin token
+
+    Attributes:
+        grace (float): Seconds a blob must have been unreferenced for, the
+                       configured grace period if not given
+    """
+
+    (ok, status_code, err) = admin_check(request)
+    if not ok:
+        response.status_code = status_code
+        return err
+
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, SWEEPER.sweep, grace)
+
+
+@APP.get("/scrub/", status_code=status.HTTP_200_OK)
+async def get_scrub():
+    """Returns the state of the verification of stored blobs"""
+    return SCRUBBER.status
+
+
+@APP.post("/scrub/", status_code=status.HTTP_200_OK)
+async def post_scrub(request: Request, response: Response):
+    """Verifies stored blobs now, requires the admin token
+
+    Blobs verified since they last changed are skipped, waits for a running
+    pass to finish first.
+    """
+
+    (ok, status_code, err) = admin_check(request)
+    if not ok:
+        response.status_code = status_code
+        return err
+
+    return await SCRUBBER.scrub()
+
+
+@APP.get("/rate_limit/", status_code=status.HTTP_200_OK)
+async def get_rate_limit():
+    """Returns the nodes most recently refused by the rate limits, most
+    refused first"""
+    return {"throttled": LIMITER.throttled()}
+
+
+@APP.get("/shaping/", status_code=status.HTTP_200_OK)
+async def get_shaping():
+    """Returns the bandwidth limits of blob downloads"""
+    return SHAPER.limits()
+
+
+@APP.put("/shaping/", status_code=status.HTTP_200_OK)
+async def put_shaping(request: Request, response: Response):
+    """Changes the bandwidth limits of blob downloads, requires the admin token
+
+    The body is a JSON object holding the limits to change, in bytes per
+    second: rate, connection_rate, burst, packages and subnets. A package or
+    subnet limit of 0 removes it. Changes are lost on restart.
+    """
+
+    (ok, status_code, err) = admin_check(request)
+    if not ok:
+        response.status_code = status_code
+        return err
+
+    try:
+        limits = await request.json()
+        if not isinstance(limits, dict):
+            raise ValueError("Body must be a JSON object")
+        SHAPER.update(limits)
+    except (ValueError, AttributeError) as error:
+        msg = "Invalid bandwidth limits"
+        logging.info(msg)
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {
+            "error": "confrm-045",
+            "message": msg,
+            "detail": f"While attempting to change the bandwidth limits: {error}"
+        }
+
+    return SHAPER.limits()
+
+
+def get_importer():
+    """Returns an Importer for this server"""
+    return transfer.Importer(DB, os.path.join(CONFIG["storage"]["data_dir"], "blob"),
+                             os.path.join(CONFIG["storage"]["data_dir"], "import"))
+
+
+@APP.get("/import/hashes/", status_code=status.HTTP_200_OK)
+async def get_import_hashes(request: Request, response: Response):
+    """Returns the SHA256 of the blobs this server has, which need not be sent
+    in an import, requires the admin token"""
+
+    (ok, status_code, err) = admin_check(request)
+    if not ok:
+        response.status_code = status_code
+        return err
+
+    return {"hashes": sorted(get_importer().hashes())}
+
+
+@APP.put("/import/", status_code=status.HTTP_200_OK)
+async def put_import(request: Request, response: Response):
+    """Imports an archive made by /export/ from the request body, requires the
+    admin token
+
+    Documents matching existing ones are skipped, so an import can be run
+    again after being interrupted. Returns the counts of what was imported.
+    """
+
+    (ok, status_code, err) = admin_check(request)
+    if not ok:
+        response.status_code = status_code
+        return err
+
+    if REPLICA.primary or IMPORT_LOCK.locked():
+        msg = "Import not possible"
+        logging.info(msg)
+        response.status_code = status.HTTP_409_CONFLICT
+        return {
+            "error": "confrm-040",
+            "message": msg,
+            "detail": "Imports must be made to the primary server" if REPLICA.primary
+            else "Another import is running"
+        }
+
+    async with IMPORT_LOCK:
+        importer = get_importer()
+        try:
+            result = await importer.run(request.stream())
+        except transfer.ArchiveError as error:
+            msg = "Invalid archive"
+            logging.info(msg)
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return {
+                "error": "confrm-039",
+                "message": msg,
+                "detail": f"{error}, blobs received so far are kept and need not be sent "
+                "again",
+                "result": importer.result
+            }
+
+    platforms = {}
+    for package in importer.packages:
+        ZEROCONF.add_package(package["name"], package["platform"])
+    for package in DB.table("packages").all():
+        platforms[package["name"]] = package["platform"]
+    for version in importer.versions:
+        PIPELINE.submit(version["name"],
+                        f"{version['major']}.{version['minor']}.{version['revision']}",
+                        version["blob_id"], platforms.get(version["name"], ""))
+
+    return result
+
+
+@APP.get("/replica/", status_code=status.HTTP_200_OK)
+async def get_replica():
+    """Returns the replication state, replica is false unless following a primary"""
+    if not REPLICA.primary:
+        return {"replica": False}
+    return dict(REPLICA.status, replica=True)
+
+
+@APP.get("/metrics")
+async def get_metrics():
+    """Returns server metrics in the Prometheus text format"""
+    return PlainTextResponse(metrics.REGISTRY.render(),
+                             media_type=metrics.CONTENT_TYPE)
+
+
+@APP.put("/profile/", status_code=status.HTTP_200_OK)
+async def put_profile(  # pylint: disable=R0913
+        request: Request,
+        response: Response,
+        count: int = 1,
+        route: str = "",
+        mode: str = "cprofile",
+        interval: float = 0.001):
+    """Arms the profiler for the next count requests, admin only
+
+    Previously collected results are cleared.
+
+    Attributes:
+        count (int): Number of requests to profile
+        route (str): Only profile requests whose path starts with this
+        mode (str): cprofile or sample
+        interval (float): Sampling interval in seconds for sample mode
+    """
+
+    (allowed, status_code, err) = admin_check(request)
+    if not allowed:
+        response.status_code = status_code
+        return err
+
+    try:
+        profiling.PROFILER.arm(count, route, mode, interval)
+    except ValueError as err:
+        msg = "Invalid profile settings"
+        logging.info(msg)
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {
+            "error": "confrm-031",
+            "message": msg,
+            "detail": f"While attempting to start profiling: {err}"
+        }
+
+    return profiling.PROFILER.status()
+
+
+@APP.get("/profile/", status_code=status.HTTP_200_OK)
+async def get_profile(request: Request, response: Response):
+    """Returns profiler state and per request time breakdowns, admin only"""
+
+    (allowed, status_code, err) = admin_check(request)
+    if not allowed:
+        response.status_code = status_code
+        return err
+
+    return profiling.PROFILER.status()
+
+
+@APP.delete("/profile/", status_code=status.HTTP_200_OK)
+async def delete_profile(request: Request, response: Response):
+    """Disarms the profiler and clears collected results, admin only"""
+
+    (allowed, status_code, err) = admin_check(request)
+    if not allowed:
+        response.status_code = status_code
+        return err
+
+    profiling.PROFILER.disarm(clear=True)
+    return {}
+
+
+@APP.get("/profile/download/", status_code=status.HTTP_200_OK)
+async def get_profile_download(request: Request, response: Response):
+    """Downloads collected profile, pstats file for cprofile mode or collapsed
+    stacks for sample mode, admin only"""
+
+    (allowed, status_code, err) = admin_check(request)
+    if not allowed:
+        response.status_code = status_code
+        return err
+
+    if not profiling.PROFILER.has_results():
+        msg = "No profile data collected"
+        logging.info(msg)
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return {
+            "error": "confrm-032",
+            "message": msg,
+            "detail": "The profiler has not collected any data, arm it using PUT /profile/"
+        }
+
+    if profiling.PROFILER.mode == "cprofile":
+        return Response(
+            profiling.PROFILER.pstats_bytes(),
+            media_type="application/octet-stream",
+            headers={"content-disposition": "attachment; filename=confrm.pstats"})
+    return PlainTextResponse(
+        profiling.PROFILER.collapsed_stacks(),
+        headers={"content-disposition": "attachment; filename=confrm.collapsed"})
+
+
 @APP.get("/time/")
 async def get_time():
     """Returns time of day from server as unix epoch time"""
@@ -530,7 +1280,7 @@ async def register_node(  # pylint: disable=R0913
         response (Response): Starlette response object for setting return codes
 
     Returns:
-        HTTP_200_OK
+        HTTP_200_OK / {"next_check_in": seconds until the node should check in again}
         HTTP_404_NOT_FOUND
     """
 
@@ -555,6 +1305,9 @@ async def register_node(  # pylint: disable=R0913
             "detail": "A node attempted to register with an invalid node_id"
         }
 
+    PRESENCE.heartbeat(node_id, package)
+    HISTORY.record(node_id, package, version, time.time())
+
     node_doc = nodes.get(query.node_id == node_id)
     if node_doc is None:
         entry = {
@@ -569,7 +1322,8 @@ async def register_node(  # pylint: disable=R0913
             "ip_address": request.client.host
         }
         nodes.insert(entry)
-        return {}
+        return {"next_check_in": next_check_in(
+            node_id, POLLING.in_rollout(package, version, time.time()))}
 
     # Update the package entry based on package name change, new version of a package
     # and register this as the last update time
@@ -593,14 +1347,16 @@ async def register_node(  # pylint: disable=R0913
     if "force" in node_doc.keys() and node_doc["package"] == node_doc["force"]["package"]:
         nodes.update(delete("force"), query.node_id == node_id)
 
-    # Check to see if a canary
+    # Check to see if a canary, the canary table is the primary's on a replica
     canary = get_canary(node_id=node_id)
-    if canary is not None:
+    if canary is not None and not REPLICA.primary:
         canaries = DB.table("canary")
         canary["force"] = False
         canaries.update(canary, query.node_id == node_id)
 
-    return {}
+    rollout = POLLING.in_rollout(package, version, time.time()) or \
+        (canary is not None and canary["version"] != version)
+    return {"next_check_in": next_check_in(node_id, rollout)}
 
 
 @APP.get("/nodes/", status_code=status.HTTP_200_OK)
@@ -629,30 +1385,85 @@ async def get_nodes(package: str = "", node_id: str = ""):
     if len(node_list) == 0:
         return {}
 
-    # Make a new copy of list so we can make changes to elements for display layer without
-    # changing the values in the database
-    new_node_list = deepcopy(node_list)
-    node_list = new_node_list
-
-    for node in node_list:
-        if node["last_updated"] != -1:
-            value = datetime.datetime.fromtimestamp(node["last_updated"])
-            node["last_updated"] = f"{value:%Y-%m-%d %H:%M:%S}"
-        else:
-            node["last_updated"] = "Unknown"
-        if node["last_seen"] != -1:
-            value = datetime.datetime.fromtimestamp(node["last_seen"])
-            node["last_seen"] = f"{value:%Y-%m-%d %H:%M:%S}"
-        else:
-            node["last_seen"] = "Unknown"
+    node_list = format_nodes(node_list)
 
     if not package and node_id:
         return node_list[0]
     return node_list
 
 
-@APP.put("/node_title/", status_code=status.HTTP_200_OK)
-async def put_node_title(response: Response, node_id: str = "", title: str = ""):
+@APP.get("/presence/", status_code=status.HTTP_200_OK)
+async def get_presence(response: Response, package: str = "", node_id: str = ""):
+    """Returns which nodes are online, from the in-memory presence tracker
+
+    Nodes are online if they have registered within the presence timeout.
+
+    Attributes:
+        package (str): If set only count nodes running this package
+        node_id (str): If set return whether this node is online
+    """
+
+    if node_id:
+        (node_doc, status_code, err) = node_exists(node_id)
+        if node_doc is None:
+            response.status_code = status_code
+            return err
+        return {"node_id": node_id, "online": PRESENCE.is_online(node_id)}
+
+    if package:
+        return {"package": package, "online": PRESENCE.online_count(package)}
+
+    online = PRESENCE.online_count()
+    return {
+        "online": online,
+        "offline": PRESENCE.node_count() - online,
+        "packages": PRESENCE.online_counts()
+    }
+
+
+@APP.get("/history/node/", status_code=status.HTTP_200_OK)
+async def get_node_history(node_id: str, response: Response, since: int = 0):
+    """Returns the recorded heartbeats and version changes of a node
+
+    Only the most recent entries are kept, see the [history] config section.
+
+    Attributes:
+        node_id (str): Node to return the history of
+        since (int): Only return entries at or after this time
+    """
+
+    (node_doc, status_code, err) = node_exists(node_id)
+    if node_doc is None:
+        response.status_code = status_code
+        return err
+
+    timeline = HISTORY.node_timeline(node_id, since)
+    if timeline is None:
+        return {"node_id": node_id, "heartbeats": [], "heartbeat_interval": None,
+                "versions": []}
+    return timeline
+
+
+@APP.get("/history/version/", status_code=status.HTTP_200_OK)
+async def get_version_history(package: str, response: Response, version: str = ""):
+    """Returns when nodes changed to a package, or a version of it, oldest first
+
+    Attributes:
+        package (str): Package name
+        version (str): If set only return changes to this version
+    """
+
+    (package_doc, status_code, err) = package_exists(package)
+    if package_doc is None:
+        response.status_code = status_code
+        return err
+
+    return {"package": package, "version": version,
+            "changes": HISTORY.version_timeline(package, version)}
+
+
+@batchable("PUT", "/node_title/")
+def put_node_title(response: Response, node_id: str = "", title: str = ""):
     """Sets the title of a node
 
     Attributes:
@@ -707,6 +1518,70 @@ async def package_list():
     return ui_packages
 
 
+def build_dashboard_state():
+    """Builds the dashboard state, reading each table once"""
+
+    packages = DB.table("packages").all()
+    nodes = DB.table("nodes").all()
+    configs = DB.table("config").all()
+
+    versions_by_package = {}
+    for doc in DB.table("package_versions").all():
+        versions_by_package.setdefault(doc["name"], []).append(doc)
+
+    node_summary = {}
+    for node in nodes:
+        entry = node_summary.setdefault(node["package"], {"nodes": 0, "versions": {}})
+        entry["nodes"] += 1
+        entry["versions"][node["version"]] = entry["versions"].get(node["version"], 0) + 1
+
+    config_summary = {}
+    for doc in configs:
+        config_summary[doc["type"]] = config_summary.get(doc["type"], 0) + 1
+
+    package_titles = {doc["name"]: doc["title"] for doc in packages}
+    node_titles = {doc["node_id"]: doc["title"] for doc in nodes}
+
+    return {
+        "info": {"packages": len(packages), "nodes": len(nodes)},
+        "packages": {package["name"]: format_package_info(
+            package, versions_raw=versions_by_package.get(package["name"], []))
+                     for package in packages},
+        "nodes": format_nodes(nodes),
+        "nodes_summary": {"nodes": len(nodes), "packages": node_summary},
+        "configs": add_config_titles(sort_configs(configs), package_titles, node_titles),
+        "configs_summary": {"configs": len(configs), "types": config_summary}
+    }
+
+
+# Rendered dashboard state and the ETag it was built for
+DASHBOARD_STATE = {"etag": None, "body": None}
+
+
+@APP.get("/dashboard_state/", status_code=status.HTTP_200_OK)
+async def get_dashboard_state(request: Request):
+    """Returns everything the dashboard displays in one snapshot: info,
+    packages, nodes, configs and summaries of the nodes and configs
+
+    The ETag changes whenever the database is written, requests with a
+    matching If-None-Match get a 304 without reading the database and the
+    rendered state is shared between clients until it changes.
+    """
+
+    etag = f'"{DB.storage.version()}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    if DASHBOARD_STATE["etag"] != etag:
+        DASHBOARD_STATE["body"] = ConfrmJSONResponse(
+            jsonable_encoder(build_dashboard_state())).body
+        DASHBOARD_STATE["etag"] = etag
+
+    return Response(DASHBOARD_STATE["body"], media_type="application/json", headers=headers)
+
+
 @APP.put("/package/", status_code=status.HTTP_201_CREATED)
 async def put_package(response: Response, package: Package = Depends()):
     """Add package description
@@ -766,12 +1641,13 @@ async def put_package(response: Response, package: Package = Depends()):
         }
 
     packages.insert(package_dict)
+    ZEROCONF.add_package(package_dict["name"], package_dict["platform"])
 
     return {}
 
 
-@APP.delete("/package/", status_code=status.HTTP_200_OK)
-async def delete_package(name: str, response: Response):
+@batchable("DELETE", "/package/")
+def delete_package(name: str, response: Response):
     """Delete a package, its versions and all configs
 
     Attributes:
@@ -790,53 +1666,48 @@ async def delete_package(name: str, response: Response):
         response.status_code = status_code
         return err
 
-    # Get all the package versions associated with this package
-    _versions = package_versions.search(query.name == name)
-    for version in _versions:
-        version_str = str(version["major"]) + "." + \
-            str(version["minor"]) + "." + \
-            str(version["revision"])
-        await delete_package_version(name, version_str, response)
+    # Versions and configs are removed with the package in a single write
+    with DB.transaction():
 
-    # Get all the configs associated with this package
-    _configs = configs.search((query.type == "package") &
-                              (query.id == name))
-    for config in _configs:
-        await delete_config(key=config["key"], type="package", response=response, id=name)
+        # Get all the package versions associated with this package
+        _versions = package_versions.search(query.name == name)
+        for version in _versions:
+            version_str = str(version["major"]) + "." + \
+                str(version["minor"]) + "." + \
+                str(version["revision"])
+            delete_package_version(name, version_str, response)
 
-    packages.remove(doc_ids=[package_doc.doc_id])
+        # Get all the configs associated with this package
+        _configs = configs.search((query.type == "package") &
+                                  (query.id == name))
+        for config in _configs:
+            delete_config(key=config["key"], type="package", response=response, id=name)
+
+        packages.remove(doc_ids=[package_doc.doc_id])
+        DB.storage.after_commit(lambda: ZEROCONF.remove_package(name, package_doc["platform"]))
+        DB.storage.after_commit(lambda: POLLING.forget(name))
 
     return {}
 
 
-@APP.post("/package_version/", status_code=status.HTTP_201_CREATED)
-async def add_package_version(
-        response: Response,
-        package_version: PackageVersion = Depends(),
-        set_active: bool = False,
-        canary_next: bool = False,
-        canary_id: str = "",
-        file: bytes = File(...)):
-    """Uploads a package version with binary package
+def check_package_version(package_version_dict: dict, canary_id: str = ""):
+    """Checks a package version can be added
 
-    Arguments:
-        response (Response): Starlette response object for setting return codes
-        package_version (PackageVersion): Package description
-        set_active (bool): Default False, if true this version will be set active
-        file (bytes): File uploaded
-    """
+    Returns a tuple of (package_doc, status_code, err), package_doc is None
+    if the version cannot be added
 
-    package_version_dict = package_version.__dict__
+    Attributes:
+        package_version_dict (dict): Package version description
+        canary_id (str): Node to be set as a canary for the version, if any
+    """
 
-    packages = DB.table("packages")
     package_versions = DB.table("package_versions")
     query = Query()
 
     (package_doc, status_code, err) = package_exists(
         package_version_dict["name"])
     if package_doc is None:
-        response.status_code = status_code
-        return err
+        return (None, status_code, err)
 
     if canary_id:
         nodes = DB.table("nodes")
@@ -844,13 +1715,12 @@ async def add_package_version(
         if not node_doc:
             msg = "Node not found"
             logging.info(msg)
-            response.status_code = status.HTTP_404_NOT_FOUND
-            return {
+            return (None, status.HTTP_404_NOT_FOUND, {
                 "error": "confrm-026",
                 "message": msg,
                 "detail": "While attempting to add a new package version the node " +
                 " given was not found"
-            }
+            })
 
     existing_version = package_versions.get((query.name == package_version_dict["name"]) &
                                             (query.major == package_version_dict["major"]) &
@@ -860,37 +1730,56 @@ async def add_package_version(
     if existing_version is not None:
         msg = "Version already exists for package"
         logging.info(msg)
-        response.status_code = status.HTTP_400_BAD_REQUEST
-        return {
+        return (None, status.HTTP_400_BAD_REQUEST, {
             "error": "confrm-006",
             "message": msg,
             "detail": "While attempting to add a new package version the version given " +
             " was found to be already used"
-        }
+        })
 
     if package_version_dict["major"] < 0 or \
             package_version_dict["minor"] < 0 or \
             package_version_dict["revision"] < 0:
         msg = "Version number elements cannot be negative"
         logging.info(msg)
-        response.status_code = status.HTTP_400_BAD_REQUEST
-        return {
+        return (None, status.HTTP_400_BAD_REQUEST, {
             "error": "confrm-017",
             "message": msg,
             "detail": "While attempting to add a new package version the version given " +
             " was found to contain negative numbers"
-        }
+        })
 
-    # Package was uploaded, create hash of binary
-    _h = SHA256.new()
-    _h.update(file)
+    return (package_doc, None, None)
 
-    # Store the binary in the data_store as a base64 encoded file
-    filename = uuid.uuid4().hex
-    blob_dir = os.path.join(CONFIG["storage"]["data_dir"], "blob")
-    save_file = os.path.join(blob_dir, filename)
-    with open(save_file, "wb") as ptr:
-        ptr.write(base64.b64encode(file))
+
+async def insert_package_version(  # pylint: disable=R0913
+        response: Response,
+        package_doc: dict,
+        package_version_dict: dict,
+        blob: dict,
+        set_active: bool = False,
+        canary_next: bool = False,
+        canary_id: str = ""):
+    """Stores a package version whose binary is in the blob store and starts
+    its processing, returns the response body
+
+    If the version is to be made active or a canary this waits for the
+    required processing stages, if they do not complete in time the version
+    is stored but left inactive.
+
+    Attributes:
+        response (Response): Starlette response object for setting return codes
+        package_doc (dict): Package doc from DB, as returned by check_package_version
+        package_version_dict (dict): Package version description
+        blob (dict): blob_id, hash (SHA256) and md5 of the stored binary
+        set_active (bool): If true this version will be set active
+        canary_next (bool): If true the next node to check in becomes a canary
+        canary_id (str): Node to be set as a canary for the version, if any
+    """
+
+    packages = DB.table("packages")
+    package_versions = DB.table("package_versions")
+    query = Query()
 
     # Escape the strings
     for key in package_version_dict.keys():
@@ -899,8 +1788,10 @@ async def add_package_version(
 
     # Update with blob details
     package_version_dict["date"] = round(time.time())
-    package_version_dict["hash"] = _h.hexdigest()
-    package_version_dict["blob_id"] = filename
+    package_version_dict["hash"] = blob["hash"]
+    package_version_dict["blob_id"] = blob["blob_id"]
+    package_version_dict["encoding"] = "raw"
+    package_version_dict["md5"] = blob["md5"]
 
     # Store in the database
     package_versions.insert(package_version_dict)
@@ -909,9 +1800,35 @@ async def add_package_version(
         str(package_version_dict["minor"]) + "." + \
         str(package_version_dict["revision"])
 
+    PIPELINE.submit(package_doc["name"], version_str, blob["blob_id"], package_doc["platform"])
+    if not (set_active or canary_id or canary_next):
+        return {}
+
+    job = await PIPELINE.wait(package_doc["name"], version_str, processing_wait())
+    if not PIPELINE.is_eligible(job):
+        msg = "Version stored but not activated"
+        logging.info(msg)
+        response.status_code = status.HTTP_202_ACCEPTED
+        return {
+            "warning": "confrm-038",
+            "message": msg,
+            "detail": "The package version was stored but its processing has " +
+            f"{processing.outcome(job)}, so it was " +
+            "not set active or as a canary, see /jobs/ for its progress",
+            "job": job
+        }
+
+    # The package may have been changed or deleted during the wait
+    (package_doc, status_code, err) = package_exists(package_doc["name"])
+    if package_doc is None:
+        response.status_code = status_code
+        return err
+
     if set_active is True:
-        package_doc["current_version"] = version_str
-        packages.update(package_doc, query.name == package_doc["name"])
+        activated = {"current_version": version_str, "activated": round(time.time())}
+        packages.update(activated, query.name == package_doc["name"])
+        package_doc.update(activated)
+        POLLING.note(package_doc)
 
     # If this is begin set to active, or a canary, delete existing canaries
     if set_active is True or canary_id or canary_next is True:
@@ -934,8 +1851,237 @@ async def add_package_version(
     return {}
 
 
-@APP.delete("/package_version/", status_code=status.HTTP_200_OK)
-async def delete_package_version(package: str, version: str, response: Response):
+@APP.post("/package_version/", status_code=status.HTTP_201_CREATED)
+async def add_package_version(
+        response: Response,
+        package_version: PackageVersion = Depends(),
+        set_active: bool = False,
+        canary_next: bool = False,
+        canary_id: str = "",
+        file: bytes = File(...)):
+    """Uploads a package version with binary package
+
+    Arguments:
+        response (Response): Starlette response object for setting return codes
+        package_version (PackageVersion): Package description
+        set_active (bool): Default False, if true this version will be set active
+        file (bytes): File uploaded
+    """
+
+    package_version_dict = package_version.__dict__
+
+    (package_doc, status_code, err) = check_package_version(package_version_dict, canary_id)
+    if package_doc is None:
+        response.status_code = status_code
+        return err
+
+    metrics.UPLOAD_SIZE.observe(value=len(file))
+
+    # Package was uploaded, create hash of binary, the MD5 is sent to nodes
+    with profiling.timed("hashing"):
+        _h = SHA256.new()
+        _h.update(file)
+        md5 = hashlib.md5(file).hexdigest()
+
+    # Store the binary in the data_store
+    filename = uuid.uuid4().hex
+    write_blob(filename, file)
+
+    return await insert_package_version(
+        response, package_doc, package_version_dict,
+        {"blob_id": filename, "hash": _h.hexdigest(), "md5": md5},
+        set_active, canary_next, canary_id)
+
+
+@APP.get("/jobs/", status_code=status.HTTP_200_OK)
+async def get_jobs(package: str = "", version: str = ""):
+    """Returns the processing jobs of package versions
+
+    Attributes:
+        package (str): Only jobs of this package, all if empty
+        version (str): Only the job of this version of the package
+    """
+
+    query = Query()
+    jobs = PIPELINE.table
+    if package and version:
+        job_list = jobs.search((query.package == package) & (query.version == version))
+    elif package:
+        job_list = jobs.search(query.package == package)
+    else:
+        job_list = jobs.all()
+
+    return [dict(job, id=job.doc_id, eligible=PIPELINE.is_eligible(job)) for job in job_list]
+
+
+def upload_not_found():
+    """Returns the error body for an unknown or expired upload session"""
+    msg = "Upload session not found"
+    logging.info(msg)
+    return {
+        "error": "confrm-034",
+        "message": msg,
+        "detail": "The upload session does not exist, it may have expired or been " +
+        "finalized"
+    }
+
+
+@APP.post("/upload/", status_code=status.HTTP_201_CREATED)
+async def create_upload(
+        response: Response,
+        package_version: PackageVersion = Depends(),
+        set_active: bool = False,
+        canary_next: bool = False,
+        canary_id: str = ""):
+    """Starts a chunked upload of a package version, the arguments are those of
+    POST /package_version/ without the file
+
+    Chunks are sent with PUT /upload/ and the version is created by POST
+    /upload/finalize/.
+    """
+
+    package_version_dict = package_version.__dict__
+
+    (package_doc, status_code, err) = check_package_version(package_version_dict, canary_id)
+    if package_doc is None:
+        response.status_code = status_code
+        return err
+
+    session = UPLOADS.create({
+        "package_version": package_version_dict,
+        "set_active": set_active,
+        "canary_next": canary_next,
+        "canary_id": canary_id
+    })
+    return session.status()
+
+
+@APP.get("/upload/", status_code=status.HTTP_200_OK)
+async def get_upload(upload_id: str, response: Response):
+    """Returns the number of bytes received, where to resume an upload from"""
+
+    session = UPLOADS.get(upload_id)
+    if session is None:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return upload_not_found()
+    return session.status()
+
+
+@APP.put("/upload/", status_code=status.HTTP_200_OK)
+async def put_upload_chunk(upload_id: str, offset: int, request: Request, response: Response):
+    """Appends the request body to an upload
+
+    Attributes:
+        upload_id (str): Upload session
+        offset (int): Position of the chunk in the file, must be the number of
+                      bytes received so far
+    """
+
+    session = UPLOADS.get(upload_id)
+    if session is None:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return upload_not_found()
+
+    if session.busy or offset != session.offset:
+        msg = "Chunk offset does not match upload"
+        logging.info(msg)
+        response.status_code = status.HTTP_409_CONFLICT
+        return {
+            "error": "confrm-035",
+            "message": msg,
+            "detail": f"The upload has received {session.offset} bytes, chunks must " +
+            "be sent in order, one at a time, starting from there",
+            "offset": session.offset
+        }
+
+    # Written as it arrives, what was received is kept if the client goes away
+    session.busy = True
+    try:
+        async for data in request.stream():
+            if data:
+                session.write(data)
+    finally:
+        session.busy = False
+
+    return session.status()
+
+
+@APP.post("/upload/finalize/", status_code=status.HTTP_201_CREATED)
+async def finalize_upload(upload_id: str, hash: str, response: Response):  # pylint: disable=W0622
+    """Creates the package version from a completed upload
+
+    Attributes:
+        upload_id (str): Upload session
+        hash (str): Expected SHA256 of the whole file
+    """
+
+    session = UPLOADS.get(upload_id)
+    if session is None or session.busy:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return upload_not_found()
+
+    if session.sha256.hexdigest() != hash.lower():
+        UPLOADS.remove(upload_id)
+        msg = "Upload hash does not match"
+        logging.info(msg)
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {
+            "error": "confrm-036",
+            "message": msg,
+            "detail": "The SHA256 of the uploaded file does not match the hash given, " +
+            "the upload has been discarded"
+        }
+
+    # Checked again, the package or version may have changed since creation
+    details = session.details
+    (package_doc, status_code, err) = check_package_version(details["package_version"],
+                                                            details["canary_id"])
+    if package_doc is None:
+        UPLOADS.remove(upload_id)
+        response.status_code = status_code
+        return err
+
+    metrics.UPLOAD_SIZE.observe(value=session.offset)
+
+    # The temporary file becomes the blob
+    UPLOADS.remove(upload_id, keep_file=True)
+    filename = uuid.uuid4().hex
+    os.replace(session.path, blob_path(filename))
+
+    return await insert_package_version(
+        response, package_doc, details["package_version"],
+        {"blob_id": filename, "hash": session.sha256.hexdigest(),
+         "md5": session.md5.hexdigest()},
+        details["set_active"], details["canary_next"], details["canary_id"])
+
+
+@APP.delete("/upload/", status_code=status.HTTP_200_OK)
+async def delete_upload(upload_id: str, response: Response):
+    """Abandons an upload"""
+
+    session = UPLOADS.get(upload_id)
+    if session is None:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return upload_not_found()
+
+    # Removing the file under a chunk being written would leave it orphaned
+    if session.busy:
+        msg = "Upload is receiving a chunk"
+        logging.info(msg)
+        response.status_code = status.HTTP_409_CONFLICT
+        return {
+            "error": "confrm-048",
+            "message": msg,
+            "detail": "The upload cannot be abandoned while a chunk is being sent, " +
+            "try again once it is done"
+        }
+
+    UPLOADS.remove(upload_id)
+    return {}
+
+
+@batchable("DELETE", "/package_version/")
+def delete_package_version(package: str, version: str, response: Response):
     """ Delete a package version
 
         Attributes:
@@ -965,9 +2111,12 @@ async def delete_package_version(package: str, version: str, response: Response)
         }
 
     package_versions.remove(doc_ids=[version_entry.doc_id])
-    blob_dir = os.path.join(CONFIG["storage"]["data_dir"], "blob")
-    file_path = os.path.join(blob_dir, version_entry["blob_id"])
-    os.remove(file_path)
+    # Jobs are not part of the transaction of the main database
+    DB.storage.after_commit(lambda: PIPELINE.remove(package, version))
+
+    # The blob is removed by the sweeper once no longer in use
+    DB.storage.after_commit(lambda: SWEEPER.release(version_entry["blob_id"]))
+    DB.storage.after_commit(lambda: BLOB_CACHE.discard(version_entry["blob_id"]))
 
     # Check for any hanging canary entries
     try:
@@ -1015,7 +2164,7 @@ async def check_for_update(package: str, node_id: str, response: Response):
         node_id (str): Id of the node making the request, or empty
         response (Response): Starlette response object for setting return codes
     Returns:
-        HTTP_200_OK / {"current_version": ..., "blob": ...} if found
+        HTTP_200_OK / {"current_version": ..., "blob": ..., "next_check_in": ...} if found
         HTTP_404_NOT_FOUND / Message header / {}  if not found
     """
 
@@ -1036,15 +2185,24 @@ async def check_for_update(package: str, node_id: str, response: Response):
             logging.error("Force version not set, removing force entry...")
             nodes.update(delete("force"), query.node_id == node_id)
         else:
+            (ok, status_code, err) = version_available(version_doc)
+            if not ok:
+                response.status_code = status_code
+                return err
             return {
                 "current_version": node_doc["force"]["version"],
                 "blob": version_doc["blob_id"],
                 "hash": version_doc["hash"],
-                "force": True
+                "force": True,
+                "next_check_in": next_check_in(
+                    node_id, node_doc["version"] != node_doc["force"]["version"])
             }
 
+    # The canary table is the primary's on a replica, the next node to check in
+    # there becomes the canary
     package_canary = get_canary(package=package)
-    if package_canary is not None and package_canary["node_id"] == "*":
+    if package_canary is not None and package_canary["node_id"] == "*" and \
+            not REPLICA.primary:
         set_canary(node_id=node_id, package=package,
                    version=package_canary["version"])
 
@@ -1058,13 +2216,20 @@ async def check_for_update(package: str, node_id: str, response: Response):
         if version_doc is None:
             # TODO: Create test
             logging.error("Canary version not set, removing canary entry...")
-            remove_canary(node_id=node_id)
+            if not REPLICA.primary:
+                remove_canary(node_id=node_id)
         else:
+            (ok, status_code, err) = version_available(version_doc)
+            if not ok:
+                response.status_code = status_code
+                return err
             return {
                 "current_version": canary["version"],
                 "blob": version_doc["blob_id"],
                 "hash": version_doc["hash"],
-                "force": canary["force"]
+                "force": canary["force"],
+                "next_check_in": next_check_in(
+                    node_id, node_doc is None or node_doc["version"] != canary["version"])
             }
 
     package_doc = packages.get(query.name == package)
@@ -1080,11 +2245,20 @@ async def check_for_update(package: str, node_id: str, response: Response):
         version_entry = get_package_version_by_version_string(
             package,
             package_doc["current_version"])
+        (ok, status_code, err) = version_available(version_entry)
+        if not ok:
+            response.status_code = status_code
+            return err
+        # Also keeps replicas, which do not see versions being set active, up to date
+        POLLING.note(package_doc)
+        node_version = node_doc["version"] if node_doc is not None else ""
         return {
             "current_version": package_doc["current_version"],
             "blob": version_entry["blob_id"],
             "hash": version_entry["hash"],
-            "force": False
+            "force": False,
+            "next_check_in": next_check_in(
+                node_id, POLLING.in_rollout(package, node_version, time.time()))
         }
 
     response.status_code = status.HTTP_404_NOT_FOUND
@@ -1097,8 +2271,8 @@ async def check_for_update(package: str, node_id: str, response: Response):
 
 
 @APP.put("/set_active_version/")
-async def set_active_version(package: str, version: str):
-    """ Set the active version via the API """
+async def set_active_version(package: str, version: str, response: Response):
+    """ Set the active version via the API, once its processing is done """
     # TODO: Set error codes
 
     query = Query()
@@ -1112,8 +2286,43 @@ async def set_active_version(package: str, version: str):
     if len(version_doc) < 1:
         return {"ok": False, "info": "Specified version does not exist for package"}
 
-    package_entry["current_version"] = version
-    result = packages.update(package_entry, query.name == package)
+    (ok, status_code, err) = version_available(version_doc)
+    if not ok:
+        response.status_code = status_code
+        return err
+
+    job = await PIPELINE.wait(package, version, processing_wait())
+    if not PIPELINE.is_eligible(job):
+        msg = "Package version has not been processed"
+        logging.info(msg)
+        response.status_code = status.HTTP_409_CONFLICT
+        return {
+            "error": "confrm-037",
+            "message": msg,
+            "detail": "The package version cannot be set active until its required " +
+            "processing stages are done, processing has " +
+            f"{processing.outcome(job)}",
+            "job": job
+        }
+
+    # The package or version may have been changed or deleted during the wait
+    package_entry = packages.get(query.name == package)
+    if package_entry is None:
+        return {"ok": False, "info": "Package does not exist"}
+
+    version_doc = get_package_version_by_version_string(package, version)
+    if version_doc is None:
+        return {"ok": False, "info": "Specified version does not exist for package"}
+
+    (ok, status_code, err) = version_available(version_doc)
+    if not ok:
+        response.status_code = status_code
+        return err
+
+    activated = {"current_version": version, "activated": round(time.time())}
+    result = packages.update(activated, query.name == package)
+    package_entry.update(activated)
+    POLLING.note(package_entry)
 
     try:
         remove_canary(package=package)
@@ -1121,13 +2330,16 @@ async def set_active_version(package: str, version: str):
         if str(err) != "Canary Not Found":
             raise
 
+    # Nodes download the new active version next, read in the background
+    BLOB_CACHE.prewarm(version_doc["blob_id"], lambda: read_blob(version_doc))
+
     if len(result) > 0:
         return {"ok": True}
     return {"ok": False}
 
 
-@APP.put("/node_package/", status_code=status.HTTP_200_OK)
-async def node_package(node_id: str, package: str, response: Response, version: str = ""):
+@batchable("PUT", "/node_package/")
+def node_package(node_id: str, package: str, response: Response, version: str = ""):
     """Force a node to use a particular package"""
 
     (package_doc, status_code, err) = package_exists(package)
@@ -1158,6 +2370,10 @@ async def node_package(node_id: str, package: str, response: Response, version:
                 "detail": "While attempting to set a node to use a particular package the " +
                 " version given was not found"
             }
+        (ok, status_code, err) = version_available(version_doc)
+        if not ok:
+            response.status_code = status_code
+            return err
 
     (node_doc, status_code, err) = node_exists(node_id)
     if node_doc is None:
@@ -1176,8 +2392,8 @@ async def node_package(node_id: str, package: str, response: Response, version:
     return {}
 
 
-@APP.delete("/node_package/", status_code=status.HTTP_200_OK)
-async def node_package(node_id: str, response: Response):
+@batchable("DELETE", "/node_package/")
+def node_package(node_id: str, response: Response):
     """Delete entry forcing a node to use a particular package"""
 
     (node_doc, status_code, err) = node_exists(node_id)
@@ -1202,7 +2418,7 @@ async def node_package(node_id: str, response: Response):
 
 
 @APP.get("/blob/", status_code=status.HTTP_200_OK)
-async def get_blob(package: str, blob: str, response: Response):
+async def get_blob(package: str, blob: str, request: Request, response: Response):
     """ Set a blob file """
 
     query = Query()
@@ -1214,30 +2430,53 @@ async def get_blob(package: str, blob: str, response: Response):
         return err
 
     version_entry = package_versions.get(
-        query.name == package and
-        query.blob_id == blob)
+        (query.name == package) &
+        (query.blob_id == blob))
     if version_entry is None:
         return {"ok": False, "info": "Specified blob does not exist for package"}
 
-    # Read the file from the data store
-    blob_dir = os.path.join(CONFIG["storage"]["data_dir"], "blob")
-    with open(os.path.join(blob_dir, blob), "rb") as ptr:
-        data = base64.b64decode(ptr.read())
+    (ok, status_code, err) = version_available(version_entry)
+    if not ok:
+        response.status_code = status_code
+        return err
+
+    # Blobs are verified by the scrubber in the background, not on download
+    offload = CONFIG.get("blob", {}).get("offload", "")
+    if offload and version_entry.get("encoding", "base64") == "raw" and "md5" in version_entry:
+        return offload_blob(version_entry, offload)
+
+    # Read the file from the data store, or the cache. Base64 blobs of older
+    # versions are converted at startup, never here
+    cached = await BLOB_CACHE.get(blob, lambda: read_blob(version_entry))
+
+    client = request.client.host if request.client is not None else ""
+    return ConfrmFileResponse(cached.data, cached.md5, SHAPER.buckets(package, client))
+
+
+def offload_blob(version_entry: dict, offload: str):
+    """Returns an empty response telling the reverse proxy to send the blob
 
-    # Create sha256 of data from store
-    _h = SHA256.new()
-    _h.update(data)
+    With x-accel-redirect (nginx) the header holds the blob id under the
+    offload_prefix location, with x-sendfile (Apache, lighttpd) the absolute
+    path of the blob. The hash is checked by the scrubber, not here.
 
-    # Check hash against original
-    if version_entry["hash"] != _h.hexdigest():
-        print("Hashes do not match...")
-        return
+    Attributes:
+        version_entry (dict): package version doc from DB, stored raw
+        offload (str): One of BLOB_OFFLOAD_MODES
+    """
 
-    return ConfrmFileResponse(data)
+    metrics.BLOB_OFFLOADS.inc()
+    headers = {"x-MD5": version_entry["md5"]}
+    if offload == "x-accel-redirect":
+        prefix = CONFIG["blob"].get("offload_prefix", "/confrm-blob/")
+        headers["X-Accel-Redirect"] = prefix + version_entry["blob_id"]
+    else:
+        headers["X-Sendfile"] = os.path.abspath(blob_path(version_entry["blob_id"]))
+    return Response(media_type="application/octet-stream", headers=headers)
 
 
-@APP.put("/config/", status_code=status.HTTP_201_CREATED)
-async def put_config(type: str, key: str, value: str, response: Response, id: str = ""):
+@batchable("PUT", "/config/", status.HTTP_201_CREATED)
+def put_config(type: str, key: str, value: str, response: Response, id: str = ""):
     """Adds new config to the config database
 
     Attributes:
@@ -1338,15 +2577,31 @@ async def put_config(type: str, key: str, value: str, response: Response, id: st
 
 
 @APP.get("/config/", status_code=status.HTTP_200_OK)
-async def get_config(response: Response, key: str = "", package: str = "", node_id: str = ""):
+async def get_config(  # pylint: disable=R0913
+        response: Response,
+        key: str = "",
+        package: str = "",
+        node_id: str = "",
+        type: str = "",
+        id: str = "",
+        offset: int = 0,
+        limit: int = 0):
     """Get configuration value from database
 
+    If no key is given then a sorted list of all configs is returned, which can
+    be filtered by type / id and paginated using offset / limit. The total
+    number of configs matching the filter is set in the X-Total-Count header.
+
     Attributes:
 
         key (str): Key to retrieve
         response (Response): Starlette response object
         package (str): Package of requesting node
         node_id (str): node_id of requesting node
+        type (str): [Listing] Only return configs of this type
+        id (str): [Listing] Only return configs with this package name / node id
+        offset (int): [Listing] Number of configs to skip
+        limit (int): [Listing] Maximum number of configs to return, 0 for all
     """
 
     query = Query()
@@ -1375,20 +2630,32 @@ async def get_config(response: Response, key: str = "", package: str = "", node_
             return {"value": doc["value"]}
 
     if not key:
-        # Do deepcopy to save changing database by accident
-        configs = deepcopy(config.all())
-        packages = DB.table("packages")
-        nodes = DB.table("nodes")
-        for config in configs:
-            if config["type"] == "package":
-                package_doc = packages.get(query.name == config["id"])
-                if package_doc is not None:
-                    config["package_title"] = package_doc["title"]
-            elif config["type"] == "node":
-                node_doc = nodes.get(query.node_id == config["id"])
-                if node_doc is not None:
-                    config["node_title"] = node_doc["title"]
-        return sort_configs(configs)
+        configs = config.all()
+        if type:
+            configs = [doc for doc in configs if doc["type"] == type]
+        if id:
+            configs = [doc for doc in configs if doc["id"] == id]
+        configs = sort_configs(configs)
+
+        response.headers["X-Total-Count"] = str(len(configs))
+        offset = max(offset, 0)
+        if limit > 0:
+            configs = configs[offset:offset + limit]
+        else:
+            configs = configs[offset:]
+
+        # Only the titles needed for this page are looked up, each table is
+        # read once and indexed rather than searched for every config
+        package_titles = {}
+        node_titles = {}
+        if any(doc["type"] == "package" for doc in configs):
+            package_titles = {doc["name"]: doc["title"]
+                              for doc in DB.table("packages").all()}
+        if any(doc["type"] == "node" for doc in configs):
+            node_titles = {doc["node_id"]: doc["title"]
+                           for doc in DB.table("nodes").all()}
+
+        return add_config_titles(configs, package_titles, node_titles)
 
     # Must be global...
     doc = config.get((query.type == "global") &
@@ -1407,8 +2674,8 @@ async def get_config(response: Response, key: str = "", package: str = "", node_
     return {"value": doc["value"]}
 
 
-@APP.delete("/config/", status_code=status.HTTP_200_OK)
-async def delete_config(key: str, type: str, response: Response, id: str = ""):
+@batchable("DELETE", "/config/")
+def delete_config(key: str, type: str, response: Response, id: str = ""):
     """Delete a config from the database
 
     Attributes:
@@ -1477,3 +2744,119 @@ async def delete_config(key: str, type: str, response: Response, id: str = ""):
             }
 
     return {}
+
+
+# Operations which can be batched, the endpoints are called as they are
+class BatchAborted(Exception):
+    """Raised to roll back a batch"""
+
+
+def batch_endpoint(method: str, path: str, params: dict):
+    """Returns ((handler, status_code), kwargs) for a batched operation, or
+    (None, error)"""
+
+    match = BATCH_OPERATIONS.get((method, path))
+    if match is None:
+        return (None, f"{method} {path} cannot be batched")
+
+    parameters = inspect.signature(match[0]).parameters
+    kwargs = {}
+    for (name, parameter) in parameters.items():
+        if name == "response":
+            continue
+        if name in params:
+            # Parameters are query parameters of the endpoint, so only scalars
+            if isinstance(params[name], (dict, list)):
+                return (None, f"{method} {path} parameter {name} must not be a list or object")
+            kwargs[name] = str(params[name])
+        elif parameter.default is inspect.Parameter.empty:
+            return (None, f"{method} {path} requires {name}")
+    unknown = set(params) - set(parameters)
+    if unknown:
+        return (None, f"{method} {path} does not take {', '.join(sorted(unknown))}")
+    return (match, kwargs)
+
+
+@APP.post("/batch/", status_code=status.HTTP_200_OK)
+async def post_batch(request: Request, response: Response):
+    """Applies several operations in one write, all or none of them
+
+    The body is {"operations": [{"method": "PUT", "path": "/config/",
+    "params": {...}}, ...]}, each operation takes the query parameters of its
+    endpoint. Returns the status and body of each operation, if any fails
+    none are applied.
+
+    On a replica a batch of writes to replicated data is forwarded to the
+    primary, and a batch of writes to the replica's own nodes is applied
+    locally. A batch mixing both cannot be applied together, it is refused.
+    """
+
+    try:
+        operations = (await request.json())["operations"]
+        assert isinstance(operations, list)
+        assert all(isinstance(operation, dict) for operation in operations)
+    except (ValueError, KeyError, TypeError, AssertionError):
+        operations = None
+    if not operations:
+        msg = "Unsupported batch operation"
+        logging.info(msg)
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {
+            "error": "confrm-043",
+            "message": msg,
+            "detail": 'The body must be {"operations": [...]} with at least one operation'
+        }
+
+    if REPLICA.primary:
+        forwarded = [(str(operation.get("method", "")).upper(), str(operation.get("path", "")))
+                     in replication.FORWARDED for operation in operations]
+        if all(forwarded):
+            headers = {name: value for (name, value) in request.headers.items()
+                       if name.lower() in replication.FORWARDED_HEADERS}
+            (status_code, content, content_type) = await replication.forward_request(
+                REPLICA, "POST", "/batch/", "", headers, await request.body())
+            return Response(content=content, status_code=status_code, media_type=content_type)
+        if any(forwarded):
+            msg = "Batch mixes replicated and local data"
+            logging.info(msg)
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return {
+                "error": "confrm-047",
+                "message": msg,
+                "detail": "Changes to packages and configs are made on the primary, node " +
+                          "changes on this replica, send them in separate batches"
+            }
+
+    results = []
+    try:
+        with DB.transaction():
+            for operation in operations:
+                (route, kwargs) = batch_endpoint(
+                    str(operation.get("method", "")).upper(), str(operation.get("path", "")),
+                    operation.get("params", {}))
+                if route is None:
+                    results.append({"status": status.HTTP_400_BAD_REQUEST, "body": {
+                        "error": "confrm-043",
+                        "message": "Unsupported batch operation",
+                        "detail": kwargs
+                    }})
+                    continue
+                (handler, status_code) = route
+                item_response = Response()
+                item_response.status_code = status_code
+                body = handler(response=item_response, **kwargs)
+                results.append({"status": item_response.status_code, "body": body})
+            if any(result["status"] >= 400 for result in results):
+                raise BatchAborted()
+    except BatchAborted:
+        msg = "Batch not applied"
+        logging.info(msg)
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {
+            "error": "confrm-042",
+            "message": msg,
+            "detail": "At least one operation failed, none of the operations were applied",
+            "results": results
+        }
+
+    return {"results": results}
@@ -9,10 +9,9 @@ export function updateConfigsTable(clear = false) {
 
   $("#config-table-body").html("");
 
-  let data = $.ajax({
-    url: "/config/",
-    type: "GET"
-  }).then(function (data) {
+  window.confrm_loadState().then(function (state) {
+
+    let data = state["configs"];
 
     $("#config-table-body").html("");
 
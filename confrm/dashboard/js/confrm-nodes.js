@@ -7,10 +7,9 @@ export function updateNodesTable(clear = false) {
     drawn_nodes = [];
   }
 
-  let data = $.ajax({
-    url: "/nodes/",
-    type: "GET"
-  }).then(function (data) {
+  window.confrm_loadState().then(function (state) {
+
+    let data = state["nodes"];
 
     for (let entry in data) {
 
@@ -21,10 +21,9 @@ export function updatePackagesTable(clear = false) {
     drawn_packages = [];
   }
 
-  let data = $.ajax({
-    url: "/packages/",
-    type: "GET"
-  }).then(function (data) {
+  window.confrm_loadState().then(function (state) {
+
+    let data = state["packages"];
 
     /*
      * This for loop draws the table to a table body with ID "#packages-table-body"
@@ -599,6 +598,9 @@ function setPackageVersionsModal(name) {
       let data = $.ajax({
         url: "/set_active_version/?package=" + package_name + "&version=" + version,
         type: "PUT"
+      }).fail(function (jqXHR, textStatus, errorThrown) {
+        let json = jqXHR.responseJSON;
+        window.addAlert(json.message, json.detail, "ERROR");
       }).then(function (data) {
         setPackageVersionsModal(package_name);
       });
@@ -33,6 +33,10 @@ window.confrm_templates = [];
 // General metadata
 window.confrm_meta = {};
 
+// Latest dashboard state and the request fetching it, if any
+window.confrm_state = null;
+let state_request = null;
+
 // Call the update function every 1200ms
 setInterval(updateUIEvent, 1200);
 
@@ -112,11 +116,34 @@ window.addAlert = function (message, detail, state) {
   // TODO: Once clicked the element should remove itself from the DOM properly
 }
 
+/*
+ * Everything the pages display comes from one request to /dashboard_state/, which is revalidated
+ * with its ETag (ifModified) so refreshing unchanged state is cheap. Callers made while a request is
+ * running share it. Resolves to the state object, which is the same object while unchanged.
+ */
+window.confrm_loadState = function () {
+  if (state_request === null) {
+    state_request = $.ajax({
+      url: "/dashboard_state/",
+      type: "GET",
+      ifModified: true
+    }).then(function (data, textStatus) {
+      state_request = null;
+      if ("notmodified" !== textStatus && "undefined" !== typeof data) {
+        window.confrm_state = data;
+      }
+      return window.confrm_state;
+    }, function (jqXHR) {
+      state_request = null;
+      return $.Deferred().reject(jqXHR);
+    });
+  }
+  return state_request;
+}
+
 window.confrm_updateMeta = function (meta) {
-  let data = $.ajax({
-    url: "/info/",
-    type: "GET"
-  }).then((function (data) {
+  window.confrm_loadState().then((function (state) {
+    let data = state["info"];
     for (let key in data) {
       meta[key] = data[key];
     }
@@ -137,10 +164,20 @@ window.confrm_showPage = function (name) {
 }
 window.confrm_updateMeta(window.confrm_meta);
 
+// State last drawn by updateUIEvent, pages are only redrawn when it changes
+let drawn_state = null;
+
 function updateUIEvent() {
-  if ("nodes" === window.confrm_current_page) {
-    updateNodesTable();
-  } else if ("packages" === window.confrm_current_page) {
-    updatePackagesTable();
-  }
+  window.confrm_loadState().then(function (state) {
+    if (state === drawn_state) {
+      return;
+    }
+    drawn_state = state;
+    window.confrm_updateMeta(window.confrm_meta);
+    if ("nodes" === window.confrm_current_page) {
+      updateNodesTable();
+    } else if ("packages" === window.confrm_current_page) {
+      updatePackagesTable();
+    }
+  });
 }
\ No newline at end of file
@@ -0,0 +1,362 @@
+"""Compact heartbeat and version history of nodes
+
+Copyright 2020 confrm.io
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+The nodes table only holds the latest version and last_seen time of each node.
+This module keeps an append-only history alongside it in fixed size ring
+buffers per node, so memory and disk use per node are bounded:
+
+    heartbeats  time of each registration
+    versions    time, package / version and update duration of each change
+
+Ring buffers are typed arrays of 32 bit unsigned integers (seconds since the
+epoch), package / version strings are interned and stored by index. The whole
+store is written to a single binary file, atomically, by save().
+
+The update duration of a version change is the time between the last
+heartbeat on the old version and the first heartbeat on the new version.
+"""
+
+import asyncio
+import logging
+import os
+import struct
+
+from array import array
+from threading import Lock
+
+logger = logging.getLogger('confrm')
+
+DEFAULT_HEARTBEATS = 128
+DEFAULT_VERSIONS = 32
+
+_MAGIC = b"CFRMHST1"
+_HEADER = struct.Struct("<8sII")
+_NODE = struct.Struct("<HIIII")
+
+
+class _Ring:
+    """Fixed capacity ring buffer over one or more parallel uint32 arrays"""
+
+    __slots__ = ("columns", "capacity", "head", "count")
+
+    def __init__(self, capacity: int, columns: int = 1):
+        self.capacity = capacity
+        self.columns = [array("I", bytes(4 * capacity)) for _ in range(columns)]
+        self.head = 0
+        self.count = 0
+
+    def append(self, *values):
+        """Append a row, overwriting the oldest row when full"""
+        for (column, value) in zip(self.columns, values):
+            column[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def rows(self):
+        """Returns rows oldest first as tuples"""
+        start = (self.head - self.count) % self.capacity
+        indexes = [(start + ind) % self.capacity for ind in range(self.count)]
+        return [tuple(column[ind] for column in self.columns) for ind in indexes]
+
+    def last(self):
+        """Returns the newest row or None"""
+        if self.count == 0:
+            return None
+        ind = (self.head - 1) % self.capacity
+        return tuple(column[ind] for column in self.columns)
+
+
+class _NodeHistory:  # pylint: disable=R0903
+    """History rings of a single node"""
+
+    __slots__ = ("heartbeats", "versions")
+
+    def __init__(self, heartbeats: int, versions: int):
+        self.heartbeats = _Ring(heartbeats)
+        # time, version index, update duration
+        self.versions = _Ring(versions, 3)
+
+
+class HistoryStore:
+    """Bounded history of node heartbeats and version changes
+
+    Attributes:
+        heartbeats (int): Number of heartbeats kept per node
+        versions (int): Number of version changes kept per node
+    """
+
+    def __init__(self, heartbeats: int = DEFAULT_HEARTBEATS,
+                 versions: int = DEFAULT_VERSIONS):
+        self.heartbeat_capacity = heartbeats
+        self.version_capacity = versions
+        self._nodes = {}
+        self._strings = []
+        self._string_index = {}
+        self._lock = Lock()
+        self.changes = 0
+
+    def _intern(self, package: str, version: str):
+        key = f"{package}\n{version}"
+        index = self._string_index.get(key)
+        if index is None:
+            index = len(self._strings)
+            self._strings.append(key)
+            self._string_index[key] = index
+        return index
+
+    def _version(self, index: int):
+        (package, version) = self._strings[index].split("\n", 1)
+        return (package, version)
+
+    def record(self, node_id: str, package: str, version: str, now: float):
+        """Record a heartbeat, and a version change if the package or version
+        differs from the previous heartbeat
+
+        Attributes:
+            node_id (str): Node sending the heartbeat
+            package (str): Package the node is running
+            version (str): Version of the package the node is running
+            now (float): Time of the heartbeat
+        """
+
+        now = int(now)
+        with self._lock:
+            node = self._nodes.get(node_id)
+            if node is None:
+                node = _NodeHistory(self.heartbeat_capacity, self.version_capacity)
+                self._nodes[node_id] = node
+            index = self._intern(package, version)
+            last_version = node.versions.last()
+            if last_version is None or last_version[1] != index:
+                duration = 0
+                last_heartbeat = node.heartbeats.last()
+                if last_version is not None and last_heartbeat is not None:
+                    duration = max(0, now - last_heartbeat[0])
+                node.versions.append(now, index, duration)
+            node.heartbeats.append(now)
+            self.changes += 1
+
+    def node_timeline(self, node_id: str, since: float = 0):
+        """Returns the history of a node, or None if there is none
+
+        Attributes:
+            node_id (str): Node to get the history of
+            since (float): Only return entries at or after this time
+        """
+
+        with self._lock:
+            node = self._nodes.get(node_id)
+            if node is None:
+                return None
+            heartbeats = [row[0] for row in node.heartbeats.rows() if row[0] >= since]
+            versions = []
+            for (when, index, duration) in node.versions.rows():
+                if when < since:
+                    continue
+                (package, version) = self._version(index)
+                versions.append({"time": when, "package": package, "version": version,
+                                 "update_duration": duration})
+
+        intervals = sorted(later - earlier for (earlier, later)
+                           in zip(heartbeats, heartbeats[1:]))
+        interval = intervals[len(intervals) // 2] if intervals else None
+        return {"node_id": node_id,
+                "heartbeats": heartbeats,
+                "heartbeat_interval": interval,
+                "versions": versions}
+
+    def version_timeline(self, package: str, version: str = ""):
+        """Returns when nodes moved to a package (version), oldest first
+
+        Attributes:
+            package (str): Package name
+            version (str): Version, if empty all versions of the package
+        """
+
+        with self._lock:
+            if version:
+                indexes = {self._string_index.get(f"{package}\n{version}")}
+            else:
+                indexes = {index for (index, key) in enumerate(self._strings)
+                           if key.split("\n", 1)[0] == package}
+            indexes.discard(None)
+            entries = []
+            if indexes:
+                for (node_id, node) in self._nodes.items():
+                    for (when, index, duration) in node.versions.rows():
+                        if index in indexes:
+                            entries.append({"node_id": node_id, "time": when,
+                                            "version": self._version(index)[1],
+                                            "update_duration": duration})
+        return sorted(entries, key=lambda x: (x["time"], x["node_id"]))
+
+    def clear(self):
+        """Removes all history"""
+        with self._lock:
+            self._nodes = {}
+            self._strings = []
+            self._string_index = {}
+            self.changes = 0
+
+    def node_count(self):
+        """Number of nodes with history"""
+        return len(self._nodes)
+
+    def dumps(self):
+        """Serializes the store to bytes"""
+
+        with self._lock:
+            parts = [_HEADER.pack(_MAGIC, self.heartbeat_capacity, self.version_capacity)]
+            strings = "\0".join(self._strings).encode()
+            parts.append(struct.pack("<I", len(strings)))
+            parts.append(strings)
+            parts.append(struct.pack("<I", len(self._nodes)))
+            for (node_id, node) in self._nodes.items():
+                encoded = node_id.encode()
+                parts.append(_NODE.pack(len(encoded),
+                                        node.heartbeats.head, node.heartbeats.count,
+                                        node.versions.head, node.versions.count))
+                parts.append(encoded)
+                parts.append(node.heartbeats.columns[0].tobytes())
+                for column in node.versions.columns:
+                    parts.append(column.tobytes())
+        return b"".join(parts)
+
+    def loads(self, data: bytes):
+        """Replaces the store with serialized data from dumps()
+
+        If the stored capacities differ from the current ones the rings are
+        copied, keeping the newest entries. Raises ValueError if the data is
+        not a complete history, the store is left as it was.
+        """
+
+        try:
+            (nodes, strings) = self._parse(data)
+        except (struct.error, UnicodeDecodeError) as err:
+            raise ValueError(f"History is truncated or corrupt: {err}") from err
+
+        with self._lock:
+            self._nodes = nodes
+            self._strings = strings
+            self._string_index = {key: index for (index, key) in enumerate(strings)}
+            self.changes = 0
+
+    def _parse(self, data: bytes):
+        (magic, heartbeats, versions) = _HEADER.unpack_from(data, 0)
+        if magic != _MAGIC:
+            raise ValueError("Not a confrm history file")
+        if not heartbeats or not versions:
+            raise ValueError("History capacities must be at least 1")
+        offset = _HEADER.size
+        (length,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        strings = data[offset:offset + length].decode().split("\0") if length else []
+        offset += length
+        (node_count,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+
+        nodes = {}
+        for _ in range(node_count):
+            (id_length, hb_head, hb_count, v_head, v_count) = _NODE.unpack_from(data, offset)
+            offset += _NODE.size
+            node_id = data[offset:offset + id_length].decode()
+            offset += id_length
+
+            stored = _NodeHistory(heartbeats, versions)
+            for (ring, count, head) in [(stored.heartbeats, hb_count, hb_head),
+                                        (stored.versions, v_count, v_head)]:
+                if head >= ring.capacity or count > ring.capacity:
+                    raise ValueError(f"History of node {node_id} is corrupt")
+                ring.head = head
+                ring.count = count
+                for column in ring.columns:
+                    if offset + 4 * ring.capacity > len(data):
+                        raise ValueError("History is truncated")
+                    column[:] = array("I", data[offset:offset + 4 * ring.capacity])
+                    offset += 4 * ring.capacity
+            if any(row[1] >= len(strings) for row in stored.versions.rows()):
+                raise ValueError(f"History of node {node_id} is corrupt")
+
+            node = stored
+            if heartbeats != self.heartbeat_capacity or versions != self.version_capacity:
+                node = _NodeHistory(self.heartbeat_capacity, self.version_capacity)
+                for row in stored.heartbeats.rows():
+                    node.heartbeats.append(*row)
+                for row in stored.versions.rows():
+                    node.versions.append(*row)
+            nodes[node_id] = node
+        return (nodes, strings)
+
+    def save(self, path: str, data: bytes = None):
+        """Atomically writes the store to path
+
+        Attributes:
+            path (str): File to write
+            data (bytes): Output of dumps(), taken now if not given
+        """
+
+        if data is None:
+            data = self.dumps()
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as ptr:
+            ptr.write(data)
+            ptr.flush()
+            os.fsync(ptr.fileno())
+        os.replace(temp_path, path)
+
+    def load(self, path: str):
+        """Loads the store from path, the store is emptied if it does not exist
+
+        A file which cannot be read is moved aside to path.corrupt and the
+        store starts empty, so a bad file does not stop the server starting.
+        """
+        if not os.path.isfile(path):
+            self.clear()
+            return
+        with open(path, "rb") as ptr:
+            data = ptr.read()
+        try:
+            self.loads(data)
+        except ValueError as err:
+            logger.warning("Node history %s cannot be read, moved to %s.corrupt: %s",
+                           path, path, err)
+            os.replace(path, path + ".corrupt")
+            self.clear()
+
+
+async def run_flush(store: HistoryStore, path: str, interval: float = 60.0):
+    """Periodically saves the store if it has changed, runs forever
+
+    The store is serialized on the event loop, which is a copy of the ring
+    buffers, and written to disk in the default executor.
+
+    Attributes:
+        store (HistoryStore): Store to save
+        path (str): File to save to
+        interval (float): Seconds between saves
+    """
+
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(interval)
+        if not store.changes:
+            continue
+        store.changes = 0
+        data = store.dumps()
+        try:
+            await loop.run_in_executor(None, store.save, path, data)
+        except OSError:
+            logger.exception("Failed to save history to %s", path)
@@ -0,0 +1,330 @@
+"""Lightweight Prometheus compatible metrics for confrm
+
+Copyright 2020 confrm.io
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Metrics are held in process memory and rendered in the Prometheus text
+exposition format by the /metrics endpoint. Recording a value is a dict
+lookup plus a few additions, which is cheap enough to leave on all the time.
+"""
+
+import asyncio
+import time
+
+from bisect import bisect_left
+from threading import Lock
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Buckets (seconds) suited to a small single worker server
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Buckets (bytes) for package binary sizes, 4kB to 16MB
+SIZE_BUCKETS = tuple(4096 * 4 ** i for i in range(7))
+
+
+def _format_value(value):
+    """Formats a number for the exposition format"""
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names, values, extra=None):
+    """Formats label names and values as {name="value",...}"""
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = []
+    for (name, value) in pairs:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+class _Metric:
+    """Base class for the metric types"""
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.label_names):
+            raise ValueError(f"Metric {self.name} expects labels {self.label_names}")
+        return tuple(str(label) for label in labels)
+
+    def clear(self):
+        """Remove all recorded values"""
+        with self._lock:
+            self._values = {}
+
+    def samples(self):
+        """Returns list of (name, label_string, value) tuples"""
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, _format_labels(self.label_names, key), value)
+                for (key, value) in sorted(items)]
+
+    def render(self):
+        """Renders the metric in the exposition format"""
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.kind}"]
+        for (name, labels, value) in self.samples():
+            lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Monotonically increasing value"""
+
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        """Increment the counter for the given label values"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, *labels):
+        """Returns current value for the given label values"""
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """Value which can go up and down"""
+
+    kind = "gauge"
+
+    def set(self, *labels, value):
+        """Set the gauge for the given label values"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, *labels, amount=1):
+        """Increment the gauge for the given label values"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        """Decrement the gauge for the given label values"""
+        self.inc(*labels, amount=-amount)
+
+    def get(self, *labels):
+        """Returns current value for the given label values"""
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in fixed buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (),
+                 buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, *labels, value):
+        """Record an observation for the given label values"""
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._values[key] = entry
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def get(self, *labels):
+        """Returns (count, sum) for the given label values"""
+        entry = self._values.get(self._key(labels))
+        if entry is None:
+            return (0, 0.0)
+        return (entry[2], entry[1])
+
+    def samples(self):
+        with self._lock:
+            items = [(key, (list(entry[0]), entry[1], entry[2]))
+                     for (key, entry) in self._values.items()]
+        samples = []
+        for (key, (counts, total, count)) in sorted(items):
+            cumulative = 0
+            for (bound, bucket_count) in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.label_names, key, ("le", _format_value(float(bound))))
+                samples.append((self.name + "_bucket", labels, cumulative))
+            labels = _format_labels(self.label_names, key)
+            samples.append((self.name + "_sum", labels, total))
+            samples.append((self.name + "_count", labels, count))
+        return samples
+
+
+class Registry:
+    """Collection of metrics which can be rendered together"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        """Add a metric to the registry, returns the metric"""
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: tuple = ()):
+        """Create and register a counter"""
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: tuple = ()):
+        """Create and register a gauge"""
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: tuple = (),
+                  buckets: tuple = LATENCY_BUCKETS):
+        """Create and register a histogram"""
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def clear(self):
+        """Reset all metrics, used by tests"""
+        for metric in self._metrics:
+            metric.clear()
+
+    def render(self):
+        """Render all metrics in the exposition format"""
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUEST_LATENCY = REGISTRY.histogram(
+    "confrm_request_duration_seconds",
+    "Time taken to serve HTTP requests, by route template",
+    ("method", "route"))
+REQUEST_COUNT = REGISTRY.counter(
+    "confrm_requests_total",
+    "HTTP requests served, by route template and status code",
+    ("method", "route", "status"))
+STORAGE_LATENCY = REGISTRY.histogram(
+    "confrm_storage_duration_seconds",
+    "Time taken by database storage operations",
+    ("operation",))
+BLOB_BYTES = REGISTRY.counter(
+    "confrm_blob_bytes_sent_total",
+    "Bytes of package binaries sent to nodes")
+BLOB_OFFLOADS = REGISTRY.counter(
+    "confrm_blob_offloads_total",
+    "Package binary downloads handed to the reverse proxy")
+BLOB_RECLAIMED_BYTES = REGISTRY.counter(
+    "confrm_blob_reclaimed_bytes_total",
+    "Bytes of unreferenced package binaries removed")
+BLOB_QUARANTINED = REGISTRY.counter(
+    "confrm_blob_quarantined_total",
+    "Package binaries quarantined for not matching their hash")
+BLOB_ACTIVE = REGISTRY.gauge(
+    "confrm_blob_active_transfers",
+    "Package binary downloads currently in progress")
+UPLOAD_SIZE = REGISTRY.histogram(
+    "confrm_upload_size_bytes",
+    "Size of uploaded package binaries",
+    buckets=SIZE_BUCKETS)
+LOOP_LAG = REGISTRY.gauge(
+    "confrm_event_loop_lag_seconds",
+    "Most recently measured delay of the event loop")
+LOOP_LAG_HISTOGRAM = REGISTRY.histogram(
+    "confrm_event_loop_lag_distribution_seconds",
+    "Distribution of measured event loop delays")
+
+
+def route_name(scope: Scope):
+    """Returns the route template for a request scope, not the raw path, so
+    that the number of label values stays bounded"""
+
+    route = scope.get("route")
+    if route is not None and hasattr(route, "path"):
+        return route.path
+    return "unmatched"
+
+
+class MetricsMiddleware:  # pylint: disable=R0903
+    """ASGI middleware recording latency and status of every HTTP request
+
+    Latency is measured until the last body chunk has been sent so streamed
+    downloads are counted in full.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = [500]
+        recorded = [False]
+
+        def record():
+            if recorded[0]:
+                return
+            recorded[0] = True
+            route = route_name(scope)
+            REQUEST_LATENCY.observe(scope["method"], route,
+                                    value=time.perf_counter() - start)
+            REQUEST_COUNT.inc(scope["method"], route, status_code[0])
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                status_code[0] = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and \
+                    not message.get("more_body", False):
+                record()
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            record()
+
+
+async def monitor_event_loop(interval: float = 0.5):
+    """Measures how late the event loop wakes up from a sleep, runs forever
+
+    Attributes:
+        interval (float): Seconds between measurements
+    """
+
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - start - interval)
+        LOOP_LAG.set(value=lag)
+        LOOP_LAG_HISTOGRAM.observe(value=lag)
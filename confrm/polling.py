@@ -0,0 +1,133 @@
+"""Server directed intervals between node check ins
+
+Copyright 2020 confrm.io
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+/register_node/ and /check_for_update/ tell the node how many seconds to
+wait before checking in again, next_check_in. Nodes which follow it let the
+server spread its load:
+
+    * The interval is at least the time the online fleet takes to check in
+      once at target_rate requests per second, so a small fleet checks
+      often and a large one spreads out
+    * While the event loop lags by more than busy_lag the interval grows, up
+      to four times
+    * Nodes in a rollout, those told to run a version other than their own,
+      or of a package whose active version changed within rollout_window
+      seconds while they run another, use rollout_interval instead of
+      interval, still limited by the fleet size
+    * Each node's interval is moved by up to jitter of itself, by an amount
+      fixed by its node_id, so nodes which start together do not stay
+      together
+
+The result is kept between min_interval and max_interval. The active version
+of each package, and when it was set, is kept in memory so heartbeats do not
+read the packages table.
+"""
+
+import hashlib
+
+
+class PollScheduler:  # pylint: disable=R0902
+    """Computes next_check_in
+
+    Attributes:
+        interval (float): Seconds between check ins of a small, idle fleet
+        rollout_interval (float): Seconds between check ins of nodes in a rollout
+        min_interval (float): Fewest seconds ever returned
+        max_interval (float): Most seconds ever returned
+        target_rate (float): Check ins per second the fleet is spread to, 0
+                             for no limit
+        busy_lag (float): Event loop lag in seconds above which the interval
+                          grows, 0 to ignore the lag
+        jitter (float): Fraction of the interval each node is moved by at most
+        rollout_window (float): Seconds after a version is set active in
+                                which its package is in a rollout
+    """
+
+    def __init__(self):
+        self.interval = 300
+        self.rollout_interval = 30
+        self.min_interval = 10
+        self.max_interval = 3600
+        self.target_rate = 20
+        self.busy_lag = 0.1
+        self.jitter = 0.1
+        self.rollout_window = 3600
+        self._active = {}
+
+    def configure(self, config: dict):
+        """Sets the settings from the [polling] config"""
+
+        self.interval = config.get("interval", 300)
+        self.rollout_interval = config.get("rollout_interval", 30)
+        self.min_interval = config.get("min_interval", 10)
+        self.max_interval = config.get("max_interval", 3600)
+        self.target_rate = config.get("target_rate", 20)
+        self.busy_lag = config.get("busy_lag", 0.1)
+        self.jitter = config.get("jitter", 0.1)
+        self.rollout_window = config.get("rollout_window", 3600)
+        self._active = {}
+
+    def note(self, package_doc: dict):
+        """Records the active version of a package and when it was set"""
+        self._active[package_doc["name"]] = (package_doc.get("current_version", ""),
+                                             package_doc.get("activated", 0))
+
+    def forget(self, package: str):
+        """Removes a deleted package"""
+        self._active.pop(package, None)
+
+    def refresh(self, package_docs: list):
+        """Replaces the recorded active versions with those of package_docs"""
+        self._active = {}
+        for package_doc in package_docs:
+            self.note(package_doc)
+
+    def in_rollout(self, package: str, node_version: str, now: float):
+        """True if a node running node_version of a package should be told
+        about its new active version soon
+
+        Attributes:
+            package (str): Package the node runs
+            node_version (str): Version the node runs
+            now (float): Current time
+        """
+
+        (version, activated) = self._active.get(package, ("", 0))
+        return bool(version) and version != node_version and \
+            activated + self.rollout_window > now
+
+    def next_check_in(self, node_id: str, rollout: bool, online: int, lag: float):
+        """Returns the seconds a node should wait before checking in again
+
+        Attributes:
+            node_id (str): Id of the node, sets its jitter
+            rollout (bool): The node is in a rollout
+            online (int): Number of nodes online
+            lag (float): Current event loop lag in seconds
+        """
+
+        interval = self.rollout_interval if rollout else self.interval
+        if self.target_rate:
+            interval = max(interval, online / self.target_rate)
+        if self.busy_lag and lag > self.busy_lag:
+            interval *= min(4.0, lag / self.busy_lag)
+
+        # Fixed per node, evenly spread between -1 and 1
+        digest = hashlib.sha1(node_id.encode()).digest()
+        spread = int.from_bytes(digest[:4], "big") / 0xFFFFFFFF * 2 - 1
+        interval += interval * self.jitter * spread
+
+        return round(min(self.max_interval, max(self.min_interval, interval)))
@@ -0,0 +1,257 @@
+"""In-memory node presence tracking for confrm
+
+Copyright 2020 confrm.io
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Nodes are online from a heartbeat (register_node) until timeout seconds have
+passed without another. Expiry deadlines are kept in a timing wheel of one
+second slots, so a heartbeat and an expiry are both O(1) amortized, and
+online counts per package are maintained incrementally so reading them is a
+dict lookup. The tracker only lives in memory and is rebuilt from the stored
+last_seen times of the nodes after startup, in the background.
+"""
+
+import asyncio
+import logging
+import math
+import time
+
+from threading import Lock
+
+from confrm.metrics import REGISTRY
+
+logger = logging.getLogger('confrm')
+
+NODES_ONLINE = REGISTRY.gauge(
+    "confrm_nodes_online",
+    "Nodes which have sent a heartbeat within the presence timeout, by package",
+    ("package",))
+PRESENCE_EVENTS = REGISTRY.counter(
+    "confrm_presence_events_total",
+    "Nodes changing between online and offline",
+    ("event",))
+
+DEFAULT_TIMEOUT = 180
+
+
+class _NodeState:  # pylint: disable=R0903
+    """Presence state of a single node"""
+
+    __slots__ = ("package", "last_seen", "online", "generation")
+
+    def __init__(self, package: str):
+        self.package = package
+        self.last_seen = 0
+        self.online = False
+        self.generation = 0
+
+
+class PresenceTracker:
+    """Tracks which nodes are online
+
+    Attributes:
+        timeout (float): Seconds after the last heartbeat a node goes offline
+    """
+
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self._nodes = {}
+        self._online = {}
+        self._wheel = {}
+        self._cursor = None
+        self._listeners = []
+        self._lock = Lock()
+
+    def add_listener(self, callback):
+        """Register callback(event, node_id, package) called with event
+        "online" or "offline" whenever a node changes state"""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        """Remove a callback added with add_listener"""
+        self._listeners.remove(callback)
+
+    def _emit(self, event: str, node_id: str, package: str):
+        PRESENCE_EVENTS.inc(event)
+        logger.info("Node %s (%s) is %s", node_id, package, event)
+        for callback in list(self._listeners):
+            try:
+                callback(event, node_id, package)
+            except Exception:  # pylint: disable=W0703
+                logger.exception("Presence listener failed")
+
+    def _count(self, package: str, amount: int):
+        count = self._online.get(package, 0) + amount
+        if count:
+            self._online[package] = count
+        else:
+            del self._online[package]
+        NODES_ONLINE.set(package, value=count)
+
+    def _schedule(self, node_id: str, state: _NodeState):
+        slot = math.ceil(state.last_seen + self.timeout)
+        if self._cursor is None or slot < self._cursor:
+            self._cursor = slot
+        self._wheel.setdefault(slot, []).append((node_id, state.generation))
+
+    def heartbeat(self, node_id: str, package: str, now: float = None):
+        """Record a heartbeat from a node
+
+        Attributes:
+            node_id (str): Node sending the heartbeat
+            package (str): Package the node is running
+            now (float): Time of the heartbeat, defaults to time.time()
+        """
+
+        if now is None:
+            now = time.time()
+
+        events = []
+        with self._lock:
+            self._expire(now, events)
+            state = self._nodes.get(node_id)
+            if state is None:
+                state = _NodeState(package)
+                self._nodes[node_id] = state
+            if state.online and state.package != package:
+                self._count(state.package, -1)
+                self._count(package, 1)
+            state.package = package
+            state.last_seen = now
+            state.generation += 1
+            if not state.online:
+                state.online = True
+                self._count(package, 1)
+                events.append(("online", node_id, package))
+            self._schedule(node_id, state)
+
+        for event in events:
+            self._emit(*event)
+
+    def _expire(self, now: float, events: list):
+        """Mark nodes whose deadline has passed offline, lock must be held"""
+
+        if self._cursor is None:
+            return
+        now_slot = math.floor(now)
+        if now_slot < self._cursor:
+            return
+
+        # Walk the slots one by one unless there are fewer occupied slots than
+        # slots to walk, i.e. after a long idle period
+        if now_slot - self._cursor > len(self._wheel):
+            slots = sorted(slot for slot in self._wheel if slot <= now_slot)
+        else:
+            slots = range(self._cursor, now_slot + 1)
+
+        for slot in slots:
+            for (node_id, generation) in self._wheel.pop(slot, ()):
+                state = self._nodes.get(node_id)
+                # Entries from earlier heartbeats are stale and skipped
+                if state is None or state.generation != generation or not state.online:
+                    continue
+                state.online = False
+                self._count(state.package, -1)
+                events.append(("offline", node_id, state.package))
+
+        self._cursor = now_slot + 1
+
+    def expire(self, now: float = None):
+        """Mark nodes offline whose timeout has passed
+
+        Attributes:
+            now (float): Current time, defaults to time.time()
+        """
+
+        if now is None:
+            now = time.time()
+
+        events = []
+        with self._lock:
+            self._expire(now, events)
+        for event in events:
+            self._emit(*event)
+
+    def reset(self):
+        """Forget all nodes"""
+        with self._lock:
+            for package in self._online:
+                NODES_ONLINE.set(package, value=0)
+            self._nodes = {}
+            self._online = {}
+            self._wheel = {}
+            self._cursor = None
+
+    def rebuild(self, nodes, now: float = None):
+        """Add state from stored node docs, using their last_seen
+
+        Nodes already tracked have sent a heartbeat since reset() and are
+        newer than the stored state, so they are kept. No events are emitted
+        for the rebuilt state.
+
+        Attributes:
+            nodes (list): Node dicts with node_id, package and last_seen
+            now (float): Current time, defaults to time.time()
+        """
+
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            for node in nodes:
+                if node["node_id"] in self._nodes:
+                    continue
+                state = _NodeState(node["package"])
+                state.last_seen = node["last_seen"]
+                self._nodes[node["node_id"]] = state
+                if state.last_seen >= 0 and state.last_seen + self.timeout > now:
+                    state.online = True
+                    self._count(state.package, 1)
+                    self._schedule(node["node_id"], state)
+
+    def is_online(self, node_id: str, now: float = None):
+        """True if the node is online"""
+        self.expire(now)
+        state = self._nodes.get(node_id)
+        return state is not None and state.online
+
+    def online_count(self, package: str = None, now: float = None):
+        """Number of online nodes, optionally only those running package"""
+        self.expire(now)
+        if package is None:
+            return sum(self._online.values())
+        return self._online.get(package, 0)
+
+    def online_counts(self, now: float = None):
+        """Dict of package to number of online nodes"""
+        self.expire(now)
+        return dict(self._online)
+
+    def node_count(self):
+        """Number of nodes known to the tracker, online or not"""
+        return len(self._nodes)
+
+
+async def run_expiry(tracker: PresenceTracker, interval: float = 1.0):
+    """Periodically expires nodes so offline events are emitted promptly, runs
+    forever
+
+    Attributes:
+        tracker (PresenceTracker): Tracker to expire
+        interval (float): Seconds between expiry runs
+    """
+
+    while True:
+        await asyncio.sleep(interval)
+        tracker.expire()
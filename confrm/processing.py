@@ -0,0 +1,285 @@
+"""Background processing of uploaded package versions
+
+Copyright 2020 confrm.io
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Once a version is stored a job is added to the jobs table, which runs each
+configured stage over the blob in a process pool, so CPU heavy work never
+holds up the event loop or the upload. Stages are functions of the blob path
+and the version's details returning a dict stored with the job. Failures are
+retried with a growing delay, except StageError which means the blob itself
+is at fault. Jobs left unfinished by a restart are picked up again.
+
+A version with a job becomes eligible to be made active, or a canary, once
+all of the required stages are done. Versions stored before processing was
+added have no job and are always eligible.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from tinydb import Query
+
+logger = logging.getLogger('confrm')
+
+DIGEST_CHUNK_SIZE = 64 * 1024
+
+# First byte of the ESP8266 and ESP32 application image formats
+ESP_IMAGE_MAGIC = {
+    "esp32": (0xE9,),
+    "esp8266": (0xE9, 0xEA),
+}
+
+
+class StageError(Exception):
+    """The blob failed a stage, retrying will not help"""
+
+
+def chunk_digests(path: str, details: dict):  # pylint: disable=W0613
+    """SHA256 of each DIGEST_CHUNK_SIZE chunk of the blob"""
+    digests = []
+    with open(path, "rb") as ptr:
+        for chunk in iter(lambda: ptr.read(DIGEST_CHUNK_SIZE), b""):
+            digests.append(hashlib.sha256(chunk).hexdigest())
+    return {"chunk_size": DIGEST_CHUNK_SIZE, "digests": digests}
+
+
+def image_header(path: str, details: dict):
+    """Checks the blob starts with an application image header for its
+    platform, platforms with no known format only need a non-empty blob"""
+
+    with open(path, "rb") as ptr:
+        header = ptr.read(8)
+    if not header:
+        raise StageError("Image is empty")
+
+    magic = ESP_IMAGE_MAGIC.get(details.get("platform", "").lower())
+    if magic is None:
+        return {"format": "unknown"}
+    if header[0] not in magic:
+        raise StageError(f"Image does not start with a {details['platform']} header")
+    if len(header) < 8:
+        raise StageError("Image header is truncated")
+    return {"format": details["platform"].lower(), "segments": header[1]}
+
+
+STAGES = {
+    "digests": chunk_digests,
+    "image_header": image_header,
+}
+
+
+def outcome(job: dict):
+    """Describes how far the processing of a job which is not eligible got"""
+    return {"failed": "failed",
+            "deleted": "stopped, the version was deleted"}.get(job["state"], "not finished")
+
+
+class Pipeline:  # pylint: disable=R0902
+    """Queues and runs processing jobs
+
+    Attributes:
+        stages (list): Names of the stages run for each version, in order
+        required (list): Stages which must be done before a version is eligible
+        workers (int): Processes, and jobs run at once
+        retries (int): Attempts of a stage after the first
+        retry_delay (float): Seconds before the first retry, doubled each time
+    """
+
+    def __init__(self):
+        self.table = None
+        self.blob_dir = ""
+        self.stages = ["digests", "image_header"]
+        self.required = ["digests"]
+        self.workers = 2
+        self.retries = 3
+        self.retry_delay = 1.0
+        self._queue = None
+        self._events = {}
+        self._executor = None
+        self._futures = set()
+
+    def configure(self, table, blob_dir: str, config: dict):  # pylint: disable=R0913
+        """Sets the jobs table and settings from the [processing] config"""
+
+        self.close()
+        self.table = table
+        self.blob_dir = blob_dir
+        self.stages = config.get("stages", ["digests", "image_header"])
+        self.required = config.get("required", ["digests"])
+        self.workers = config.get("workers", 2)
+        self.retries = config.get("retries", 3)
+        self.retry_delay = config.get("retry_delay", 1.0)
+        for name in self.stages + self.required:
+            if name not in STAGES:
+                raise ValueError(f"Unknown processing stage {name}")
+        for name in self.required:
+            if name not in self.stages:
+                raise ValueError(f"Required processing stage {name} is not in stages")
+        self._queue = asyncio.Queue()
+        self._events = {}
+
+    def submit(self, package: str, version: str, blob_id: str, platform: str):
+        """Adds a job for a stored version, returns its doc_id"""
+
+        now = round(time.time())
+        doc_id = self.table.insert({
+            "package": package,
+            "version": version,
+            "blob_id": blob_id,
+            "platform": platform,
+            "state": "pending",
+            "stages": {name: {"state": "pending", "attempts": 0} for name in self.stages},
+            "created": now,
+            "updated": now
+        })
+        self._events[doc_id] = asyncio.Event()
+        self._queue.put_nowait(doc_id)
+        return doc_id
+
+    def job(self, package: str, version: str):
+        """Returns the job of a version, None if it has none"""
+        query = Query()
+        return self.table.get((query.package == package) & (query.version == version))
+
+    def remove(self, package: str, version: str):
+        """Removes the job of a version"""
+        query = Query()
+        self.table.remove((query.package == package) & (query.version == version))
+
+    def is_eligible(self, job: dict):
+        """True if the required stages of the job are done, versions without
+        a job are always eligible, deleted ones never are"""
+        if job is None:
+            return True
+        if job["state"] == "deleted":
+            return False
+        return all(job["stages"].get(name, {}).get("state") == "done"
+                   for name in self.required)
+
+    async def wait(self, package: str, version: str, timeout: float):
+        """Waits up to timeout seconds for the job of a version to finish,
+        returns the job, in state "deleted" if the version was deleted while
+        waiting"""
+
+        job = self.job(package, version)
+        if job is None or job["state"] in ("done", "failed"):
+            return job
+        event = self._events.setdefault(job.doc_id, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        current = self.job(package, version)
+        if current is None:
+            return dict(job, state="deleted")
+        return current
+
+    def _update(self, doc_id: int, fields: dict):
+        # The version may have been deleted while the job ran
+        if not self.table.contains(doc_id=doc_id):
+            return False
+        fields["updated"] = round(time.time())
+        self.table.update(fields, doc_ids=[doc_id])
+        return True
+
+    async def _run_stage(self, job: dict, name: str):
+        """Runs a stage with retries, returns its final entry"""
+
+        path = os.path.join(self.blob_dir, job["blob_id"])
+        entry = job["stages"][name]
+        while True:
+            entry["attempts"] += 1
+            start = time.perf_counter()
+            try:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                future = self._executor.submit(STAGES[name], path, {"platform": job["platform"]})
+                self._futures.add(future)
+                future.add_done_callback(self._futures.discard)
+                result = await asyncio.wrap_future(future)
+                return {"state": "done", "attempts": entry["attempts"], "result": result,
+                        "seconds": round(time.perf_counter() - start, 3)}
+            except asyncio.CancelledError:
+                # An Exception before Python 3.8, the pool was closed
+                raise
+            except StageError as err:
+                return {"state": "failed", "attempts": entry["attempts"], "error": str(err)}
+            except Exception as err:  # pylint: disable=W0703
+                if isinstance(err, BrokenProcessPool):
+                    self._executor = None
+                logger.warning("Processing stage %s of %s %s failed: %s", name,
+                               job["package"], job["version"], err)
+                if entry["attempts"] > self.retries:
+                    return {"state": "failed", "attempts": entry["attempts"],
+                            "error": str(err) or type(err).__name__}
+                entry["error"] = str(err) or type(err).__name__
+                await asyncio.sleep(self.retry_delay * 2 ** (entry["attempts"] - 1))
+
+    async def _process(self, doc_id: int):
+        job = self.table.get(doc_id=doc_id)
+        if job is None or not self._update(doc_id, {"state": "running"}):
+            return
+
+        state = "done"
+        for name in self.stages:
+            entry = job["stages"].setdefault(name, {"state": "pending", "attempts": 0})
+            if entry["state"] != "done":
+                job["stages"][name] = await self._run_stage(job, name)
+                if not self._update(doc_id, {"stages": job["stages"]}):
+                    return
+            if job["stages"][name]["state"] == "failed" and name in self.required:
+                state = "failed"
+                break
+
+        self._update(doc_id, {"state": state})
+        if state == "failed":
+            logger.warning("Processing of %s %s failed", job["package"], job["version"])
+
+    async def _worker(self):
+        while True:
+            doc_id = await self._queue.get()
+            try:
+                await self._process(doc_id)
+            except Exception:  # pylint: disable=W0703
+                logger.exception("Processing job %s failed", doc_id)
+            finally:
+                event = self._events.pop(doc_id, None)
+                if event is not None:
+                    event.set()
+
+    async def run(self):
+        """Runs the workers, requeuing jobs left unfinished, runs forever"""
+
+        query = Query()
+        for job in self.table.search(query.state.one_of(["pending", "running"])):
+            self._events.setdefault(job.doc_id, asyncio.Event())
+            self._queue.put_nowait(job.doc_id)
+        await asyncio.gather(*[self._worker() for _ in range(self.workers)])
+
+    def close(self):
+        """Stops the process pool, running stages are picked up on restart"""
+        if self._executor is not None:
+            # Stages not started yet are cancelled, shutdown only takes
+            # cancel_futures from Python 3.9
+            for future in list(self._futures):
+                future.cancel()
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -0,0 +1,268 @@
+"""On-demand request profiling for confrm
+
+Copyright 2020 confrm.io
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+The profiler is armed through the admin API for the next N requests, optionally
+only those whose path starts with a given prefix. While disarmed the middleware
+does a single attribute check per request and the timing hooks a single
+context variable lookup.
+
+Two modes are supported:
+
+    cprofile    Deterministic profile of the request, downloadable as a pstats
+                file which can be loaded with pstats.Stats or snakeviz
+    sample      Stack sampling of the event loop thread, downloadable as
+                collapsed stacks for flamegraph.pl / speedscope
+
+Each profiled request also records a breakdown of its time spent in storage
+I/O, hashing and (de)serialization.
+"""
+
+import contextvars
+import cProfile
+import pstats
+import sys
+import tempfile
+import threading
+import time
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+MODES = ["cprofile", "sample"]
+CATEGORIES = ["storage", "hashing", "serialization"]
+
+# Breakdown dict of the request currently being profiled, None otherwise
+_BREAKDOWN = contextvars.ContextVar("confrm_profile_breakdown", default=None)
+
+
+def add_time(category: str, seconds: float):
+    """Adds time to the breakdown of the current request, if it is profiled"""
+    breakdown = _BREAKDOWN.get()
+    if breakdown is not None:
+        breakdown[category] = breakdown.get(category, 0.0) + seconds
+
+
+class timed:  # pylint: disable=C0103
+    """Context manager adding the time of the block to the current breakdown
+
+    Attributes:
+        category (str): One of CATEGORIES
+    """
+
+    __slots__ = ("category", "start")
+
+    def __init__(self, category: str):
+        self.category = category
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        add_time(self.category, time.perf_counter() - self.start)
+
+
+class _StackSampler(threading.Thread):
+    """Samples the stack of a thread at a fixed interval in to collapsed stacks"""
+
+    def __init__(self, thread_id: int, interval: float, stacks: dict):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = stacks
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)  # pylint: disable=W0212
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            if names:
+                stack = ";".join(reversed(names))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+
+class RequestProfiler:
+    """Holds the armed state and the collected profiles"""
+
+    def __init__(self):
+        self.armed = False
+        self.mode = "cprofile"
+        self.remaining = 0
+        self.route = ""
+        self.interval = 0.001
+        self.requests = []
+        self.stacks = {}
+        self._stats = None
+        self._running = False
+        self._lock = threading.Lock()
+
+    def arm(self, count: int, route: str = "", mode: str = "cprofile",
+            interval: float = 0.001):
+        """Profile the next count requests, clears previous results
+
+        Attributes:
+            count (int): Number of requests to profile
+            route (str): Only profile requests whose path starts with this
+            mode (str): cprofile or sample
+            interval (float): Sampling interval in seconds (sample mode)
+        """
+        if mode not in MODES:
+            raise ValueError(f"Mode must be one of {MODES}")
+        if count < 1:
+            raise ValueError("Count must be at least 1")
+        with self._lock:
+            self.mode = mode
+            self.remaining = count
+            self.route = route
+            self.interval = interval
+            self.requests = []
+            self.stacks = {}
+            self._stats = None
+            self.armed = True
+
+    def disarm(self, clear: bool = False):
+        """Stop profiling, optionally clearing the results"""
+        with self._lock:
+            self.armed = False
+            self.remaining = 0
+            if clear:
+                self.requests = []
+                self.stacks = {}
+                self._stats = None
+
+    def status(self):
+        """Returns dict describing the profiler state and per request breakdowns"""
+        return {
+            "armed": self.armed,
+            "mode": self.mode,
+            "remaining": self.remaining,
+            "route": self.route,
+            "requests": list(self.requests)
+        }
+
+    def _claim(self, scope: Scope):
+        """Returns True if this request should be profiled, counting it"""
+        if self.route and not scope["path"].startswith(self.route):
+            return False
+        with self._lock:
+            # Only one request is profiled at a time, profilers cannot nest
+            if not self.armed or self._running or self.remaining < 1:
+                return False
+            self._running = True
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.armed = False
+            return True
+
+    def _release(self):
+        with self._lock:
+            self._running = False
+
+    def _add_profile(self, profile: cProfile.Profile):
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+
+    def has_results(self):
+        """True if any requests have been profiled"""
+        return bool(self.requests)
+
+    def pstats_bytes(self):
+        """Returns the collected cProfile data in the pstats file format"""
+        if self._stats is None:
+            return b""
+        with tempfile.NamedTemporaryFile() as ptr:
+            self._stats.dump_stats(ptr.name)
+            ptr.seek(0)
+            return ptr.read()
+
+    def collapsed_stacks(self):
+        """Returns the collected samples as collapsed stacks text"""
+        return "".join(f"{stack} {count}\n" for (stack, count) in sorted(self.stacks.items()))
+
+    async def profile(self, app: ASGIApp, scope: Scope, receive: Receive, send: Send):
+        """Runs the request under the profiler"""
+
+        breakdown = {}
+        token = _BREAKDOWN.set(breakdown)
+        status_code = [500]
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                status_code[0] = message["status"]
+                # Report the breakdown so far, anything after the headers is
+                # still included in the stored record
+                timing = ", ".join(f"{name};dur={breakdown.get(name, 0.0) * 1000:.3f}"
+                                   for name in CATEGORIES)
+                message = dict(message)
+                message["headers"] = list(message.get("headers", [])) + \
+                    [(b"server-timing", timing.encode())]
+            await send(message)
+
+        profile = None
+        sampler = None
+        if self.mode == "cprofile":
+            profile = cProfile.Profile()
+            profile.enable()
+        else:
+            sampler = _StackSampler(threading.get_ident(), self.interval, self.stacks)
+            sampler.start()
+
+        start = time.perf_counter()
+        try:
+            await app(scope, receive, send_wrapper)
+        finally:
+            total = time.perf_counter() - start
+            if profile is not None:
+                profile.disable()
+                self._add_profile(profile)
+            if sampler is not None:
+                sampler.stopped.set()
+                sampler.join()
+            _BREAKDOWN.reset(token)
+            record = {
+                "method": scope["method"],
+                "path": scope["path"],
+                "status": status_code[0],
+                "total": total
+            }
+            for name in CATEGORIES:
+                record[name] = breakdown.get(name, 0.0)
+            record["other"] = max(0.0, total - sum(breakdown.values()))
+            self.requests.append(record)
+            self._release()
+
+
+PROFILER = RequestProfiler()
+
+
+class ProfilingMiddleware:  # pylint: disable=R0903
+    """ASGI middleware running armed requests under the profiler"""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if not PROFILER.armed or scope["type"] != "http" or not PROFILER._claim(scope):  # pylint: disable=W0212
+            await self.app(scope, receive, send)
+            return
+        await PROFILER.profile(self.app, scope, receive, send)
@@ -0,0 +1,188 @@
+"""Request rate limits of the endpoints called by nodes
+
+Copyright 2020 confrm.io
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+A node stuck in a loop calling /register_node/ or /check_for_update/ can use
+all of the time of the server, which the dashboard needs too. Requests to
+the device endpoints take a token from a bucket for the node_id given in
+the query, if any, and one for the client address. A request finding either
+empty is answered straight away with 429 and a Retry-After header, before
+any of its work is done.
+
+Buckets are kept for the most recently seen max_keys nodes and addresses,
+so memory is bounded whatever the number of clients. A client whose bucket
+was dropped starts again with a full one.
+
+The server also sheds requests to the device endpoints while the event loop
+is lagging by more than max_lag seconds, nodes retry later and the dashboard
+stays usable.
+
+Refused requests are counted by reason in a metric. The nodes refused most
+recently, up to max_throttled of them, are kept with their counts so the
+worst offenders can be found without a metric label per node.
+"""
+
+import json
+import math
+import time
+import urllib.parse
+
+from collections import OrderedDict
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from confrm.metrics import LOOP_LAG, REGISTRY
+from confrm.shaping import TokenBucket
+
+RATE_LIMITED = REGISTRY.counter(
+    "confrm_rate_limited_total",
+    "Requests to device endpoints refused, by reason",
+    ("reason",))
+
+DEVICE_PATHS = ["/register_node/", "/check_for_update/", "/blob/", "/time/"]
+
+
+class RateLimiter:  # pylint: disable=R0902
+    """Token buckets of nodes and client addresses
+
+    Attributes:
+        paths (list): Paths of the endpoints which are limited
+        node_rate (float): Requests per second of each node, 0 for no limit
+        node_burst (int): Requests a node can make at once
+        address_rate (float): Requests per second of each address, 0 for no limit
+        address_burst (int): Requests an address can make at once
+        max_keys (int): Buckets kept, least recently used are dropped first
+        max_lag (float): Event loop lag in seconds above which requests are
+                         refused, 0 to never refuse them
+        max_throttled (int): Refused nodes kept, least recently refused are
+                             dropped first
+    """
+
+    def __init__(self):
+        self.paths = set(DEVICE_PATHS)
+        self.node_rate = 0
+        self.node_burst = 10
+        self.address_rate = 0
+        self.address_burst = 50
+        self.max_keys = 10000
+        self.max_lag = 0
+        self.max_throttled = 100
+        self._buckets = OrderedDict()
+        self._throttled = OrderedDict()
+
+    def configure(self, config: dict):
+        """Sets the limits from the [rate_limit] config, drops all buckets"""
+
+        self.paths = set(config.get("paths", DEVICE_PATHS))
+        self.node_rate = config.get("node_rate", 0)
+        self.node_burst = config.get("node_burst", 10)
+        self.address_rate = config.get("address_rate", 0)
+        self.address_burst = config.get("address_burst", 50)
+        self.max_keys = config.get("max_keys", 10000)
+        self.max_lag = config.get("max_lag", 0)
+        self.max_throttled = config.get("max_throttled", 100)
+        self._buckets = OrderedDict()
+        self._throttled = OrderedDict()
+
+    def _bucket(self, key: tuple, rate: float, burst: int):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, burst)
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def check(self, node_id: str, address: str):
+        """Takes a request from the buckets of the node and the address,
+        returns (seconds to wait, reason), 0 if the request may go ahead"""
+
+        if self.max_lag and LOOP_LAG.get() > self.max_lag:
+            return (1.0, "overloaded")
+
+        # Nothing is taken from the node if its address is limited
+        if self.address_rate and address:
+            wait = self._bucket(("address", address), self.address_rate,
+                                self.address_burst).take()
+            if wait:
+                return (wait, "address")
+        if self.node_rate and node_id:
+            wait = self._bucket(("node", node_id), self.node_rate, self.node_burst).take()
+            if wait:
+                return (wait, "node")
+        return (0.0, "")
+
+    def refused(self, node_id: str, reason: str):
+        """Counts a refused request of a node, empty if not given"""
+
+        RATE_LIMITED.inc(reason)
+        if not node_id or not self.max_throttled:
+            return
+        entry = self._throttled.pop(node_id, None) or {"node_id": node_id, "refused": 0}
+        entry["refused"] += 1
+        entry["last"] = round(time.time())
+        entry["reason"] = reason
+        self._throttled[node_id] = entry
+        if len(self._throttled) > self.max_throttled:
+            self._throttled.popitem(last=False)
+
+    def throttled(self):
+        """Returns the most recently refused nodes, most refused first"""
+        return sorted((dict(entry) for entry in self._throttled.values()),
+                      key=lambda entry: entry["refused"], reverse=True)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class RateLimitMiddleware:  # pylint: disable=R0903
+    """ASGI middleware refusing requests over the limits of a RateLimiter
+
+    Attributes:
+        limiter (RateLimiter): Limits and buckets
+    """
+
+    def __init__(self, app: ASGIApp, limiter: RateLimiter) -> None:
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+
+        if scope["type"] != "http" or scope["path"] not in self.limiter.paths:
+            await self.app(scope, receive, send)
+            return
+
+        query = urllib.parse.parse_qs(scope["query_string"].decode(errors="replace"))
+        node_id = query.get("node_id", [""])[0]
+        address = scope["client"][0] if scope.get("client") else ""
+        (wait, reason) = self.limiter.check(node_id, address)
+        if not wait:
+            await self.app(scope, receive, send)
+            return
+
+        self.limiter.refused(node_id, reason)
+        content = json.dumps({
+            "error": "confrm-046",
+            "message": "Too many requests",
+            "detail": "The server is overloaded, try again later" if reason == "overloaded"
+            else f"Requests from this {reason} are over the rate limit, try again later"
+        }).encode()
+        await send({"type": "http.response.start", "status": 429,
+                    "headers": [(b"content-type", b"application/json"),
+                                (b"content-length", str(len(content)).encode()),
+                                (b"retry-after", str(math.ceil(wait)).encode())]})
+        await send({"type": "http.response.body", "body": content})
@@ -0,0 +1,321 @@
+"""Replica mode, following a primary confrm server
+
+Copyright 2020 confrm.io
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+A replica serves nodes on its own LAN from a local copy of the packages,
+versions, configs and canaries of a primary. It polls the change log of the
+primary (GET /changes/), starting from a full copy, downloads the blobs of
+new versions and verifies their hashes before the versions become visible
+locally, then applies each table's changes in a single write.
+
+Nodes and their heartbeats stay local to each site. Admin writes to the
+replicated data are forwarded to the primary and the replica syncs straight
+after, so the change shows up locally within one round trip.
+"""
+
+import asyncio
+import base64
+import logging
+import os
+import time
+
+import requests
+
+from Crypto.Hash import SHA256
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+logger = logging.getLogger('confrm')
+
+# Bytes of a blob read from the primary at a time
+CHUNK_SIZE = 64 * 1024
+
+# Writes which change replicated data, forwarded to the primary, upload
+# sessions live on the primary so all their calls go there
+FORWARDED = {
+    ("PUT", "/package/"),
+    ("DELETE", "/package/"),
+    ("POST", "/package_version/"),
+    ("DELETE", "/package_version/"),
+    ("PUT", "/set_active_version/"),
+    ("POST", "/upload/"),
+    ("GET", "/upload/"),
+    ("PUT", "/upload/"),
+    ("DELETE", "/upload/"),
+    ("POST", "/upload/finalize/"),
+    ("GET", "/scrub/"),
+    ("POST", "/scrub/"),
+    ("PUT", "/config/"),
+    ("DELETE", "/config/"),
+}
+
+# Request headers passed on to the primary
+FORWARDED_HEADERS = ("content-type", "x-confrm-admin-token", "accept")
+
+
+def apply_table(table, docs: dict, replace: bool = False):
+    """Applies documents to a table in one write
+
+    Attributes:
+        table (Table): TinyDB table
+        docs (dict): doc_id to document, None removes the document
+        replace (bool): If true documents not in docs are removed
+    """
+
+    def updater(data):
+        if replace:
+            data.clear()
+        for (doc_id, doc) in docs.items():
+            if doc is None:
+                data.pop(doc_id, None)
+            else:
+                data[doc_id] = doc
+
+    table._update_table(updater)  # pylint: disable=W0212
+    # Inserts must not reuse the ids of replicated documents
+    table._next_id = None  # pylint: disable=W0212
+
+
+class Replica:
+    """Follows a primary server
+
+    Attributes:
+        primary (str): Base URL of the primary, replica mode is off if empty
+        token (str): Admin token of the primary
+        interval (float): Seconds between polls
+    """
+
+    def __init__(self):
+        self.primary = ""
+        self.token = ""
+        self.interval = 10.0
+        self.session = requests.Session()
+        self.instance = ""
+        self.seq = 0
+        self.status = {}
+        self._wake = None
+        self.configure("")
+
+    def configure(self, primary: str, token: str = "", interval: float = 10.0):
+        """Sets the primary and resets the replication cursor"""
+        self.primary = primary.rstrip("/")
+        self.token = token
+        self.interval = interval
+        self.instance = ""
+        self.seq = 0
+        self.status = {"primary": self.primary, "synced": False, "last_sync": None,
+                       "last_error": None, "blobs_fetched": 0}
+
+    def _headers(self):
+        return {"X-Confrm-Admin-Token": self.token} if self.token else {}
+
+    def _get_changes(self):
+        response = self.session.get(f"{self.primary}/changes/",
+                                    params={"instance": self.instance, "since": self.seq},
+                                    headers=self._headers(), timeout=60)
+        response.raise_for_status()
+        return response.json()
+
+    def _fetch_blob(self, blob_dir: str, version: dict):
+        """Downloads and verifies the blob of a version, blocks on I/O
+
+        The blob is written to a temporary file as it arrives and hashed on the
+        way, it replaces the stored blob once the hash matches.
+        """
+
+        # Stored the same way as on the primary, base64 is written in whole
+        # groups of three bytes
+        encode = version.get("encoding", "base64") == "base64"
+        path = os.path.join(blob_dir, version["blob_id"])
+        digest = SHA256.new()
+        with self.session.get(f"{self.primary}/blob/",
+                              params={"package": version["name"],
+                                      "blob": version["blob_id"]},
+                              headers=self._headers(), timeout=300, stream=True) as response:
+            response.raise_for_status()
+            with open(path + ".tmp", "wb") as ptr:
+                rest = b""
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    digest.update(chunk)
+                    if encode:
+                        chunk = rest + chunk
+                        cut = len(chunk) - len(chunk) % 3
+                        (chunk, rest) = (base64.b64encode(chunk[:cut]), chunk[cut:])
+                    ptr.write(chunk)
+                ptr.write(base64.b64encode(rest))
+
+        if digest.hexdigest() != version["hash"]:
+            os.remove(path + ".tmp")
+            raise ValueError(f"Hash of blob {version['blob_id']} does not match")
+        os.replace(path + ".tmp", path)
+        self.status["blobs_fetched"] += 1
+
+    async def sync(self, database, blob_dir: str, on_packages=None):
+        """Pulls and applies changes until up to date with the primary
+
+        Attributes:
+            database (TinyDB): Local database
+            blob_dir (str): Local blob directory
+            on_packages (callable): Called with all package docs once changes
+                                    to packages are applied
+        """
+
+        loop = asyncio.get_event_loop()
+        while True:
+            data = await loop.run_in_executor(None, self._get_changes)
+
+            if "snapshot" in data:
+                updates = {name: {int(doc_id): doc for (doc_id, doc) in docs.items()}
+                           for (name, docs) in data["snapshot"].items()}
+            else:
+                updates = {}
+                for (_, name, doc_id, doc) in data["changes"]:
+                    updates.setdefault(name, {})[int(doc_id)] = doc
+
+            # Blobs first, a version is only visible once its blob is here, the
+            # primary does not send the blobs of quarantined versions. Blobs the
+            # primary converted from base64 to raw are fetched again
+            versions = database.table("package_versions")
+            old_blobs = {doc["blob_id"] for doc in versions.all()}
+            for (doc_id, doc) in updates.get("package_versions", {}).items():
+                if doc is None or "quarantined" in doc:
+                    continue
+                old_doc = versions.get(doc_id=doc_id)
+                if not os.path.isfile(os.path.join(blob_dir, doc["blob_id"])) or \
+                        (old_doc is not None and
+                         old_doc.get("encoding", "base64") != doc.get("encoding", "base64")):
+                    await loop.run_in_executor(None, self._fetch_blob, blob_dir, doc)
+
+            for (name, docs) in updates.items():
+                apply_table(database.table(name), docs, replace="snapshot" in data)
+            if "packages" in updates and on_packages is not None:
+                on_packages(database.table("packages").all())
+
+            # Remove blobs of versions which no longer exist
+            new_blobs = {doc["blob_id"] for doc in versions.all()}
+            for blob_id in old_blobs - new_blobs:
+                try:
+                    os.remove(os.path.join(blob_dir, blob_id))
+                except FileNotFoundError:
+                    pass
+
+            self.instance = data["instance"]
+            self.seq = data["seq"]
+            if not data.get("more", False):
+                break
+
+        self.status.update({"synced": True, "last_sync": round(time.time()),
+                            "last_error": None, "instance": self.instance, "seq": self.seq})
+
+    def wake(self):
+        """Makes the sync loop poll now"""
+        if self._wake is not None:
+            self._wake.set()
+
+    async def run(self, database, blob_dir: str, on_packages=None):
+        """Syncs with the primary every interval seconds, runs forever"""
+
+        self._wake = asyncio.Event()
+        while True:
+            try:
+                await self.sync(database, blob_dir, on_packages)
+            except Exception as err:  # pylint: disable=W0703
+                logger.warning("Replication from %s failed: %s", self.primary, err)
+                self.status["last_error"] = str(err)
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    def forward(self, method: str, path: str, query: str, headers: dict, body: bytes):
+        """Forwards a request to the primary, blocks on I/O, returns the
+        requests response"""
+        url = f"{self.primary}{path}" + (f"?{query}" if query else "")
+        return self.session.request(method, url, headers=headers, data=body, timeout=300)
+
+
+async def forward_request(replica: Replica, method: str, path: str, query: str,  # pylint: disable=R0913
+                          headers: dict, body: bytes):
+    """Forwards a request to the primary in the executor, wakes the replica if
+    it succeeded, returns (status code, content, content type)
+
+    Attributes:
+        replica (Replica): Replica settings
+        method (str): HTTP method
+        path (str): Path of the endpoint
+        query (str): Query string
+        headers (dict): Headers passed on, see FORWARDED_HEADERS
+        body (bytes): Body of the request
+    """
+
+    loop = asyncio.get_event_loop()
+    try:
+        response = await loop.run_in_executor(
+            None, replica.forward, method, path, query, headers, body)
+        status_code = response.status_code
+        content = response.content
+        content_type = response.headers.get("content-type", "application/json")
+    except requests.RequestException as err:
+        logger.warning("Forwarding %s %s to %s failed: %s", method, path, replica.primary, err)
+        status_code = 502
+        content = ('{"error": "confrm-033", "message": "Primary not reachable", '
+                   '"detail": "The replica could not forward the request to the '
+                   'primary server"}').encode()
+        content_type = "application/json"
+
+    if status_code < 300:
+        replica.wake()
+    return (status_code, content, content_type)
+
+
+class ForwardMiddleware:  # pylint: disable=R0903
+    """ASGI middleware forwarding writes of replicated data to the primary
+
+    Attributes:
+        replica (Replica): Replica settings, nothing is forwarded if it has
+                           no primary
+    """
+
+    def __init__(self, app: ASGIApp, replica: Replica) -> None:
+        self.app = app
+        self.replica = replica
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+
+        if not self.replica.primary or scope["type"] != "http" or \
+                (scope["method"], scope["path"]) not in FORWARDED:
+            await self.app(scope, receive, send)
+            return
+
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            body.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+
+        headers = {}
+        for (name, value) in scope["headers"]:
+            if name.decode().lower() in FORWARDED_HEADERS:
+                headers[name.decode()] = value.decode()
+
+        (status_code, content, content_type) = await forward_request(
+            self.replica, scope["method"], scope["path"], scope["query_string"].decode(),
+            headers, b"".join(body))
+
+        await send({"type": "http.response.start", "status": status_code,
+                    "headers": [(b"content-type", content_type.encode()),
+                                (b"content-length", str(len(content)).encode())]})
+        await send({"type": "http.response.body", "body": content})
@@ -1,4 +1,5 @@
-"""Custom FastAPI Response handler for sending data from memory as a file
+"""Custom FastAPI Response handlers, for sending data from memory as a file
+and for JSON responses
 
 Copyright 2020 confrm.io
 
@@ -16,10 +17,23 @@ limitations under the License.
 """
 
 import hashlib
+import typing
 
-from fastapi.responses import Response
+from fastapi.responses import JSONResponse, Response
 from starlette.types import Receive, Scope, Send
 
+from confrm import profiling
+from confrm.shaping import throttle
+from confrm.metrics import BLOB_ACTIVE, BLOB_BYTES
+
+
+class ConfrmJSONResponse(JSONResponse):
+    """JSON response which reports its serialization time to the profiler"""
+
+    def render(self, content: typing.Any) -> bytes:
+        with profiling.timed("serialization"):
+            return super().render(content)
+
 
 class ConfrmFileResponse(Response):
     """Response class to enable files to be transfered from memory
@@ -29,10 +43,18 @@ class ConfrmFileResponse(Response):
     chunk_size = 4096
 
 
-    def __init__(self, data: bytes = None) -> None: #pylint: disable=W0231
-        """Init method for ConfrmFileResponse class """
+    def __init__(self, data: bytes = None, md5: str = None, #pylint: disable=W0231
+                 buckets: list = None) -> None:
+        """Init method for ConfrmFileResponse class
+
+        The data is not copied, or changed, so one bytes object can be sent by
+        many responses at once. The MD5 is computed if not given. Chunks are
+        sent no faster than the token buckets allow.
+        """
 
         self.data = data
+        self.md5 = md5
+        self.buckets = buckets or []
         self.media_type = "application/octet-stream"
         self.init_headers(None)
         self.background = None
@@ -46,24 +68,39 @@ class ConfrmFileResponse(Response):
         method to transfer data to TCP stack.
         """
 
+        BLOB_ACTIVE.inc()
+        try:
+            await self._send_data(send)
+        finally:
+            BLOB_ACTIVE.dec()
+
+    async def _send_data(self, send: Send) -> None:
+        """Sends the headers and body in chunks"""
+
         if self._headers_set is False:
             self._headers_set = True
             content_length = str(len(self.data))
             self.headers.setdefault("content-length", content_length)
-            m = hashlib.md5()
-            m.update(self.data)
-            self.headers.setdefault("x-MD5", m.hexdigest())
+            if self.md5 is None:
+                self.md5 = hashlib.md5(self.data).hexdigest()
+            self.headers.setdefault("x-MD5", self.md5)
             await send({
                     "type": "http.response.start",
                     "status": 200,
                     "headers": self.raw_headers,
                 })
 
+        # Chunks are sliced from a view, the remaining data is never copied
+        view = memoryview(self.data)
+        offset = 0
         more_body = True
         while more_body:
-            chunk = self.data[0:self.chunk_size]
-            self.data = self.data[self.chunk_size:]
+            chunk = bytes(view[offset:offset + self.chunk_size])
+            offset += self.chunk_size
             more_body = len(chunk) == self.chunk_size
+            if self.buckets:
+                await throttle(self.buckets, len(chunk))
+            BLOB_BYTES.inc(amount=len(chunk))
             await send(
                 {
                     "type": "http.response.body",
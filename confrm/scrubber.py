@@ -0,0 +1,221 @@
+"""Background verification of stored blobs against their hashes
+
+Copyright 2020 confrm.io
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Blobs are hashed when they are stored, downloads send them without hashing
+them again. The scrubber instead reads every blob in the background, limited
+to a number of bytes per second so downloads are not starved of disk, and
+compares its SHA256 with the hash of the package version. A blob which does
+not match, or is missing, is moved to the quarantine directory and its
+version marked quarantined, which stops it being sent to nodes.
+
+Results are cached by the inode, modification time and size of the file, so
+a pass only reads blobs which changed since they were verified, or were
+verified longer than max_age ago. The cache is kept in the data directory so
+it survives a restart.
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import time
+
+from confrm.metrics import BLOB_QUARANTINED
+
+logger = logging.getLogger('confrm')
+
+CHUNK_SIZE = 64 * 1024
+
+
+class BlobScrubber:  # pylint: disable=R0902
+    """Verifies blobs and quarantines corrupt ones
+
+    Attributes:
+        interval (float): Seconds between passes over all blobs
+        rate (int): Bytes read per second at most, 0 for no limit
+        max_age (float): Seconds an unchanged file is trusted after it was
+                         verified
+    """
+
+    def __init__(self):
+        self.table = None
+        self.blob_dir = ""
+        self.quarantine_dir = ""
+        self.cache_path = ""
+        self.interval = 3600.0
+        self.rate = 8 * 1024 * 1024
+        self.max_age = 7 * 86400.0
+        self.status = {}
+        self._cache = {}
+        self._lock = None
+
+    def configure(self, table, data_dir: str, config: dict):
+        """Sets the package_versions table and settings from the [scrub]
+        config, loads the cached results"""
+
+        self.table = table
+        self.blob_dir = os.path.join(data_dir, "blob")
+        self.quarantine_dir = os.path.join(data_dir, "quarantine")
+        self.cache_path = os.path.join(data_dir, "scrub_cache.json")
+        self.interval = config.get("interval", 3600)
+        self.rate = config.get("rate", 8 * 1024 * 1024)
+        self.max_age = config.get("max_age", 7 * 86400)
+        self.status = {"last_run": None, "last_seconds": None, "last_verified": 0,
+                       "last_cached": 0, "verified_bytes": 0, "quarantined": 0, "errors": 0}
+        self._lock = asyncio.Lock()
+        try:
+            with open(self.cache_path) as ptr:
+                self._cache = json.load(ptr)
+        except FileNotFoundError:
+            self._cache = {}
+        except ValueError:
+            logger.warning("Scrub cache %s is invalid, all blobs will be verified",
+                           self.cache_path)
+            self._cache = {}
+
+    @staticmethod
+    def _key(stat):
+        return [stat.st_ino, stat.st_mtime_ns, stat.st_size]
+
+    def _is_cached(self, blob_id: str, now: float):
+        entry = self._cache.get(blob_id)
+        if entry is None or entry[3] + self.max_age < now:
+            return False
+        try:
+            stat = os.stat(os.path.join(self.blob_dir, blob_id))
+        except FileNotFoundError:
+            return False
+        return self._key(stat) == entry[:3]
+
+    def verify(self, version: dict):
+        """Hashes the blob of a version at no more than rate bytes per second,
+        blocks on I/O, returns (matches, bytes read)
+
+        Raises FileNotFoundError if the blob is missing.
+        """
+
+        path = os.path.join(self.blob_dir, version["blob_id"])
+        encoding = version.get("encoding", "base64")
+        digest = hashlib.sha256()
+        start = time.perf_counter()
+        read = 0
+        with open(path, "rb") as ptr:
+            stat = os.fstat(ptr.fileno())
+            # Base64 blobs hold no line breaks, so whole groups of 4 decode alone
+            for chunk in iter(lambda: ptr.read(CHUNK_SIZE), b""):
+                read += len(chunk)
+                digest.update(base64.b64decode(chunk) if encoding == "base64" else chunk)
+                if self.rate:
+                    delay = read / self.rate - (time.perf_counter() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+
+        matches = digest.hexdigest() == version["hash"]
+        if matches:
+            self._cache[version["blob_id"]] = self._key(stat) + [time.time()]
+        return (matches, read)
+
+    def quarantine(self, version: dict, reason: str):
+        """Moves the blob of a version out of the blob directory and marks the
+        version quarantined"""
+
+        self._cache.pop(version["blob_id"], None)
+        if not os.path.isdir(self.quarantine_dir):
+            os.makedirs(self.quarantine_dir)
+        try:
+            os.replace(os.path.join(self.blob_dir, version["blob_id"]),
+                       os.path.join(self.quarantine_dir, version["blob_id"]))
+        except FileNotFoundError:
+            pass
+
+        # The version may have been deleted while its blob was read
+        if not self.table.contains(doc_id=version.doc_id):
+            return
+        self.table.update({"quarantined": {"time": round(time.time()), "reason": reason}},
+                          doc_ids=[version.doc_id])
+        self.status["quarantined"] += 1
+        BLOB_QUARANTINED.inc()
+        logger.error("Blob %s of %s %d.%d.%d quarantined, %s", version["blob_id"],
+                     version["name"], version["major"], version["minor"],
+                     version["revision"], reason)
+
+    def _save(self, blob_ids: set):
+        # Entries of versions which no longer exist are dropped
+        self._cache = {blob_id: entry for (blob_id, entry) in self._cache.items()
+                       if blob_id in blob_ids}
+        with open(self.cache_path + ".tmp", "w") as ptr:
+            json.dump(self._cache, ptr)
+        os.replace(self.cache_path + ".tmp", self.cache_path)
+
+    async def scrub(self):
+        """Verifies the blobs not verified since they last changed, returns
+        the status"""
+
+        loop = asyncio.get_event_loop()
+        async with self._lock:
+            start = time.perf_counter()
+            now = time.time()
+            verified = 0
+            cached = 0
+            doc_ids = [doc.doc_id for doc in self.table.all() if "quarantined" not in doc]
+            for doc_id in doc_ids:
+                # Read again, downloads rewrite base64 blobs as raw while a pass runs
+                version = self.table.get(doc_id=doc_id)
+                if version is None or "quarantined" in version:
+                    continue
+                if self._is_cached(version["blob_id"], now):
+                    cached += 1
+                    continue
+                try:
+                    (matches, read) = await loop.run_in_executor(None, self.verify, version)
+                except FileNotFoundError:
+                    self.quarantine(version, "blob is missing")
+                    continue
+                except (OSError, ValueError) as err:
+                    logger.warning("Could not verify blob %s: %s", version["blob_id"], err)
+                    self.status["errors"] += 1
+                    continue
+                verified += 1
+                self.status["verified_bytes"] += read
+                if not matches:
+                    # The blob may have been rewritten while it was read
+                    current = self.table.get(doc_id=doc_id)
+                    if current is not None and \
+                            current.get("encoding", "base64") != version.get("encoding", "base64"):
+                        continue
+                    self.quarantine(version, "hash does not match")
+
+            await loop.run_in_executor(
+                None, self._save, {doc["blob_id"] for doc in self.table.all()})
+            self.status.update({
+                "last_run": round(now),
+                "last_seconds": round(time.perf_counter() - start, 3),
+                "last_verified": verified,
+                "last_cached": cached
+            })
+            return dict(self.status)
+
+    async def run(self):
+        """Scrubs every interval seconds, runs forever"""
+
+        while True:
+            try:
+                await self.scrub()
+            except Exception:  # pylint: disable=W0703
+                logger.exception("Blob scrub failed")
+            await asyncio.sleep(self.interval)
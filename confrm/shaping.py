@@ -0,0 +1,204 @@
+"""Bandwidth limits for blob downloads
+
+Copyright 2020 confrm.io
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Limits are token buckets in bytes per second, shared by all downloads they
+apply to: one global bucket, one per package, one per client subnet (the
+most specific subnet containing the client) and one for each download. A
+chunk takes its size from every bucket applying to the download, a bucket
+may go into debt, and the download sleeps once for as long as the most
+indebted bucket needs to refill. Downloads only sleep when they are over a
+limit, and for exactly as long as needed.
+
+Limits are read from the [shaping] config and can be changed while the server
+runs. Downloads in progress follow changes to the global limit and to the
+package and subnet limits they started under, new limits apply to new
+downloads.
+"""
+
+import asyncio
+import ipaddress
+import time
+
+from confrm.metrics import REGISTRY
+
+THROTTLED_SECONDS = REGISTRY.counter(
+    "confrm_blob_throttled_seconds_total",
+    "Time package binary downloads waited for bandwidth")
+
+DEFAULT_BURST = 64 * 1024
+
+
+class TokenBucket:
+    """Bytes (or requests) per second limit allowing bursts of up to burst
+
+    Attributes:
+        rate (float): Bytes per second, 0 for no limit
+        burst (int): Bytes which can be sent at once after being idle
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "last")
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def reserve(self, size: int):
+        """Takes size bytes, returns the seconds to wait before sending them"""
+
+        if not self.rate:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= size
+        return max(0.0, -self.tokens / self.rate)
+
+    def take(self, size: int = 1):
+        """Takes size bytes if there are enough, returns 0, otherwise takes
+        nothing and returns the seconds until there will be"""
+
+        if not self.rate:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= size:
+            self.tokens -= size
+            return 0.0
+        return (size - self.tokens) / self.rate
+
+
+def _check_rate(name: str, rate):
+    if isinstance(rate, bool) or not isinstance(rate, (int, float)) or rate < 0:
+        raise ValueError(f"{name} must be a number of bytes, not negative")
+    return rate
+
+
+class Shaper:
+    """Holds the limits and their buckets
+
+    Attributes:
+        rate (float): Bytes per second of all downloads
+        connection_rate (float): Bytes per second of each download
+        burst (int): Burst size of every bucket
+        packages (dict): Bytes per second of the downloads of each package
+        subnets (dict): Bytes per second of the downloads to each subnet
+    """
+
+    def __init__(self):
+        self.burst = DEFAULT_BURST
+        self.connection_rate = 0
+        self._global = TokenBucket(0, DEFAULT_BURST)
+        self._packages = {}
+        self._subnets = {}
+
+    def configure(self, config: dict):
+        """Sets the limits from the [shaping] config, raises ValueError if
+        they are invalid"""
+
+        self.burst = DEFAULT_BURST
+        self.connection_rate = 0
+        self._global = TokenBucket(0, DEFAULT_BURST)
+        self._packages = {}
+        self._subnets = {}
+        self.update(config)
+
+    def limits(self):
+        """Returns the limits, in the form taken by update"""
+        return {
+            "rate": self._global.rate,
+            "connection_rate": self.connection_rate,
+            "burst": self.burst,
+            "packages": {name: bucket.rate for (name, bucket) in self._packages.items()},
+            "subnets": {str(net): bucket.rate for (net, bucket) in self._subnets.items()}
+        }
+
+    def update(self, limits: dict):
+        """Changes the given limits, a package or subnet limit of 0 removes it
+
+        Nothing is changed if any of the limits are invalid, ValueError is
+        raised.
+        """
+
+        unknown = set(limits) - {"rate", "connection_rate", "burst", "packages", "subnets"}
+        if unknown:
+            raise ValueError(f"Unknown settings {', '.join(sorted(unknown))}")
+        burst = _check_rate("burst", limits.get("burst", self.burst))
+        rate = _check_rate("rate", limits.get("rate", self._global.rate))
+        connection_rate = _check_rate("connection_rate",
+                                      limits.get("connection_rate", self.connection_rate))
+        packages = {name: _check_rate(f"Limit of package {name}", value)
+                    for (name, value) in limits.get("packages", {}).items()}
+        subnets = {}
+        for (subnet, value) in limits.get("subnets", {}).items():
+            try:
+                subnets[ipaddress.ip_network(subnet, strict=False)] = \
+                    _check_rate(f"Limit of subnet {subnet}", value)
+            except ValueError as err:
+                raise ValueError(f"Invalid subnet {subnet}: {err}") from err
+        if not burst:
+            raise ValueError("burst must be greater than 0")
+
+        # Buckets are changed in place so downloads in progress follow them
+        self.burst = int(burst)
+        self.connection_rate = connection_rate
+        self._global.rate = rate
+        for (buckets, changes) in ((self._packages, packages), (self._subnets, subnets)):
+            for (key, value) in changes.items():
+                if key in buckets:
+                    buckets[key].rate = value
+                    if not value:
+                        del buckets[key]
+                elif value:
+                    buckets[key] = TokenBucket(value, self.burst)
+        for bucket in [self._global] + list(self._packages.values()) + \
+                list(self._subnets.values()):
+            bucket.burst = self.burst
+
+    def buckets(self, package: str, client: str):
+        """Returns the buckets limiting a new download
+
+        Attributes:
+            package (str): Package of the blob
+            client (str): Address of the client, which may not be an IP address
+        """
+
+        # Unlimited buckets cost nothing, the global one is kept in case it is limited later
+        buckets = [self._global, TokenBucket(self.connection_rate, self.burst)]
+        if package in self._packages:
+            buckets.append(self._packages[package])
+        if self._subnets:
+            try:
+                address = ipaddress.ip_address(client)
+            except ValueError:
+                address = None
+            matches = [net for net in self._subnets
+                       if address is not None and address.version == net.version and
+                       address in net]
+            if matches:
+                buckets.append(self._subnets[max(matches, key=lambda net: net.prefixlen)])
+        return buckets
+
+
+async def throttle(buckets: list, size: int):
+    """Takes size bytes from each bucket, waits until they can be sent"""
+
+    delay = max([bucket.reserve(size) for bucket in buckets], default=0.0)
+    if delay > 0:
+        THROTTLED_SECONDS.inc(amount=delay)
+        await asyncio.sleep(delay)
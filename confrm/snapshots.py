@@ -0,0 +1,209 @@
+"""Online point-in-time snapshots of the database and blobs
+
+Copyright 2020 confrm.io
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+A snapshot is a directory in data_dir/snapshots holding a copy of the
+database file, the blobs of the versions in that copy and a manifest listing
+them with their hashes. The database is captured by reading the file under
+the storage lock, the only time requests wait, and is written out after the
+lock is released. Blobs are never changed once written so they are hard
+linked rather than copied, which makes a snapshot cheap in time and space.
+
+If the data directory is on a filesystem with snapshots of its own (ZFS,
+btrfs, LVM) a command can be run as well, with writes held so
+the filesystem snapshot holds a whole database file. Its run time adds to
+the latency of requests writing at the time, so it is limited by a timeout.
+
+Restore a snapshot by stopping the server and copying confrm_db.json and
+the blob directory of the snapshot into data_dir.
+"""
+
+import asyncio
+import datetime
+import json
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger('confrm')
+
+DATABASE_NAME = "confrm_db.json"
+MANIFEST_NAME = "manifest.json"
+
+
+class SnapshotBusy(Exception):
+    """A snapshot is already being taken"""
+
+
+class Snapshots:  # pylint: disable=R0902
+    """Takes and prunes snapshots
+
+    Attributes:
+        directory (str): Directory snapshots are written to
+        keep (int): Number of snapshots kept, oldest are removed first
+        link_blobs (bool): Hard link blobs, copies them if false or if linking
+                           is not possible
+        command (str): Storage level snapshot command, run with writes held
+        command_timeout (float): Seconds the command may hold writes for
+        interval (float): Seconds between scheduled snapshots, 0 for none
+    """
+
+    def __init__(self):
+        self.storage = None
+        self.blob_dir = ""
+        self.directory = ""
+        self.keep = 7
+        self.link_blobs = True
+        self.command = ""
+        self.command_timeout = 5.0
+        self.interval = 0
+        self._lock = threading.Lock()
+
+    def configure(self, storage, data_dir: str, config: dict):
+        """Sets the storage and settings from the [snapshot] config"""
+
+        self.storage = storage
+        self.blob_dir = os.path.join(data_dir, "blob")
+        self.directory = config.get("directory", os.path.join(data_dir, "snapshots"))
+        self.keep = config.get("keep", 7)
+        self.link_blobs = config.get("link_blobs", True)
+        self.command = config.get("command", "")
+        self.command_timeout = config.get("command_timeout", 5.0)
+        self.interval = config.get("interval", 0)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def _capture(self):
+        """Returns (text, version, seconds writes were held)"""
+
+        times = []
+
+        def hold():
+            times.append(time.perf_counter())
+            if self.command:
+                try:
+                    subprocess.run(shlex.split(self.command), check=True,
+                                   timeout=self.command_timeout)
+                except (OSError, subprocess.SubprocessError) as err:
+                    logger.error("Snapshot command failed: %s", err)
+
+        (text, version) = self.storage.capture(hold)
+        return (text, version, time.perf_counter() - times[0])
+
+    def _add_blob(self, path: str, target: str):
+        if self.link_blobs:
+            try:
+                os.link(path, target)
+                return
+            except FileNotFoundError:
+                raise
+            except OSError:
+                # Such as the snapshot directory being on another filesystem
+                pass
+        shutil.copyfile(path, target)
+
+    def take(self):
+        """Takes a snapshot, blocks on I/O, returns its manifest
+
+        Raises SnapshotBusy if another snapshot is being taken.
+        """
+
+        if not self._lock.acquire(blocking=False):  # pylint: disable=R1732
+            raise SnapshotBusy()
+        try:
+            start = time.perf_counter()
+            (text, version, held) = self._capture()
+            name = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+            part = os.path.join(self.directory, name + ".part")
+            os.mkdir(part)
+            os.mkdir(os.path.join(part, "blob"))
+            with open(os.path.join(part, DATABASE_NAME), "w") as ptr:
+                ptr.write(text)
+
+            # Blobs of versions deleted since the capture may already be gone
+            blobs = []
+            missing = []
+            versions = json.loads(text or "{}").get("package_versions", {})
+            for doc in versions.values():
+                try:
+                    self._add_blob(os.path.join(self.blob_dir, doc["blob_id"]),
+                                   os.path.join(part, "blob", doc["blob_id"]))
+                except FileNotFoundError:
+                    missing.append(doc["blob_id"])
+                    continue
+                blobs.append({"blob_id": doc["blob_id"], "hash": doc["hash"],
+                              "encoding": doc.get("encoding", "base64"),
+                              "size": os.path.getsize(os.path.join(part, "blob",
+                                                                   doc["blob_id"]))})
+
+            manifest = {
+                "name": name,
+                "created": round(time.time()),
+                "version": version,
+                "writes_held_seconds": round(held, 6),
+                "seconds": round(time.perf_counter() - start, 6),
+                "blobs": blobs,
+                "missing_blobs": missing
+            }
+            with open(os.path.join(part, MANIFEST_NAME), "w") as ptr:
+                json.dump(manifest, ptr)
+            os.replace(part, os.path.join(self.directory, name))
+            self.prune()
+            logger.info("Snapshot %s taken, writes held for %.1f ms", name, held * 1000)
+            return manifest
+        finally:
+            self._lock.release()
+
+    def list(self):
+        """Returns the manifests of the snapshots, oldest first, without the
+        blob lists"""
+
+        manifests = []
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name, MANIFEST_NAME)
+            if name.endswith(".part") or not os.path.isfile(path):
+                continue
+            with open(path) as ptr:
+                manifest = json.load(ptr)
+            manifest["blob_count"] = len(manifest.pop("blobs"))
+            manifests.append(manifest)
+        return manifests
+
+    def prune(self):
+        """Removes the oldest snapshots beyond keep, and unfinished ones"""
+        names = sorted(os.listdir(self.directory))
+        finished = [name for name in names if not name.endswith(".part")]
+        stale = [name for name in names if name.endswith(".part")] + \
+            finished[:max(0, len(finished) - self.keep)]
+        for name in stale:
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+
+async def run_schedule(snapshots: Snapshots):
+    """Takes a snapshot every interval seconds, runs forever"""
+
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(snapshots.interval)
+        try:
+            await loop.run_in_executor(None, snapshots.take)
+        except SnapshotBusy:
+            pass
+        except Exception:  # pylint: disable=W0703
+            logger.exception("Scheduled snapshot failed")
@@ -0,0 +1,261 @@
+"""Serving of the dashboard static assets
+
+Copyright 2020 confrm.io
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Compressed variants of the assets (file.gz, file.br) are built ahead of time
+by running this module:
+
+    python -m confrm.static
+
+and are served in place of the original when the client accepts them. Every
+asset has a strong ETag derived from its content. References to assets in
+index.html carry the content hash (?v=...), those URLs never change content
+so are served as immutable, everything else is revalidated with the ETag.
+Small assets, such as the templates, are kept in memory.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import stat
+import sys
+
+import anyio
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import StaticFiles
+from starlette.types import Scope
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+DASHBOARD_DIR = os.path.join(os.path.dirname(__file__), "dashboard")
+
+# Preferred first
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+
+# Files smaller than this are kept in memory, compressed variants included
+MEMORY_LIMIT = 64 * 1024
+
+# Files which do not benefit from compression
+COMPRESSED_TYPES = (".gz", ".br", ".png", ".jpg", ".jpeg", ".gif", ".woff", ".woff2", ".ico")
+MIN_COMPRESS_SIZE = 1024
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+_STATIC_URL = re.compile(r'((?:src|href)=")/static/([^"?#]+)(")')
+
+
+def accepted_encoding(accept_encoding: str, available):
+    """Returns the preferred encoding in available accepted by the client, or
+    "identity"
+
+    Attributes:
+        accept_encoding (str): Accept-Encoding request header
+        available (iterable): Encodings the asset has
+    """
+
+    accepted = set()
+    for part in accept_encoding.split(","):
+        fields = part.strip().split(";")
+        name = fields[0].strip().lower()
+        quality = 1.0
+        for field in fields[1:]:
+            field = field.strip()
+            if field.startswith("q="):
+                try:
+                    quality = float(field[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(name)
+
+    for encoding in ENCODINGS:
+        if encoding in available and (encoding in accepted or "*" in accepted):
+            return encoding
+    return "identity"
+
+
+class _Asset:  # pylint: disable=R0903
+    """An asset and its encoded variants"""
+
+    __slots__ = ("key", "digest", "media_type", "paths", "bodies")
+
+    def __init__(self, key, digest, media_type):
+        self.key = key
+        self.digest = digest
+        self.media_type = media_type
+        self.paths = {}
+        self.bodies = {}
+
+    def etag(self, encoding: str):
+        """Strong ETag of the variant, each encoding is a different entity"""
+        if encoding == "identity":
+            return f'"{self.digest}"'
+        return f'"{self.digest}-{encoding}"'
+
+
+class DashboardFiles(StaticFiles):
+    """StaticFiles serving precompressed variants with strong ETags
+
+    Attributes:
+        directory (str): Directory to serve
+        transforms (dict): Path to callable(bytes) -> bytes applied to the
+                           content before serving, e.g. to version URLs
+    """
+
+    def __init__(self, directory: str = DASHBOARD_DIR, memory_limit: int = MEMORY_LIMIT):
+        super().__init__(directory=directory)
+        self.memory_limit = memory_limit
+        self.transforms = {"index.html": self.version_urls}
+        self._assets = {}
+
+    def version_urls(self, content: bytes):
+        """Appends the content hash to /static/ URLs in src and href attributes"""
+
+        def replace(match):
+            asset = self.load_asset(match.group(2))
+            if asset is None:
+                return match.group(0)
+            return f"{match.group(1)}/static/{match.group(2)}?v={asset.digest}{match.group(3)}"
+
+        return _STATIC_URL.sub(replace, content.decode()).encode()
+
+    def load_asset(self, path: str):
+        """Returns the asset at path, None if it is not a file, blocks on I/O"""
+
+        (full_path, stat_result) = self.lookup_path(path)
+        if stat_result is None or not stat.S_ISREG(stat_result.st_mode):
+            return None
+
+        # Cached until the file changes
+        key = (stat_result.st_mtime_ns, stat_result.st_size)
+        asset = self._assets.get(full_path)
+        if asset is not None and asset.key == key:
+            return asset
+
+        with open(full_path, "rb") as ptr:
+            content = ptr.read()
+        transform = self.transforms.get(path)
+        if transform is not None:
+            content = transform(content)
+
+        media_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+        asset = _Asset(key, hashlib.sha256(content).hexdigest()[:20], media_type)
+
+        in_memory = len(content) <= self.memory_limit or transform is not None
+        if in_memory:
+            asset.bodies["identity"] = content
+        else:
+            asset.paths["identity"] = full_path
+
+        for (encoding, suffix) in ENCODINGS.items():
+            variant = full_path + suffix
+            try:
+                variant_stat = os.stat(variant)
+            except OSError:
+                continue
+            # Variants older than the original are stale
+            if transform is not None or variant_stat.st_mtime_ns < stat_result.st_mtime_ns:
+                continue
+            if in_memory:
+                with open(variant, "rb") as ptr:
+                    asset.bodies[encoding] = ptr.read()
+            else:
+                asset.paths[encoding] = variant
+
+        # Small files are cheap to compress here if they were not built
+        if in_memory and "gzip" not in asset.bodies and len(content) >= MIN_COMPRESS_SIZE:
+            asset.bodies["gzip"] = gzip.compress(content, 9, mtime=0)
+
+        self._assets[full_path] = asset
+        return asset
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+
+        if scope["method"] not in ("GET", "HEAD"):
+            return await super().get_response(path, scope)
+
+        try:
+            asset = await anyio.to_thread.run_sync(self.load_asset, path)
+        except (OSError, ValueError):
+            asset = None
+        if asset is None:
+            return await super().get_response(path, scope)
+
+        request_headers = Headers(scope=scope)
+        available = list(asset.bodies) + list(asset.paths)
+        encoding = accepted_encoding(request_headers.get("accept-encoding", ""), available)
+
+        query = scope.get("query_string", b"").decode()
+        immutable = f"v={asset.digest}" in query.split("&")
+        headers = {
+            "etag": asset.etag(encoding),
+            "vary": "Accept-Encoding",
+            "cache-control": IMMUTABLE if immutable else REVALIDATE
+        }
+        if encoding != "identity":
+            headers["content-encoding"] = encoding
+
+        if_none_match = request_headers.get("if-none-match", "")
+        if headers["etag"] in [tag.strip() for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+
+        if encoding in asset.bodies:
+            return Response(asset.bodies[encoding], media_type=asset.media_type,
+                            headers=headers)
+        return FileResponse(asset.paths[encoding], media_type=asset.media_type,
+                            headers=headers)
+
+
+def compress_directory(directory: str = DASHBOARD_DIR):
+    """Writes .gz (and .br, if brotli is installed) variants of the files in
+    directory, only keeping variants smaller than the original
+
+    Returns the number of variants written.
+    """
+
+    written = 0
+    for (root, _, files) in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            if name.lower().endswith(COMPRESSED_TYPES) or \
+                    os.path.getsize(path) < MIN_COMPRESS_SIZE:
+                continue
+            with open(path, "rb") as ptr:
+                content = ptr.read()
+            variants = {".gz": gzip.compress(content, 9, mtime=0)}
+            if brotli is not None:
+                variants[".br"] = brotli.compress(content, quality=11)
+            for (suffix, data) in variants.items():
+                if len(data) >= len(content):
+                    continue
+                with open(path + suffix, "wb") as ptr:
+                    ptr.write(data)
+                written += 1
+    return written
+
+
+if __name__ == "__main__":
+    COUNT = compress_directory(sys.argv[1] if len(sys.argv) > 1 else DASHBOARD_DIR)
+    print(f"Wrote {COUNT} compressed files")
+    if brotli is None:
+        print("brotli is not installed, only gzip variants were written")
@@ -0,0 +1,412 @@
+"""TinyDB storage used by confrm
+
+Copyright 2020 confrm.io
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Besides the storage itself this module accounts for the database work done by
+each request: the number of table reads (queries), the rows those reads
+loaded and the number of writes. The counts are logged, can be returned in
+the X-Confrm-Queries response header and are used by the tests to enforce
+query budgets per endpoint, catching N+1 patterns.
+
+Writes to the replicated tables are also recorded in a change log, which
+replicas pull to follow the database incrementally.
+
+Several writes can be made as one with a transaction: the database is read
+once, the writes are applied in memory and flushed together when the
+transaction ends, or dropped if it raises.
+"""
+
+import collections
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from copy import deepcopy
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from tinydb import TinyDB
+from tinydb.storages import JSONStorage
+from tinydb.table import Table
+
+from confrm import profiling
+from confrm.metrics import STORAGE_LATENCY
+
+logger = logging.getLogger('confrm')
+
+# Account of the request currently being served, None outside of requests
+_ACCOUNT = contextvars.ContextVar("confrm_query_account", default=None)
+
+ACCOUNTING = {
+    "header": False,     # Add X-Confrm-Queries header to responses
+    "warn_queries": 50   # Log a warning if a request makes more queries than this
+}
+
+
+def configure_accounting(header: bool = False, warn_queries: int = 50):
+    """Sets the query accounting options
+
+    Attributes:
+        header (bool): If true responses carry the X-Confrm-Queries header
+        warn_queries (int): Requests making more queries are logged as warnings
+    """
+    ACCOUNTING["header"] = header
+    ACCOUNTING["warn_queries"] = warn_queries
+
+
+class QueryAccount:  # pylint: disable=R0903
+    """Database work done by a single request"""
+
+    __slots__ = ("queries", "rows", "writes")
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+        self.writes = 0
+
+    def __str__(self):
+        return f"queries={self.queries}; rows={self.rows}; writes={self.writes}"
+
+
+def parse_account(header: str):
+    """Parses an X-Confrm-Queries header value in to a dict"""
+    result = {}
+    for part in header.split(";"):
+        (name, value) = part.strip().split("=")
+        result[name] = int(value)
+    return result
+
+
+class ChangeLog:
+    """Bounded in-memory log of changes to the replicated tables
+
+    Each change is (seq, table, doc_id, doc) where doc is None for removed
+    documents. The instance id changes on every start, a replica with a cursor
+    from another instance, or older than the oldest kept change, has to start
+    from a full copy.
+
+    Attributes:
+        tables (tuple): Names of the tables to record changes of
+        size (int): Number of changes kept
+    """
+
+    def __init__(self, tables=("packages", "package_versions", "config", "canary"),
+                 size: int = 10000):
+        self.tables = tables
+        self.instance = uuid.uuid4().hex
+        self.seq = 0
+        self._entries = collections.deque(maxlen=size)
+
+    def record(self, table: str, doc_id: int, doc: dict):
+        """Appends a change"""
+        self.seq += 1
+        self._entries.append((self.seq, table, doc_id, doc))
+
+    def since(self, seq: int, limit: int = 1000):
+        """Returns up to limit changes after seq, None if some were dropped"""
+        if seq > self.seq:
+            return None
+        if seq < self.seq and (not self._entries or self._entries[0][0] > seq + 1):
+            return None
+        start = len(self._entries) - (self.seq - seq)
+        return [self._entries[ind] for ind in range(start, min(start + limit, len(self._entries)))]
+
+
+class ConfrmTable(Table):
+    """TinyDB table which accounts reads and writes to the current request
+
+    Writes to tables of the change log record the documents they return the
+    ids of, only those documents are copied.
+
+    Attributes:
+        change_log (ChangeLog): Records writes to its tables, if set
+    """
+
+    change_log = None
+    _written = None
+
+    def _read_table(self):
+        table = super()._read_table()
+        account = _ACCOUNT.get()
+        if account is not None:
+            account.queries += 1
+            account.rows += len(table)
+        return table
+
+    def _update_table(self, updater):
+        if self._written is None:
+            super()._update_table(updater)
+        else:
+            def keep_table(table):
+                updater(table)
+                self._written = table
+            super()._update_table(keep_table)
+
+        # Writes in a transaction are counted once, when it is flushed
+        account = _ACCOUNT.get()
+        if account is not None and not self._storage.in_transaction():
+            account.writes += 1
+
+    def _logged(self, write, *args, **kwargs):
+        change_log = self.change_log
+        if change_log is None or self.name not in change_log.tables or \
+                self._written is not None:
+            return write(*args, **kwargs)
+
+        self._written = {}
+        try:
+            result = write(*args, **kwargs)
+            table = self._written
+        finally:
+            self._written = None
+
+        # Removed documents are no longer in the table and are recorded as None
+        doc_ids = [result] if isinstance(result, int) else result
+        changes = [(doc_id, deepcopy(table.get(doc_id))) for doc_id in doc_ids]
+        if changes:
+            self._storage.after_commit(
+                lambda: [change_log.record(self.name, doc_id, doc) for (doc_id, doc) in changes])
+        return result
+
+    def insert(self, document):
+        return self._logged(super().insert, document)
+
+    def insert_multiple(self, documents):
+        return self._logged(super().insert_multiple, documents)
+
+    def update(self, fields, cond=None, doc_ids=None):
+        return self._logged(super().update, fields, cond=cond, doc_ids=doc_ids)
+
+    def update_multiple(self, updates):
+        return self._logged(super().update_multiple, updates)
+
+    def upsert(self, document, cond=None):
+        return self._logged(super().upsert, document, cond=cond)
+
+    def remove(self, cond=None, doc_ids=None):
+        return self._logged(super().remove, cond=cond, doc_ids=doc_ids)
+
+    def truncate(self):
+        def clear():
+            removed = []
+
+            def updater(table):
+                removed.extend(table)
+                table.clear()
+            self._update_table(updater)
+            self._next_id = None
+            return removed
+        self._logged(clear)
+
+
+class ConfrmDB(TinyDB):
+    """TinyDB using the accounting table class"""
+
+    table_class = ConfrmTable
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Context manager making the writes within it one write, see
+        ConfrmStorage.transaction
+
+        Query caches of the tables may hold results read within a transaction
+        which raised, they are cleared so the rolled back writes are not seen.
+        """
+
+        nested = self.storage.in_transaction()
+        try:
+            with self.storage.transaction():
+                yield
+        except BaseException:
+            if not nested:
+                for table in self._tables.values():
+                    table.clear_cache()
+                    table._next_id = None  # pylint: disable=W0212
+            raise
+
+
+class QueryAccountingMiddleware:  # pylint: disable=R0903
+    """ASGI middleware accounting database work per request"""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        account = QueryAccount()
+        token = _ACCOUNT.set(account)
+        status_code = [500]
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                status_code[0] = message["status"]
+                if ACCOUNTING["header"]:
+                    message = dict(message)
+                    message["headers"] = list(message.get("headers", [])) + \
+                        [(b"x-confrm-queries", str(account).encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _ACCOUNT.reset(token)
+            if account.queries > ACCOUNTING["warn_queries"]:
+                logger.warning("%s %s made %d queries (%s), possible N+1 query pattern",
+                               scope["method"], scope["path"], account.queries, account)
+            elif logger.isEnabledFor(logging.DEBUG):
+                logger.debug("%s %s %d %s", scope["method"], scope["path"],
+                             status_code[0], account)
+
+
+class ConfrmStorage(JSONStorage):
+    """JSON file storage which records the time taken by reads and writes
+
+    File I/O and JSON (de)serialization are timed separately so request
+    profiles can tell them apart. File access is serialized by a lock so
+    snapshot() can be called from another thread while the server runs.
+
+    The generation counts writes, together with the instance id it identifies
+    the state of the database and is used to build ETags.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+        self.instance = uuid.uuid4().hex[:8]
+        self.generation = 0
+        self._pending = None
+        self._pending_thread = None
+        self._callbacks = []
+
+    def in_transaction(self):
+        """True if the calling thread is in a transaction"""
+        return self._pending is not None and self._pending_thread == threading.get_ident()
+
+    def after_commit(self, callback):
+        """Calls callback once the current transaction is flushed, dropped if
+        it is rolled back, or straight away outside of a transaction"""
+        if self.in_transaction():
+            self._callbacks.append(callback)
+        else:
+            callback()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Applies the writes made within it in memory and flushes them in one
+        write at the end, nothing is written if it raises
+
+        Reads within the transaction see its writes, other threads see the
+        database as it was. The block must not await anything which can
+        suspend, other requests would write outside of the transaction.
+        Nested transactions join the outer one.
+        """
+
+        if self.in_transaction():
+            yield
+            return
+
+        if self._pending is not None:
+            raise RuntimeError("Transaction already running in another thread")
+        self._pending = self.read() or {}
+        self._pending_thread = threading.get_ident()
+        try:
+            yield
+            data = self._pending
+            callbacks = self._callbacks
+        finally:
+            self._pending = None
+            self._pending_thread = None
+            self._callbacks = []
+
+        self.write(data)
+        account = _ACCOUNT.get()
+        if account is not None:
+            account.writes += 1
+        for callback in callbacks:
+            callback()
+
+    def version(self):
+        """Returns a string which changes whenever the database is written"""
+        return f"{self.instance}-{self.generation}"
+
+    def _read_text(self):
+        with self.lock:
+            self._handle.seek(0, os.SEEK_END)
+            if not self._handle.tell():
+                return None
+            self._handle.seek(0)
+            return self._handle.read()
+
+    def snapshot(self):
+        """Returns a consistent copy of the whole database, safe to call from
+        any thread, only the file read holds the lock"""
+        text = self._read_text()
+        if text is None:
+            return {}
+        return json.loads(text)
+
+    def capture(self, hold=None):
+        """Returns (text, version) of the database at one point in time, the
+        serialized file as it is, safe to call from any thread. hold, if given,
+        is called first with writes held"""
+        with self.lock:
+            if hold is not None:
+                hold()
+            self._handle.seek(0)
+            return (self._handle.read(), self.version())
+
+    def read(self):
+        if self.in_transaction():
+            return self._pending
+        start = time.perf_counter()
+        try:
+            text = self._read_text()
+            if text is None:
+                return None
+            loaded = time.perf_counter()
+            profiling.add_time("storage", loaded - start)
+            data = json.loads(text)
+            profiling.add_time("serialization", time.perf_counter() - loaded)
+            return data
+        finally:
+            STORAGE_LATENCY.observe("read", value=time.perf_counter() - start)
+
+    def write(self, data):
+        if self.in_transaction():
+            self._pending = data
+            return
+        start = time.perf_counter()
+        try:
+            serialized = json.dumps(data, **self.kwargs)
+            dumped = time.perf_counter()
+            profiling.add_time("serialization", dumped - start)
+            with self.lock:
+                self._handle.seek(0)
+                self._handle.write(serialized)
+                self._handle.flush()
+                os.fsync(self._handle.fileno())
+                self._handle.truncate()
+                self.generation += 1
+            profiling.add_time("storage", time.perf_counter() - dumped)
+        finally:
+            STORAGE_LATENCY.observe("write", value=time.perf_counter() - start)
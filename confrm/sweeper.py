@@ -0,0 +1,145 @@
+"""Background removal of blobs no longer referenced by a package version
+
+Copyright 2020 confrm.io
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Deleting a package version only removes it from the database, the blob is
+left in place. The sweeper periodically compares the blob directory with
+the blob_id of every package version and removes files no version refers
+to, once they have been unreferenced for the grace period. This also cleans
+up after crashes: blobs of versions deleted before their file was removed,
+blobs written by uploads which failed before the version was stored and
+temporary files of interrupted writes.
+
+A file is only removed once both its modification time and the time the
+sweeper first found it unreferenced are older than the grace period, so a
+blob being written for a version about to be stored, or one still being sent
+to a node after its version was deleted, is left alone. When the server
+restarts the grace period starts again.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from confrm.metrics import BLOB_RECLAIMED_BYTES
+
+logger = logging.getLogger('confrm')
+
+
+class BlobSweeper:
+    """Finds and removes unreferenced blobs
+
+    Attributes:
+        blob_dir (str): Directory of the blobs
+        grace (float): Seconds a file must be unreferenced before removal
+        interval (float): Seconds between sweeps
+    """
+
+    def __init__(self):
+        self.storage = None
+        self.blob_dir = ""
+        self.grace = 3600.0
+        self.interval = 600.0
+        self.status = {}
+        self._unreferenced = {}
+        self._lock = threading.Lock()
+
+    def configure(self, storage, blob_dir: str, config: dict):
+        """Sets the storage and settings from the [blob_gc] config"""
+
+        self.storage = storage
+        self.blob_dir = blob_dir
+        self.grace = config.get("grace", 3600)
+        self.interval = config.get("interval", 600)
+        self._unreferenced = {}
+        self.status = {"last_run": None, "unreferenced": 0, "unreferenced_bytes": 0,
+                       "reclaimed_files": 0, "reclaimed_bytes": 0,
+                       "last_reclaimed_files": 0, "last_reclaimed_bytes": 0, "errors": 0}
+
+    def release(self, blob_id: str):
+        """Notes a blob is no longer used, starting its grace period now"""
+        self._unreferenced.setdefault(blob_id, time.time())
+
+    def sweep(self, grace: float = None):
+        """Removes unreferenced files past the grace period, blocks on I/O,
+        returns the status
+
+        Attributes:
+            grace (float): Overrides the configured grace period
+        """
+
+        grace = self.grace if grace is None else grace
+        with self._lock:
+            now = time.time()
+            tables = self.storage.snapshot()
+            referenced = {doc["blob_id"] for doc in
+                          tables.get("package_versions", {}).values()}
+
+            unreferenced = {}
+            reclaimed_files = 0
+            reclaimed_bytes = 0
+            pending_bytes = 0
+            for entry in os.scandir(self.blob_dir):
+                if entry.name in referenced or not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                since = max(self._unreferenced.get(entry.name, now), stat.st_mtime)
+                if since + grace > now:
+                    unreferenced[entry.name] = self._unreferenced.get(entry.name, now)
+                    pending_bytes += stat.st_size
+                    continue
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+                except OSError as err:
+                    logger.warning("Could not remove blob %s: %s", entry.name, err)
+                    self.status["errors"] += 1
+                    unreferenced[entry.name] = self._unreferenced.get(entry.name, now)
+                    continue
+                reclaimed_files += 1
+                reclaimed_bytes += stat.st_size
+
+            self._unreferenced = unreferenced
+            BLOB_RECLAIMED_BYTES.inc(amount=reclaimed_bytes)
+            self.status.update({
+                "last_run": round(now),
+                "unreferenced": len(unreferenced),
+                "unreferenced_bytes": pending_bytes,
+                "reclaimed_files": self.status["reclaimed_files"] + reclaimed_files,
+                "reclaimed_bytes": self.status["reclaimed_bytes"] + reclaimed_bytes,
+                "last_reclaimed_files": reclaimed_files,
+                "last_reclaimed_bytes": reclaimed_bytes
+            })
+            if reclaimed_files:
+                logger.info("Removed %d unreferenced blobs, %d bytes", reclaimed_files,
+                            reclaimed_bytes)
+            return dict(self.status)
+
+    async def run(self):
+        """Sweeps every interval seconds, runs forever"""
+
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.sweep)
+            except Exception:  # pylint: disable=W0703
+                logger.exception("Blob sweep failed")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,456 @@
+"""Streaming export and import of packages, versions, blobs and configs
+
+Copyright 2020 confrm.io
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+An export is a tar archive with the raw binary of each version, named by its
+SHA256 (blobs/<sha256>), followed by metadata.ndjson, one line per document
+of the exported tables. Blobs come first so a version can be added as soon
+as the metadata is read, and the metadata is taken when the export starts so
+blobs deleted while it runs are left out of it.
+
+Archives are written and read a block at a time. Imported blobs are staged in
+data_dir/import under their hash, so an interrupted import can be run again
+and only the missing blobs sent: /import/hashes/ lists the blobs the server
+has and the exporter leaves those out.
+
+Copy a server, or back it up and restore it, with:
+
+    python -m confrm.transfer copy http://source:8000 http://target:8000 --token TOKEN
+    python -m confrm.transfer export http://source:8000 backup.tar --token TOKEN
+    python -m confrm.transfer import backup.tar http://target:8000 --token TOKEN
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import uuid
+
+import requests
+
+# Tables exported, documents are matched to existing ones on import by these
+# fields and skipped if one matches
+TABLE_KEYS = {
+    "packages": ("name",),
+    "package_versions": ("name", "major", "minor", "revision"),
+    "config": ("type", "id", "key"),
+    "canary": ("package",),
+}
+
+FORMAT = "confrm-export"
+FORMAT_VERSION = 1
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+CHUNK_SIZE = 64 * 1024
+METADATA_NAME = "metadata.ndjson"
+BLOB_PREFIX = "blobs/"
+
+
+def _member(name: str, size: int, mtime: int):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = mtime
+    info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT)
+
+
+def _padding(size: int):
+    return b"\0" * (-size % BLOCK_SIZE)
+
+
+def _blob_size(path: str, encoding: str):
+    size = os.path.getsize(path)
+    if encoding != "base64":
+        return size
+    with open(path, "rb") as ptr:
+        ptr.seek(max(0, size - 2))
+        padding = ptr.read().count(b"=")
+    return size // 4 * 3 - padding
+
+
+def _read_blob(path: str, encoding: str):
+    # Base64 blobs hold no line breaks, so whole groups of 4 decode alone
+    with open(path, "rb") as ptr:
+        for chunk in iter(lambda: ptr.read(CHUNK_SIZE), b""):
+            yield base64.b64decode(chunk) if encoding == "base64" else chunk
+
+
+def export_archive(tables: dict, blob_dir: str, have=()):
+    """Yields the export archive of a snapshot of the database
+
+    Attributes:
+        tables (dict): Database contents, as returned by ConfrmStorage.snapshot
+        blob_dir (str): Directory of the blobs
+        have (iterable): SHA256 of blobs to leave out, the target has them
+    """
+
+    have = set(have)
+    now = round(time.time())
+    missing = set()
+
+    sent = set()
+    for doc in tables.get("package_versions", {}).values():
+        if doc["hash"] in sent or doc["hash"] in have:
+            continue
+        path = os.path.join(blob_dir, doc["blob_id"])
+        encoding = doc.get("encoding", "base64")
+        try:
+            size = _blob_size(path, encoding)
+            chunks = _read_blob(path, encoding)
+            first = next(chunks, b"")
+        except FileNotFoundError:
+            # Deleted since the snapshot was taken
+            missing.add(doc["blob_id"])
+            continue
+        yield _member(BLOB_PREFIX + doc["hash"], size, doc.get("date", now))
+        yield first
+        for chunk in chunks:
+            yield chunk
+        yield _padding(size)
+        sent.add(doc["hash"])
+
+    # Bounded in memory, larger metadata goes to a temporary file
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as metadata:
+        metadata.write(json.dumps({"format": FORMAT, "version": FORMAT_VERSION,
+                                   "created": now}).encode() + b"\n")
+        for name in TABLE_KEYS:
+            for doc in tables.get(name, {}).values():
+                if name == "package_versions" and doc["blob_id"] in missing:
+                    continue
+                metadata.write(json.dumps({"table": name, "doc": doc}).encode() + b"\n")
+        size = metadata.tell()
+        metadata.seek(0)
+        yield _member(METADATA_NAME, size, now)
+        for chunk in iter(lambda: metadata.read(CHUNK_SIZE), b""):
+            yield chunk
+        yield _padding(size)
+
+    yield b"\0" * (2 * BLOCK_SIZE)
+
+
+class ArchiveError(ValueError):
+    """The archive is not a valid export"""
+
+
+class _Reader:
+    """Reads exact amounts from an async iterator of byte chunks"""
+
+    def __init__(self, chunks):
+        self._chunks = chunks.__aiter__()
+        self._buffer = bytearray()
+        self._ended = False
+
+    async def read(self, size: int):
+        """Returns up to size bytes, fewer only at the end of the stream"""
+        while len(self._buffer) < size and not self._ended:
+            try:
+                self._buffer += await self._chunks.__anext__()
+            except StopAsyncIteration:
+                self._ended = True
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    async def read_exact(self, size: int):
+        """Returns size bytes, raises ArchiveError if the stream ends first"""
+        data = await self.read(size)
+        if len(data) != size:
+            raise ArchiveError("Archive is truncated")
+        return data
+
+    async def pieces(self, size: int):
+        """Yields the next size bytes in pieces of at most CHUNK_SIZE"""
+        while size > 0:
+            data = await self.read_exact(min(size, CHUNK_SIZE))
+            size -= len(data)
+            yield data
+
+
+def _pax_fields(data: bytes):
+    fields = {}
+    while data:
+        (length, _) = data.split(b" ", 1)
+        record = data[:int(length)]
+        data = data[int(length):]
+        (key, value) = record.split(b" ", 1)[1].rstrip(b"\n").split(b"=", 1)
+        fields[key.decode()] = value.decode()
+    return fields
+
+
+async def read_archive(chunks):
+    """Yields (name, size, reader) for each file in a tar stream, the caller
+    must consume the size bytes with reader.pieces(size) before the next
+
+    Attributes:
+        chunks (async iterable): Bytes of the archive
+    """
+
+    reader = _Reader(chunks)
+    pax = {}
+    while True:
+        block = await reader.read(BLOCK_SIZE)
+        if len(block) < BLOCK_SIZE or block == b"\0" * BLOCK_SIZE:
+            return
+        try:
+            info = tarfile.TarInfo.frombuf(block, "utf-8", "surrogateescape")
+        except tarfile.TarError as err:
+            raise ArchiveError(f"Invalid archive header: {err}") from err
+
+        if info.type in (tarfile.XHDTYPE, tarfile.XGLTYPE):
+            data = await reader.read_exact(info.size + len(_padding(info.size)))
+            if info.type == tarfile.XHDTYPE:
+                pax = _pax_fields(data[:info.size])
+            continue
+
+        name = pax.get("path", info.name)
+        size = int(pax.get("size", info.size))
+        pax = {}
+        if info.type in (tarfile.REGTYPE, tarfile.AREGTYPE):
+            yield (name, size, reader)
+        else:
+            async for _ in reader.pieces(size):
+                pass
+        await reader.read_exact(len(_padding(size)))
+
+
+class Importer:
+    """Applies an archive to the database
+
+    Attributes:
+        database (TinyDB): Database to import into
+        blob_dir (str): Directory of the blobs
+        staging_dir (str): Directory blobs are received into, kept between
+                           imports so an interrupted import can resume
+    """
+
+    def __init__(self, database, blob_dir: str, staging_dir: str):
+        self.database = database
+        self.blob_dir = blob_dir
+        self.staging_dir = staging_dir
+        if not os.path.isdir(staging_dir):
+            os.mkdir(staging_dir)
+        self.result = {"blobs": 0, "imported": {name: 0 for name in TABLE_KEYS},
+                       "skipped": {name: 0 for name in TABLE_KEYS}, "missing_blobs": 0}
+        self.packages = []
+        self.versions = []
+
+    def hashes(self):
+        """SHA256 of the blobs the server has, stored or staged"""
+        hashes = {doc["hash"] for doc in self.database.table("package_versions").all()}
+        hashes.update(name for name in os.listdir(self.staging_dir) if "." not in name)
+        return hashes
+
+    async def receive_blob(self, name: str, size: int, reader):
+        """Stages a blob, verifying its content matches its name"""
+
+        expected = name[len(BLOB_PREFIX):]
+        digest = hashlib.sha256()
+        part = os.path.join(self.staging_dir, expected + ".part")
+        with open(part, "wb") as ptr:
+            async for data in reader.pieces(size):
+                digest.update(data)
+                ptr.write(data)
+        if digest.hexdigest() != expected:
+            os.remove(part)
+            raise ArchiveError(f"Blob {expected} does not match its hash")
+        os.replace(part, os.path.join(self.staging_dir, expected))
+        self.result["blobs"] += 1
+
+    def _place_blob(self, sha256: str, raw_blobs: dict):
+        """Returns a new blob id holding the binary with this hash, None if
+        the server does not have it
+
+        Attributes:
+            sha256 (str): Hash of the binary
+            raw_blobs (dict): Hash to blob id of the raw blobs already here
+        """
+
+        blob_id = uuid.uuid4().hex
+        staged = os.path.join(self.staging_dir, sha256)
+        if os.path.isfile(staged):
+            os.replace(staged, os.path.join(self.blob_dir, blob_id))
+            raw_blobs[sha256] = blob_id
+            return blob_id
+
+        # Each version has its own blob, copy that of a version already here
+        if sha256 in raw_blobs:
+            shutil.copyfile(os.path.join(self.blob_dir, raw_blobs[sha256]),
+                            os.path.join(self.blob_dir, blob_id))
+            return blob_id
+        return None
+
+    def _place_blobs(self, versions: list, raw_blobs: dict):
+        """Gives each version its blob, returns the versions which have one,
+        blocks on I/O"""
+
+        placed = []
+        for doc in versions:
+            blob_id = self._place_blob(doc["hash"], raw_blobs)
+            if blob_id is None:
+                self.result["missing_blobs"] += 1
+                self.result["skipped"]["package_versions"] += 1
+                continue
+            doc = dict(doc, blob_id=blob_id, encoding="raw")
+            if "md5" not in doc:
+                with open(os.path.join(self.blob_dir, blob_id), "rb") as ptr:
+                    doc["md5"] = hashlib.md5(ptr.read()).hexdigest()
+            placed.append(doc)
+        return placed
+
+    def _read_metadata(self, metadata, existing: dict):
+        """Returns the documents of each table not already present, blocks on
+        I/O"""
+
+        header = json.loads(metadata.readline() or b"{}")
+        if header.get("format") != FORMAT or header.get("version") != FORMAT_VERSION:
+            raise ArchiveError("Archive is not a confrm export")
+
+        docs = {name: [] for name in TABLE_KEYS}
+        for line in metadata:
+            entry = json.loads(line)
+            name = entry.get("table")
+            if name not in TABLE_KEYS:
+                continue
+            key = tuple(entry["doc"].get(field) for field in TABLE_KEYS[name])
+            if key in existing[name]:
+                self.result["skipped"][name] += 1
+                continue
+            existing[name].add(key)
+            docs[name].append(entry["doc"])
+        return docs
+
+    async def receive_metadata(self, size: int, reader):
+        """Adds the documents of the archive which are not already present"""
+
+        loop = asyncio.get_event_loop()
+
+        # Spooled so a large metadata file is not held in memory
+        with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as metadata:
+            async for data in reader.pieces(size):
+                metadata.write(data)
+            metadata.seek(0)
+
+            existing = {name: {tuple(doc.get(field) for field in fields)
+                               for doc in self.database.table(name).all()}
+                        for (name, fields) in TABLE_KEYS.items()}
+            docs = await loop.run_in_executor(None, self._read_metadata, metadata, existing)
+
+        # Blobs are moved and hashed in the executor, the database is only
+        # used from the event loop
+        raw_blobs = {doc["hash"]: doc["blob_id"]
+                     for doc in self.database.table("package_versions").all()
+                     if doc.get("encoding", "base64") == "raw"}
+        docs["package_versions"] = await loop.run_in_executor(
+            None, self._place_blobs, docs["package_versions"], raw_blobs)
+
+        with self.database.transaction():
+            for (name, table_docs) in docs.items():
+                if table_docs:
+                    self.database.table(name).insert_multiple(table_docs)
+                self.result["imported"][name] += len(table_docs)
+        self.packages.extend(docs["packages"])
+        self.versions.extend(docs["package_versions"])
+
+    async def run(self, chunks):
+        """Reads and applies an archive, returns the counts of what was done"""
+
+        seen_metadata = False
+        async for (name, size, reader) in read_archive(chunks):
+            if name.startswith(BLOB_PREFIX):
+                await self.receive_blob(name, size, reader)
+            elif name == METADATA_NAME:
+                await self.receive_metadata(size, reader)
+                seen_metadata = True
+            else:
+                async for _ in reader.pieces(size):
+                    pass
+        if not seen_metadata:
+            raise ArchiveError("Archive has no metadata, it may be truncated")
+        return self.result
+
+
+def _headers(token: str):
+    return {"X-Confrm-Admin-Token": token} if token else {}
+
+
+def _check(response):
+    if response.status_code >= 400:
+        try:
+            message = response.json().get("message", response.text)
+        except ValueError:
+            message = response.text
+        sys.exit(f"{response.request.method} {response.url} failed: {message}")
+    return response
+
+
+def _export_stream(source: str, token: str, have=()):
+    response = _check(requests.post(f"{source.rstrip('/')}/export/", json={"have": list(have)},
+                                    headers=_headers(token), stream=True, timeout=300))
+    return response.iter_content(CHUNK_SIZE)
+
+
+def _import_stream(target: str, token: str, chunks):
+    response = _check(requests.put(f"{target.rstrip('/')}/import/", data=chunks,
+                                   headers=_headers(token), timeout=300))
+    return response.json()
+
+
+def _target_hashes(target: str, token: str):
+    response = _check(requests.get(f"{target.rstrip('/')}/import/hashes/",
+                                   headers=_headers(token), timeout=300))
+    return response.json()["hashes"]
+
+
+def main():
+    """Command line interface, see the module documentation"""
+
+    parser = argparse.ArgumentParser(description="confrm export and import")
+    parser.add_argument("command", choices=["export", "import", "copy"])
+    parser.add_argument("source", help="Server URL, or archive file to import")
+    parser.add_argument("target", help="Server URL, or archive file to export to")
+    parser.add_argument("--token", default=os.environ.get("CONFRM_ADMIN_TOKEN", ""),
+                        help="Admin token, defaults to $CONFRM_ADMIN_TOKEN")
+    parser.add_argument("--source-token", default="",
+                        help="Admin token of the source for copy, if different")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        with open(args.target, "wb") as ptr:
+            for chunk in _export_stream(args.source, args.token):
+                ptr.write(chunk)
+        print(f"Exported {args.source} to {args.target}")
+        return
+
+    if args.command == "import":
+        with open(args.source, "rb") as ptr:
+            result = _import_stream(args.target, args.token,
+                                    iter(lambda: ptr.read(CHUNK_SIZE), b""))
+    else:
+        have = _target_hashes(args.target, args.token)
+        result = _import_stream(args.target, args.token,
+                                _export_stream(args.source, args.source_token or args.token,
+                                               have))
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
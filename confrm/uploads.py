@@ -0,0 +1,142 @@
+"""Resumable chunked uploads of package binaries
+
+Copyright 2020 confrm.io
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+An upload session holds the details of the package version being uploaded
+and a temporary file in data_dir/uploads. Chunks are appended to the file at
+the offset the client gives, which must be the number of bytes received so
+far, and hashed as they arrive so finalizing does not read the file again.
+Bytes of an interrupted chunk which did arrive are kept, the client asks for
+the session's offset and carries on from there.
+
+Sessions are held in memory, those not written to within the expiry time are
+removed along with their file, as are all sessions when the server restarts.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import uuid
+
+logger = logging.getLogger('confrm')
+
+
+class UploadSession:  # pylint: disable=R0902
+    """A package binary being uploaded
+
+    Attributes:
+        upload_id (str): Session id
+        details (dict): Package version and options given at creation
+        path (str): Temporary file
+        expiry (float): Seconds without a chunk before the session expires
+    """
+
+    def __init__(self, upload_id: str, details: dict, path: str, expiry: float):
+        self.upload_id = upload_id
+        self.details = details
+        self.path = path
+        self.expiry = expiry
+        self.offset = 0
+        self.sha256 = hashlib.sha256()
+        self.md5 = hashlib.md5()
+        self.busy = False
+        self.expires = time.time() + expiry
+
+    def write(self, data: bytes):
+        """Appends data to the file and hashes"""
+        with open(self.path, "ab") as ptr:
+            ptr.write(data)
+        self.sha256.update(data)
+        self.md5.update(data)
+        self.offset += len(data)
+        self.expires = time.time() + self.expiry
+
+    def status(self):
+        """Returns the state reported to clients"""
+        return {"upload_id": self.upload_id, "offset": self.offset,
+                "expires": round(self.expires)}
+
+
+class UploadStore:
+    """Open upload sessions
+
+    Attributes:
+        directory (str): Directory of the temporary files, emptied on start
+        expiry (float): Seconds without a chunk before a session expires
+    """
+
+    def __init__(self):
+        self.directory = ""
+        self.expiry = 3600.0
+        self.sessions = {}
+
+    def configure(self, directory: str, expiry: float = 3600.0):
+        """Sets the directory and removes files of sessions from earlier runs"""
+
+        self.directory = directory
+        self.expiry = expiry
+        self.sessions = {}
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+        # Only session files are removed, anything else was not put there by us
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                os.remove(path)
+
+    def create(self, details: dict):
+        """Starts a session and returns it"""
+        upload_id = uuid.uuid4().hex
+        path = os.path.join(self.directory, upload_id)
+        open(path, "wb").close()  # pylint: disable=R1732
+        session = UploadSession(upload_id, details, path, self.expiry)
+        self.sessions[upload_id] = session
+        return session
+
+    def get(self, upload_id: str):
+        """Returns the session, None if it does not exist or has expired"""
+        session = self.sessions.get(upload_id)
+        if session is not None and session.expires < time.time() and not session.busy:
+            self.remove(upload_id)
+            return None
+        return session
+
+    def remove(self, upload_id: str, keep_file: bool = False):
+        """Ends a session, deleting its file unless keep_file is set"""
+        session = self.sessions.pop(upload_id, None)
+        if session is not None and not keep_file:
+            try:
+                os.remove(session.path)
+            except FileNotFoundError:
+                pass
+
+    def expire(self, now: float = None):
+        """Removes expired sessions, returns the number removed"""
+        now = time.time() if now is None else now
+        expired = [session.upload_id for session in self.sessions.values()
+                   if session.expires < now and not session.busy]
+        for upload_id in expired:
+            logger.info("Upload %s expired", upload_id)
+            self.remove(upload_id)
+        return len(expired)
+
+
+async def run_expiry(store: UploadStore, interval: float = 60):
+    """Removes expired sessions every interval seconds, runs forever"""
+    while True:
+        await asyncio.sleep(interval)
+        store.expire()
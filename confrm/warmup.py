@@ -0,0 +1,65 @@
+"""Background warm-up of in-memory state after startup
+
+Copyright 2020 confrm.io
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Startup only does what is needed to serve requests, anything which has to
+scan the database (indexes, caches, presence) is registered here as a
+component and built in a worker thread once the server is up. The readiness
+endpoint reports the state of each component.
+"""
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger('confrm')
+
+
+class Warmup:
+    """Runs the registered warm-up components in order"""
+
+    def __init__(self):
+        self._components = []
+        self.status = {}
+
+    def add(self, name: str, func):
+        """Registers a component, func is called without arguments in a worker
+        thread and must be safe to run while requests are being served"""
+        self._components.append((name, func))
+        self.status[name] = {"state": "pending", "seconds": None}
+
+    def reset(self):
+        """Marks all components pending"""
+        for (name, _) in self._components:
+            self.status[name] = {"state": "pending", "seconds": None}
+
+    def is_ready(self):
+        """True when all components are ready"""
+        return all(entry["state"] == "ready" for entry in self.status.values())
+
+    async def run(self):
+        """Warms up all components, failures are logged and reported"""
+
+        loop = asyncio.get_event_loop()
+        for (name, func) in self._components:
+            self.status[name] = {"state": "running", "seconds": None}
+            start = time.perf_counter()
+            try:
+                await loop.run_in_executor(None, func)
+                state = "ready"
+            except Exception:  # pylint: disable=W0703
+                logger.exception("Warm-up of %s failed", name)
+                state = "failed"
+            self.status[name] = {"state": state, "seconds": time.perf_counter() - start}
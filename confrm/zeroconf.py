@@ -1,82 +1,170 @@
-import socket
-from threading import Lock
+"""Zeroconf (mDNS) adverts of the confrm server and its packages
 
-from zeroconf import IPVersion, ServiceInfo, Zeroconf
+Copyright 2020 confrm.io
 
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
 
-class ConfrmZeroconf:
+    https://www.apache.org/licenses/LICENSE-2.0
 
-    mutex = Lock()
-    services = []
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
 
-    def __init__(self):
+Registering a service with python-zeroconf waits around a second for the
+announcements to go out, so adverts are never registered from a request.
+Changes are queued with add_package / remove_package and applied by a worker
+task on the event loop, which registers everything queued since it last ran
+concurrently - at startup the server and all packages go out as one batch.
+"""
+
+import asyncio
+import logging
+import socket
+
+from zeroconf import IPVersion, ServiceInfo
+from zeroconf.asyncio import AsyncZeroconf
+
+logger = logging.getLogger('confrm')
+
+SERVER_TYPE = "_confrm._tcp.local."
+PACKAGE_TYPE = "_arduino._tcp.local."
 
-        self.mutex.acquire()
-        try:
-            self.zeroconf = Zeroconf(ip_version=IPVersion.V4Only)
-        finally:
-            self.mutex.release()
 
-    def close(self):
+def local_address():
+    """Returns the IPv4 address of the interface used for the default route"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            # No packets are sent, this only selects a route
+            sock.connect(("10.255.255.255", 1))
+            return sock.getsockname()[0]
+        except OSError:
+            return "127.0.0.1"
 
-        for service in self.services:
-            self.zeroconf.unregister_service(service["info"])
-        self.zeroconf.close()
 
-    def register_package(self, name: str, platform: str):
+class ConfrmZeroconf:
+    """Advertises the server and packages over mDNS
+
+    Attributes:
+        zeroconf_factory (callable): Returns the AsyncZeroconf instance to use
+    """
+
+    def __init__(self, zeroconf_factory=None):
+        self.zeroconf_factory = zeroconf_factory or \
+            (lambda: AsyncZeroconf(ip_version=IPVersion.V4Only))
+        self.zeroconf = None
+        self.services = {}
+        self.address = "127.0.0.1"
+        self.port = 80
+        self._pending = {}
+        self._wake = None
+        self._idle = None
+        self._task = None
+
+    def start(self, port: int, packages: list, address: str = ""):
+        """Starts advertising the server and packages, returns immediately
+
+        Attributes:
+            port (int): Port the server is reachable on
+            packages (list): Package dicts with name and platform
+            address (str): IPv4 address to advertise, detected if empty
+        """
+
+        self.port = port
+        self.address = address or local_address()
+        self.zeroconf = self.zeroconf_factory()
+        self._wake = asyncio.Event()
+        self._idle = asyncio.Event()
+
+        self._queue(self._server_info(), True)
+        for package in packages:
+            self.add_package(package["name"], package["platform"])
+        self._task = asyncio.ensure_future(self._run())
+
+    def _server_info(self):
+        name = f"confrm on {socket.gethostname()}"
+        return ServiceInfo(
+            SERVER_TYPE,
+            f"{name}.{SERVER_TYPE}",
+            addresses=[socket.inet_aton(self.address)],
+            port=self.port,
+            properties={"path": "/"},
+        )
 
+    def _package_info(self, name: str, platform: str):
         service_name = f"Confrm[{name}-{platform}]"
-        service_info = ServiceInfo(
-            "_" + service_name + "._arduino._tcp.local.",
-            service_name + "._arduino._tcp.local.",
-            addresses=[socket.inet_aton("127.0.0.1")],
-            port=8266,
+        return ServiceInfo(
+            PACKAGE_TYPE,
+            f"{service_name}.{PACKAGE_TYPE}",
+            addresses=[socket.inet_aton(self.address)],
+            port=self.port,
             properties={
                 "tcp_check": "no",
                 "ssh_upload": "no",
                 "board": platform,
-                "auth_upload": "no"
+                "auth_upload": "no",
+                "package": name
             },
-            server=service_name + "._arduino._tcp.local.",
         )
 
-        self.mutex.acquire()
-        try:
-
-            for service in self.services:
-                if service["name"] == service_name:
-                    #logging.error("Service already registered")
-                    # TODO: Raise error here
-                    return
-
-            self.services.append({
-                "name": service_name,
-                "info": service_info
-            })
-            self.zeroconf.register_service(service_info)
+    def _queue(self, info: ServiceInfo, register: bool):
+        # Only the last change to a service matters, so a package added and
+        # deleted before the worker runs is never advertised
+        self._pending[info.name] = (info, register)
+        self._idle.clear()
+        self._wake.set()
 
-        finally:
+    def add_package(self, name: str, platform: str):
+        """Queues the advert of a package, does nothing if not started"""
+        if self.zeroconf is not None:
+            self._queue(self._package_info(name, platform), True)
 
-            self.mutex.release()
+    def remove_package(self, name: str, platform: str):
+        """Queues the removal of a package advert, does nothing if not started"""
+        if self.zeroconf is not None:
+            self._queue(self._package_info(name, platform), False)
 
-    def unregister_package(self, name: str, platform: str):
-
-        service_name = f"Confrm[{name}-{platform}]"
-        service_ind = -1
-        for ind in range(0, len(self.services)):
-            if self.services[ind]["name"] == service_name:
-                service_ind = -1
-                break
-
-        if service_ind == -1:
-            #logging.error("Service not registered")
-            # TODO: Raise error here
-            return
-
-        self.mutex.acquire()
+    async def _apply(self, info: ServiceInfo, register: bool):
         try:
-            self.zeroconf.unregister_service(
-                self.services[service_ind]["info"])
-            del self.services[service_ind]
-        finally:
-            self.mutex.release()
+            if register and info.name not in self.services:
+                await (await self.zeroconf.async_register_service(
+                    info, allow_name_change=info.type == SERVER_TYPE))
+                self.services[info.name] = info
+            elif not register and info.name in self.services:
+                await (await self.zeroconf.async_unregister_service(
+                    self.services.pop(info.name)))
+        except Exception:  # pylint: disable=W0703
+            logger.exception("Failed to update zeroconf advert %s", info.name)
+
+    async def _run(self):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            batch = list(self._pending.values())
+            self._pending = {}
+            await asyncio.gather(*[self._apply(info, register) for (info, register) in batch])
+            if not self._pending:
+                self._idle.set()
+
+    async def wait_idle(self):
+        """Waits until all queued changes have been applied"""
+        if self._idle is not None:
+            await self._idle.wait()
+
+    async def close(self):
+        """Stops the worker and removes all adverts"""
+
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.zeroconf is not None:
+            try:
+                await self.zeroconf.async_unregister_all_services()
+            finally:
+                await self.zeroconf.async_close()
+            self.zeroconf = None
+        self.services = {}
+        self._pending = {}
@@ -0,0 +1,211 @@
+"""
+Micro-benchmarks for the data helpers in confrm.py
+
+Each helper is timed against tables of increasing size and the scaling
+exponent is fitted from the largest sizes (time ~ rows ** exponent). A helper
+whose exponent exceeds its allowed maximum fails the test, so accidental
+quadratic behaviour is caught rather than just getting slower.
+
+The suite is not collected by a plain `pytest` run, run it explicitly:
+
+    pytest extras/bench/bench_helpers.py
+
+Environment variables:
+
+    CONFRM_BENCH_SIZES   Comma separated table sizes, default 10,...,100000
+    CONFRM_BENCH_OUTPUT  Write the measured scaling curves to this JSON file
+
+Copyright 2020 confrm.io
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import math
+import os
+import timeit
+
+import pytest
+
+from tinydb import TinyDB
+from tinydb.storages import MemoryStorage
+
+import confrm.confrm as server
+
+SIZES = [int(size) for size in
+         os.environ.get("CONFRM_BENCH_SIZES", "10,100,1000,10000,100000").split(",")]
+
+# Exponents are fitted over sizes at or above this, below it fixed per call
+# overheads dominate and flatten the curve
+FIT_MIN_SIZE = 1000
+
+# Allowed scaling exponents, linear (or n log n) helpers get some headroom
+# for measurement noise
+MAX_EXPONENT = 1.35
+
+CURVES = {}
+
+
+def fresh_db():
+    """Installs an empty in-memory database as the server DB"""
+    server.DB = TinyDB(storage=MemoryStorage)
+    return server.DB
+
+
+def add_versions(rows: int, name: str = "package_a"):
+    """Adds a package with the given number of versions"""
+    server.DB.table("packages").insert({
+        "name": name,
+        "title": name,
+        "description": "",
+        "platform": "esp32",
+        "current_version": "0.0.0"
+    })
+    server.DB.table("package_versions").insert_multiple({
+        "name": name,
+        "major": ind // 10000,
+        "minor": ind // 100 % 100,
+        "revision": ind % 100,
+        "date": 1600000000 + ind,
+        "hash": "",
+        "blob_id": f"blob_{ind}"
+    } for ind in range(rows))
+    return server.DB.table("packages").all()[0]
+
+
+def add_canaries(rows: int):
+    """Adds canary entries for the given number of packages / nodes"""
+    server.DB.table("canary").insert_multiple({
+        "package": f"package_{ind}",
+        "version": "1.0.0",
+        "node_id": f"node_{ind}",
+        "force": True
+    } for ind in range(rows))
+
+
+def make_configs(rows: int):
+    """Returns a list of configs with a mix of types, keys and ids"""
+    types = ["node", "package", "global"]
+    return [{
+        "type": types[ind % 3],
+        "id": f"id_{(ind * 7919) % rows}",
+        "key": f"key_{(ind * 104729) % 97}",
+        "value": "value"
+    } for ind in range(rows)]
+
+
+def setup_get_package_versions(rows):
+    """Returns a callable timing get_package_versions with a table of the given size"""
+    fresh_db()
+    package = add_versions(rows)
+    return lambda: server.get_package_versions(package["name"], package)
+
+
+def setup_format_package_info(rows):
+    """Returns a callable timing format_package_info with a table of the given size"""
+    fresh_db()
+    package = add_versions(rows)
+    return lambda: server.format_package_info(package)
+
+
+def setup_get_package_version_by_version_string(rows):
+    """Returns a callable timing get_package_version_by_version_string with a table of the given size"""
+    fresh_db()
+    add_versions(rows)
+    ind = rows - 1
+    version = f"{ind // 10000}.{ind // 100 % 100}.{ind % 100}"
+    return lambda: server.get_package_version_by_version_string("package_a", version)
+
+
+def setup_sort_configs(rows):
+    """Returns a callable timing sort_configs with a table of the given size"""
+    configs = make_configs(rows)
+    return lambda: server.sort_configs(configs)
+
+
+def setup_get_canary(rows):
+    """Returns a callable timing get_canary with a table of the given size"""
+    fresh_db()
+    add_canaries(rows)
+    return lambda: server.get_canary(package=f"package_{rows - 1}")
+
+
+def setup_set_canary(rows):
+    """Returns a callable timing set_canary with a table of the given size"""
+    fresh_db()
+    add_canaries(rows)
+    return lambda: server.set_canary(node_id=f"node_{rows - 1}",
+                                     package=f"package_{rows - 1}",
+                                     version="1.0.1")
+
+
+HELPERS = {
+    "get_package_versions": setup_get_package_versions,
+    "format_package_info": setup_format_package_info,
+    "get_package_version_by_version_string": setup_get_package_version_by_version_string,
+    "sort_configs": setup_sort_configs,
+    "get_canary": setup_get_canary,
+    "set_canary": setup_set_canary,
+}
+
+
+def time_call(func):
+    """Returns the best per call time in seconds"""
+    timer = timeit.Timer(func)
+    (number, _) = timer.autorange()
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+
+def fit_exponent(curve: list):
+    """Least squares slope of log(time) against log(rows)"""
+    points = [(math.log(rows), math.log(seconds))
+              for (rows, seconds) in curve if rows >= FIT_MIN_SIZE and seconds > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for (x, _) in points) / len(points)
+    mean_y = sum(y for (_, y) in points) / len(points)
+    numerator = sum((x - mean_x) * (y - mean_y) for (x, y) in points)
+    denominator = sum((x - mean_x) ** 2 for (x, _) in points)
+    return numerator / denominator
+
+
+@pytest.fixture(scope="module", autouse=True)
+def restore_db():
+    """Puts back the server DB and writes the curves once the module is done"""
+    original = server.DB
+    yield
+    server.DB = original
+    output = os.environ.get("CONFRM_BENCH_OUTPUT", "")
+    if output:
+        with open(output, "w") as ptr:
+            json.dump(CURVES, ptr, indent=2)
+
+
+@pytest.mark.parametrize("name", list(HELPERS.keys()))
+def test_helper_scaling(name):
+    """Times the helper over all table sizes and checks the scaling exponent"""
+
+    curve = []
+    for rows in SIZES:
+        func = HELPERS[name](rows)
+        curve.append((rows, time_call(func)))
+
+    exponent = fit_exponent(curve)
+    CURVES[name] = {"curve": curve, "exponent": exponent}
+
+    report = ", ".join(f"{rows}: {seconds * 1e6:.1f} us" for (rows, seconds) in curve)
+    print(f"\n{name}: {report} (exponent {exponent})")
+
+    if exponent is not None:
+        assert exponent <= MAX_EXPONENT, \
+            f"{name} scales as rows ** {exponent:.2f}, allowed {MAX_EXPONENT}: {report}"
@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+"""
+Fleet scale load test for the confrm server.
+
+Seeds a data_dir with a synthetic fleet (packages, versions, nodes and
+configs) and then drives a mix of device traffic through the ASGI app
+in-process, so no network stack or external server is needed. Reports
+throughput, p50/p99 latency per request type and peak RSS, and can compare
+the results against a stored baseline.
+
+Example usage:
+
+    # Record a baseline
+    python extras/bench/fleet.py --nodes 10000 --save-baseline baseline.json
+
+    # Compare against it, exits with status 1 on regression
+    python extras/bench/fleet.py --nodes 10000 --baseline baseline.json
+
+Copyright 2020 confrm.io
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+from urllib.parse import urlencode
+
+# Default traffic mix, relative weights of each request type
+DEFAULT_MIX = {
+    "heartbeat": 50,
+    "check": 35,
+    "config": 10,
+    "download": 5
+}
+
+
+def seed_data_dir(data_dir: str,  # pylint: disable=R0913,R0914
+                  nodes: int = 10000,
+                  packages: int = 10,
+                  versions: int = 100,
+                  configs_per_node: int = 1,
+                  blob_size: int = 64 * 1024,
+                  seed: int = 0):
+    """Writes a synthetic fleet in to data_dir, returns a description of it
+
+    The database file is written directly in the TinyDB JSON layout which is
+    much faster than going through the API. Every version has its blob, so
+    the server finds nothing missing, although the traffic mix only fetches
+    the active ones. Background scrubbing and zeroconf are turned off so they
+    do not add to the measured load.
+
+    Attributes:
+        data_dir (str): Directory to write confrm.toml, database and blobs to
+        nodes (int): Number of nodes to create
+        packages (int): Number of packages to create
+        versions (int): Number of versions per package
+        configs_per_node (int): Number of node configs per node
+        blob_size (int): Size in bytes of each package binary
+        seed (int): Random seed, the same seed gives the same fleet
+    """
+
+    rand = random.Random(seed)
+    blob_dir = os.path.join(data_dir, "blob")
+    os.makedirs(blob_dir, exist_ok=True)
+
+    tables = {"packages": {}, "package_versions": {}, "nodes": {}, "config": {}}
+    fleet = {"packages": [], "nodes": []}
+    now = round(time.time())
+
+    version_id = 1
+    for package_ind in range(packages):
+        name = f"package_{package_ind}"
+        active = f"1.0.{versions - 1}"
+        tables["packages"][str(package_ind + 1)] = {
+            "name": name,
+            "title": f"Package {package_ind}",
+            "description": "Synthetic package",
+            "platform": "esp32",
+            "current_version": active
+        }
+        for revision in range(versions):
+            blob_id = f"{name}_{revision}"
+            data = bytes(rand.getrandbits(8) for _ in range(min(blob_size, 256)))
+            data = (data * (blob_size // len(data) + 1))[:blob_size]
+            digest = hashlib.sha256(data).hexdigest()
+            with open(os.path.join(blob_dir, blob_id), "wb") as ptr:
+                ptr.write(base64.b64encode(data))
+            if f"1.0.{revision}" == active:
+                fleet["packages"].append({"name": name, "version": active, "blob": blob_id})
+            tables["package_versions"][str(version_id)] = {
+                "name": name,
+                "major": 1,
+                "minor": 0,
+                "revision": revision,
+                "date": now - (versions - revision) * 3600,
+                "hash": digest,
+                "blob_id": blob_id
+            }
+            version_id += 1
+
+    config_id = 1
+    for key_ind in range(5):
+        tables["config"][str(config_id)] = {
+            "type": "global", "id": "", "key": f"key_{key_ind}", "value": "global"}
+        config_id += 1
+
+    for node_ind in range(nodes):
+        node_id = "{:02x}:{:02x}:{:02x}:{:02x}:{:02x}:{:02x}".format(
+            *[(node_ind >> shift) & 0xff for shift in (40, 32, 24, 16, 8, 0)])
+        package = fleet["packages"][rand.randrange(packages)]
+        tables["nodes"][str(node_ind + 1)] = {
+            "node_id": node_id,
+            "title": node_id,
+            "package": package["name"],
+            "version": package["version"],
+            "description": "Synthetic node",
+            "platform": "esp32",
+            "last_updated": now - rand.randrange(86400),
+            "last_seen": now - rand.randrange(600),
+            "ip_address": "10.0.{}.{}".format(node_ind // 250 % 250, node_ind % 250 + 1)
+        }
+        for key_ind in range(configs_per_node):
+            tables["config"][str(config_id)] = {
+                "type": "node", "id": node_id, "key": f"key_{key_ind}", "value": node_id}
+            config_id += 1
+        fleet["nodes"].append({"node_id": node_id, "package": package["name"],
+                               "version": package["version"]})
+
+    with open(os.path.join(data_dir, "confrm_db.json"), "w") as ptr:
+        json.dump(tables, ptr)
+
+    config_file = os.path.join(data_dir, "confrm.toml")
+    with open(config_file, "w") as ptr:
+        ptr.write(f'[basic]\nport = 8000\nhost = "127.0.0.1"\n\n'
+                  f'[storage]\ndata_dir = "{data_dir}"\n\n'
+                  '[scrub]\nenabled = false\n\n'
+                  '[zeroconf]\nenabled = false\n')
+    fleet["config_file"] = config_file
+    return fleet
+
+
+class AsgiClient:
+    """Minimal in-process ASGI client, drives the app without a network stack"""
+
+    def __init__(self, app):
+        self.app = app
+        self._lifespan = None
+        self._to_app = None
+        self._from_app = None
+
+    async def _lifespan_message(self, message_type: str):
+        await self._to_app.put({"type": message_type})
+        if self._lifespan is None:
+            self._lifespan = asyncio.ensure_future(self.app(
+                {"type": "lifespan", "asgi": {"version": "3.0"}},
+                self._to_app.get, self._from_app.put))
+        result = await self._from_app.get()
+        if result["type"].endswith(".failed"):
+            raise RuntimeError(result.get("message", "Lifespan failed"))
+
+    async def startup(self):
+        """Runs the application startup handlers"""
+        self._to_app = asyncio.Queue()
+        self._from_app = asyncio.Queue()
+        await self._lifespan_message("lifespan.startup")
+
+    async def shutdown(self):
+        """Runs the application shutdown handlers"""
+        await self._lifespan_message("lifespan.shutdown")
+        await self._lifespan
+
+    async def request(self, method: str, path: str, params: dict = None):
+        """Makes a request, returns (status, body bytes)"""
+
+        query = urlencode(params or {}).encode()
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": query,
+            "root_path": "",
+            "headers": [(b"host", b"localhost")],
+            "client": ("10.0.0.1", 50000),
+            "server": ("localhost", 80),
+        }
+        request_sent = [False]
+        result = {"status": 0, "body": []}
+
+        async def receive():
+            if not request_sent[0]:
+                request_sent[0] = True
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await asyncio.sleep(3600)
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                result["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                result["body"].append(message.get("body", b""))
+
+        await self.app(scope, receive, send)
+        return (result["status"], b"".join(result["body"]))
+
+
+def make_request(kind: str, node: dict, fleet: dict):
+    """Returns (method, path, params) for a request of the given kind"""
+
+    if kind == "heartbeat":
+        return ("PUT", "/register_node/", {
+            "node_id": node["node_id"],
+            "package": node["package"],
+            "version": node["version"],
+            "description": "Synthetic node",
+            "platform": "esp32"})
+    if kind == "check":
+        return ("GET", "/check_for_update/", {
+            "node_id": node["node_id"], "package": node["package"]})
+    if kind == "config":
+        return ("GET", "/config/", {
+            "key": "key_0", "package": node["package"], "node_id": node["node_id"]})
+    if kind == "download":
+        package = next(entry for entry in fleet["packages"]
+                       if entry["name"] == node["package"])
+        return ("GET", "/blob/", {"package": package["name"], "blob": package["blob"]})
+    raise ValueError(f"Unknown request kind {kind}")
+
+
+def percentile(values: list, fraction: float):
+    """Returns the value at the given fraction of a sorted list"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(fraction * (len(values) - 1)))))
+    return values[index]
+
+
+async def run_load(app, fleet: dict, requests: int, concurrency: int,  # pylint: disable=R0913
+                   mix: dict, seed: int = 0):
+    """Drives the traffic mix through the app, returns the results dict"""
+
+    rand = random.Random(seed)
+    kinds = list(mix.keys())
+    weights = [mix[kind] for kind in kinds]
+    plan = [(rand.choices(kinds, weights)[0], rand.choice(fleet["nodes"]))
+            for _ in range(requests)]
+
+    client = AsgiClient(app)
+    await client.startup()
+
+    latencies = {kind: [] for kind in kinds}
+    errors = {kind: 0 for kind in kinds}
+    queue = asyncio.Queue()
+    for item in plan:
+        queue.put_nowait(item)
+
+    async def worker():
+        while not queue.empty():
+            (kind, node) = queue.get_nowait()
+            (method, path, params) = make_request(kind, node, fleet)
+            start = time.perf_counter()
+            (status, _) = await client.request(method, path, params)
+            latencies[kind].append(time.perf_counter() - start)
+            if status >= 400:
+                errors[kind] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    await client.shutdown()
+
+    results = {"requests": requests, "concurrency": concurrency,
+               "elapsed": elapsed, "throughput": requests / elapsed if elapsed else 0.0,
+               "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               "kinds": {}}
+    all_latencies = []
+    for kind in kinds:
+        values = sorted(latencies[kind])
+        all_latencies.extend(values)
+        results["kinds"][kind] = {
+            "count": len(values),
+            "errors": errors[kind],
+            "p50": percentile(values, 0.5),
+            "p99": percentile(values, 0.99)
+        }
+    all_latencies.sort()
+    results["p50"] = percentile(all_latencies, 0.5)
+    results["p99"] = percentile(all_latencies, 0.99)
+    return results
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float):
+    """Returns list of regression messages, empty if within tolerance
+
+    Attributes:
+        results (dict): Results of this run
+        baseline (dict): Results of the baseline run
+        tolerance (float): Allowed fractional change, 0.2 allows 20% worse
+    """
+
+    regressions = []
+    if results["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append(f"throughput {results['throughput']:.1f} req/s is below "
+                           f"baseline {baseline['throughput']:.1f} req/s")
+    for name in ("p50", "p99"):
+        if results[name] > baseline[name] * (1 + tolerance):
+            regressions.append(f"{name} {results[name] * 1000:.2f} ms is above "
+                               f"baseline {baseline[name] * 1000:.2f} ms")
+    for (kind, values) in results["kinds"].items():
+        if kind not in baseline.get("kinds", {}):
+            continue
+        base = baseline["kinds"][kind]
+        if values["p99"] > base["p99"] * (1 + tolerance):
+            regressions.append(f"{kind} p99 {values['p99'] * 1000:.2f} ms is above "
+                               f"baseline {base['p99'] * 1000:.2f} ms")
+    if results["peak_rss_kb"] > baseline["peak_rss_kb"] * (1 + tolerance):
+        regressions.append(f"peak RSS {results['peak_rss_kb']} kB is above "
+                           f"baseline {baseline['peak_rss_kb']} kB")
+    return regressions
+
+
+def print_results(results: dict, fleet_args: dict):
+    """Prints a human readable summary"""
+
+    print(f"Fleet: {fleet_args}")
+    print(f"Requests: {results['requests']}, concurrency: {results['concurrency']}, "
+          f"elapsed: {results['elapsed']:.2f} s")
+    print(f"Throughput: {results['throughput']:.1f} req/s, p50: {results['p50'] * 1000:.2f} ms, "
+          f"p99: {results['p99'] * 1000:.2f} ms, peak RSS: {results['peak_rss_kb']} kB")
+    for (kind, values) in results["kinds"].items():
+        print(f"  {kind:10s} count {values['count']:6d}  errors {values['errors']:4d}  "
+              f"p50 {values['p50'] * 1000:8.2f} ms  p99 {values['p99'] * 1000:8.2f} ms")
+
+
+def parse_mix(text: str):
+    """Parses heartbeat=50,check=35,... in to a dict"""
+    mix = {}
+    for part in text.split(","):
+        (name, weight) = part.split("=")
+        if name not in DEFAULT_MIX:
+            raise ValueError(f"Unknown request kind {name}")
+        mix[name] = float(weight)
+    return mix
+
+
+def main():
+    """Seeds the fleet, runs the load and reports"""
+
+    parser = argparse.ArgumentParser(description="confrm fleet load test")
+    parser.add_argument("--nodes", type=int, default=10000)
+    parser.add_argument("--packages", type=int, default=10)
+    parser.add_argument("--versions", type=int, default=100)
+    parser.add_argument("--configs-per-node", type=int, default=1)
+    parser.add_argument("--blob-size", type=int, default=64 * 1024)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--mix", type=str,
+                        default=",".join(f"{k}={v}" for (k, v) in DEFAULT_MIX.items()),
+                        help="Relative weights, e.g. heartbeat=50,check=35,config=10,download=5")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", type=str, default="",
+                        help="Use this directory instead of a temporary one")
+    parser.add_argument("--baseline", type=str, default="",
+                        help="Compare against this baseline file")
+    parser.add_argument("--save-baseline", type=str, default="",
+                        help="Write the results to this baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed fractional regression against the baseline")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    fleet_args = {"nodes": args.nodes, "packages": args.packages, "versions": args.versions,
+                  "configs_per_node": args.configs_per_node, "blob_size": args.blob_size}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        data_dir = args.data_dir or temp_dir
+        fleet = seed_data_dir(data_dir, seed=args.seed, **fleet_args)
+        os.environ["CONFRM_CONFIG"] = fleet["config_file"]
+
+        from confrm import APP  # pylint: disable=C0415
+
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(run_load(
+                APP, fleet, args.requests, args.concurrency, parse_mix(args.mix), args.seed))
+        finally:
+            loop.close()
+
+    results["fleet"] = fleet_args
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results, fleet_args)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as ptr:
+            json.dump(results, ptr, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as ptr:
+            baseline = json.load(ptr)
+        if baseline.get("fleet") != fleet_args:
+            print("Warning: baseline was recorded with a different fleet "
+                  f"{baseline.get('fleet')}")
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
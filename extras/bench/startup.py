@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Startup time benchmark for the confrm server.
+
+Seeds a large data_dir (see fleet.py) and then starts the server in fresh
+interpreters, measuring for each run the time from process start to:
+
+    import          confrm imported
+    startup         startup handlers finished
+    first_response  first request (GET /info/) answered
+    ready           GET /ready/ reports all warm-up components ready
+
+Example usage:
+
+    python extras/bench/startup.py --nodes 50000 --runs 5
+
+Copyright 2020 confrm.io
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+PHASES = ["import", "startup", "first_response", "ready"]
+
+
+def child(config_file: str, started: float):
+    """Runs in the measured interpreter, prints the phase times as JSON"""
+
+    os.environ["CONFRM_CONFIG"] = config_file
+    times = {}
+
+    from confrm import APP  # pylint: disable=C0415
+    times["import"] = time.time() - started
+
+    from fleet import AsgiClient  # pylint: disable=C0415
+
+    async def run():
+        client = AsgiClient(APP)
+        await client.startup()
+        times["startup"] = time.time() - started
+        (status, _) = await client.request("GET", "/info/")
+        assert status == 200, status
+        times["first_response"] = time.time() - started
+        while (await client.request("GET", "/ready/"))[0] != 200:
+            await asyncio.sleep(0.001)
+        times["ready"] = time.time() - started
+        await client.shutdown()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+    print(json.dumps(times))
+
+
+def measure(config_file: str):
+    """Starts a fresh interpreter and returns its phase times"""
+    started = time.time()
+    output = subprocess.run(
+        [sys.executable, __file__, "--child", config_file, "--started", str(started)],
+        check=True, stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+    return json.loads(output.stdout.decode().strip().splitlines()[-1])
+
+
+def main():
+    """Seeds the data_dir, runs the measurements and reports"""
+
+    parser = argparse.ArgumentParser(description="confrm startup benchmark")
+    parser.add_argument("--nodes", type=int, default=50000)
+    parser.add_argument("--packages", type=int, default=10)
+    parser.add_argument("--versions", type=int, default=100)
+    parser.add_argument("--configs-per-node", type=int, default=1)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    parser.add_argument("--child", type=str, default="", help=argparse.SUPPRESS)
+    parser.add_argument("--started", type=float, default=0.0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.started)
+        return
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from fleet import seed_data_dir  # pylint: disable=C0415
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        fleet = seed_data_dir(data_dir, nodes=args.nodes, packages=args.packages,
+                              versions=args.versions, configs_per_node=args.configs_per_node,
+                              blob_size=1024)
+        size = os.path.getsize(os.path.join(data_dir, "confrm_db.json"))
+        runs = [measure(fleet["config_file"]) for _ in range(args.runs)]
+
+    results = {
+        "nodes": args.nodes,
+        "db_bytes": size,
+        "runs": runs,
+        "best": {phase: min(run[phase] for run in runs) for phase in PHASES}
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{args.nodes} nodes, database {size / 1e6:.1f} MB, best of {args.runs} runs")
+    for phase in PHASES:
+        print(f"  {phase:<16}{results['best'][phase] * 1000:10.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
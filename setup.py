@@ -34,6 +34,7 @@ setuptools.setup(
                       "toml",
                       "uvicorn",
                       "zeroconf"],
+    extras_require={"brotli": ["brotli"]},
     scripts=['confrm_srv'],
     classifiers=["Intended Audience :: Users",
                  "Natural Language :: English"
@@ -1,12 +1,44 @@
 """Unit tests for confrm API"""
 
+import asyncio
+import base64
+import hashlib
+import io
+import json
 import os
+import pstats
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tarfile
 import tempfile
+import threading
+import time
 import pytest
 
+import requests
+
+from fastapi import FastAPI
 from fastapi.testclient import TestClient
+from tinydb import Query
+from tinydb.table import Document
+
+import confrm.confrm
 
 from confrm import APP
+from confrm import metrics
+from confrm.blobcache import BlobCache
+from confrm.history import HistoryStore
+from confrm.presence import PresenceTracker
+from confrm.polling import PollScheduler
+from confrm.processing import StageError, chunk_digests, image_header
+from confrm.ratelimit import RateLimiter
+from confrm.shaping import Shaper, TokenBucket
+from confrm.static import DASHBOARD_DIR, DashboardFiles, accepted_encoding, compress_directory
+from confrm.storage import ChangeLog, parse_account
+from confrm.zeroconf import ConfrmZeroconf
 
 CONFIG_NAME = "confrm.toml"
 
@@ -17,10 +49,34 @@ def get_config_file(path: str):
           '[basic]\n' + \
           'port = 8001\n\n' + \
           '[storage]\n' + \
-          f'data_dir = "{path}"'
+          f'data_dir = "{path}"\n\n' + \
+          '[zeroconf]\n' + \
+          'enabled = false\n'
     return ret
 
 
+def wait_ready(client, timeout: float = 5):
+    """Waits for the server to report it is ready, returns the last response"""
+    deadline = time.time() + timeout
+    response = client.get("/ready/")
+    while response.status_code != 200 and time.time() < deadline:
+        time.sleep(0.01)
+        response = client.get("/ready/")
+    return response
+
+
+def assert_query_budget(response, max_queries: int, max_writes: int = None):
+    """Checks the database work reported in the X-Confrm-Queries header of a
+    response is within budget, requires query_header in the [debug] config"""
+    account = parse_account(response.headers["X-Confrm-Queries"])
+    assert account["queries"] <= max_queries, \
+        f"{response.request.url} made {account['queries']} queries, budget {max_queries}"
+    if max_writes is not None:
+        assert account["writes"] <= max_writes, \
+            f"{response.request.url} made {account['writes']} writes, budget {max_writes}"
+    return account
+
+
 def test_no_env():
     """Test for env not set"""
     with pytest.raises(ValueError):
@@ -248,8 +304,12 @@ def test_delete_package():
             response = client.get("/package/?name=test_package")
             assert response.status_code == 404
 
-            # Check the file was deleted too
-            assert not os.path.isfile(os.path.join(os.path.join(data_dir, "blob"), new_file))
+            # The file is removed by the sweeper after the grace period
+            blob_file = os.path.join(os.path.join(data_dir, "blob"), new_file)
+            assert os.path.isfile(blob_file)
+            assert confrm.confrm.SWEEPER.sweep()["last_reclaimed_files"] == 0
+            assert confrm.confrm.SWEEPER.sweep(grace=0)["last_reclaimed_files"] == 1
+            assert not os.path.isfile(blob_file)
 
             # Test the config was deleted
             response = client.get("/config/" +
@@ -962,6 +1022,76 @@ def test_config():
             assert response.json()["error"] == "confrm-012"
 
 
+def test_config_listing():
+    """Tests listing, filtering and paginating configs"""
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        config_file = os.path.join(data_dir, CONFIG_NAME)
+        with open(config_file, "w") as file:
+            file.write(get_config_file(data_dir))
+        os.environ["CONFRM_CONFIG"] = config_file
+
+        with TestClient(APP) as client:
+
+            # Create package and node for testing
+            response = client.put("/package/" +
+                                  "?name=package_a" +
+                                  "&description=some%20description" +
+                                  "&title=Good%20Name" +
+                                  "&platform=esp32")
+            assert response.status_code == 201
+
+            response = client.put("/register_node/" +
+                                  "?node_id=0:12:3:4" +
+                                  "&package=package_a" +
+                                  "&version=0.2.0" +
+                                  "&description=some%20description" +
+                                  "&platform=esp32")
+            assert response.status_code == 200
+
+            # Add configs out of order
+            for (type_name, config_id, key) in [("node", "0:12:3:4", "key_a"),
+                                                ("package", "package_a", "key_b"),
+                                                ("global", "", "key_b"),
+                                                ("package", "package_a", "key_a"),
+                                                ("global", "", "key_a")]:
+                response = client.put("/config/" +
+                                      f"?type={type_name}" +
+                                      f"&id={config_id}" +
+                                      f"&key={key}" +
+                                      "&value=value")
+                assert response.status_code == 201
+
+            # Sorted by key, then global / package / node
+            response = client.get("/config/")
+            assert response.status_code == 200
+            assert response.headers["X-Total-Count"] == "5"
+            assert [(entry["key"], entry["type"]) for entry in response.json()] == [
+                ("key_a", "global"),
+                ("key_a", "package"),
+                ("key_a", "node"),
+                ("key_b", "global"),
+                ("key_b", "package")]
+
+            # Titles are added to package and node configs
+            assert response.json()[1]["package_title"] == "Good Name"
+            assert response.json()[2]["node_title"] == "0:12:3:4"
+
+            # Paginate the list
+            response = client.get("/config/?offset=1&limit=2")
+            assert response.status_code == 200
+            assert response.headers["X-Total-Count"] == "5"
+            assert [(entry["key"], entry["type"]) for entry in response.json()] == [
+                ("key_a", "package"),
+                ("key_a", "node")]
+
+            # Filter the list
+            response = client.get("/config/?type=package&id=package_a")
+            assert response.status_code == 200
+            assert response.headers["X-Total-Count"] == "2"
+            assert [entry["key"] for entry in response.json()] == ["key_a", "key_b"]
+
+
 def test_put_node_title():
     """Tests changing the title of a given node"""
 
@@ -1074,3 +1204,2030 @@ def test_register_node():
                                   "&description=some%20description" +
                                   "&platform=esp32")
             assert response.status_code == 400
+
+
+def test_metrics():
+    """Tests the prometheus metrics endpoint"""
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        config_file = os.path.join(data_dir, CONFIG_NAME)
+        with open(config_file, "w") as file:
+            file.write(get_config_file(data_dir))
+        os.environ["CONFRM_CONFIG"] = config_file
+
+        test_file_content = bytearray(os.urandom(1000))
+        test_file = os.path.join(data_dir, "test.bin")
+        with open(test_file, "wb") as file_ptr:
+            file_ptr.write(test_file_content)
+
+        metrics.REGISTRY.clear()
+
+        with TestClient(APP) as client:
+
+            response = client.put("/package/" +
+                                  "?name=package_a" +
+                                  "&description=some%20description" +
+                                  "&title=Good%20Name" +
+                                  "&platform=esp32")
+            assert response.status_code == 201
+
+            with open(test_file, "rb") as file_ptr:
+                response = client.post("/package_version/" +
+                                       "?name=package_a" +
+                                       "&major=0" +
+                                       "&minor=1" +
+                                       "&revision=0" +
+                                       "&set_active=true",
+                                       files={"file": ("filename", file_ptr, "application/binary")})
+                assert response.status_code == 201
+
+            response = client.get("/check_for_update/" +
+                                  "?node_id=0:12:3:4" +
+                                  "&package=package_a")
+            assert response.status_code == 200
+            blob = response.json()["blob"]
+
+            response = client.get("/blob/" +
+                                  "?package=package_a" +
+                                  f"&blob={blob}")
+            assert response.status_code == 200
+
+            response = client.get("/package/?name=not_there")
+            assert response.status_code == 404
+
+            response = client.get("/metrics")
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("text/plain")
+            text = response.text
+
+            # Route templates are used as labels, with status codes counted
+            assert 'confrm_requests_total{method="GET",route="/package/",status="404"}' in text
+            assert 'confrm_request_duration_seconds_count{method="GET",route="/blob/"}' in text
+            assert 'confrm_storage_duration_seconds_count{operation="write"}' in text
+            assert "confrm_upload_size_bytes_count 1\n" in text
+            assert "confrm_blob_active_transfers 0" in text
+            assert "confrm_event_loop_lag_seconds" in text
+
+            assert "confrm_blob_bytes_sent_total 1000\n" in text
+
+
+def test_profile():
+    """Tests the on demand request profiler"""
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        config_file = os.path.join(data_dir, CONFIG_NAME)
+        with open(config_file, "w") as file:
+            file.write(get_config_file(data_dir) + '\n\n[admin]\ntoken = "secret"\n')
+        os.environ["CONFRM_CONFIG"] = config_file
+
+        headers = {"X-Confrm-Admin-Token": "secret"}
+
+        with TestClient(APP) as client:
+
+            # Admin token is required
+            response = client.put("/profile/?count=1")
+            assert response.status_code == 403
+            assert response.json()["error"] == "confrm-030"
+
+            response = client.put("/profile/?count=1",
+                                  headers={"X-Confrm-Admin-Token": "wrong"})
+            assert response.status_code == 403
+
+            # Nothing collected yet
+            response = client.get("/profile/download/", headers=headers)
+            assert response.status_code == 404
+            assert response.json()["error"] == "confrm-032"
+
+            # Invalid mode
+            response = client.put("/profile/?count=1&mode=magic", headers=headers)
+            assert response.status_code == 400
+            assert response.json()["error"] == "confrm-031"
+
+            # Profile the next two requests to /package/
+            response = client.put("/profile/?count=2&route=/package/", headers=headers)
+            assert response.status_code == 200
+            assert response.json()["armed"]
+
+            # Not matching the route, not profiled
+            response = client.get("/info/")
+            assert response.status_code == 200
+            assert "server-timing" not in response.headers
+
+            response = client.put("/package/" +
+                                  "?name=package_a" +
+                                  "&description=some%20description" +
+                                  "&title=Good%20Name" +
+                                  "&platform=esp32")
+            assert response.status_code == 201
+            assert "storage;dur=" in response.headers["server-timing"]
+
+            response = client.get("/package/?name=package_a")
+            assert response.status_code == 200
+
+            # Count reached, profiler disarms itself
+            response = client.get("/package/?name=package_a")
+            assert "server-timing" not in response.headers
+
+            response = client.get("/profile/", headers=headers)
+            assert response.status_code == 200
+            data = response.json()
+            assert not data["armed"]
+            assert [entry["path"] for entry in data["requests"]] == ["/package/", "/package/"]
+            assert data["requests"][0]["storage"] > 0
+            assert data["requests"][0]["serialization"] > 0
+
+            # Download the pstats file and check it loads
+            response = client.get("/profile/download/", headers=headers)
+            assert response.status_code == 200
+            stats_file = os.path.join(data_dir, "confrm.pstats")
+            with open(stats_file, "wb") as file_ptr:
+                file_ptr.write(response.content)
+            stats = pstats.Stats(stats_file)
+            assert any(name == "put_package" for (_, _, name) in stats.stats.keys())
+
+            # Sampling mode gives collapsed stacks
+            response = client.put("/profile/?count=1&mode=sample&interval=0.0001",
+                                  headers=headers)
+            assert response.status_code == 200
+            response = client.get("/packages/")
+            assert response.status_code == 200
+            response = client.get("/profile/download/", headers=headers)
+            assert response.status_code == 200
+            for line in response.text.splitlines():
+                assert int(line.rsplit(" ", 1)[1]) > 0
+
+            # Clearing removes the results
+            response = client.delete("/profile/", headers=headers)
+            assert response.status_code == 200
+            response = client.get("/profile/", headers=headers)
+            assert response.json()["requests"] == []
+
+
+def test_query_budgets():
+    """Tests device and listing endpoints make a fixed number of queries, however
+    many nodes, versions and configs there are"""
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        config_file = os.path.join(data_dir, CONFIG_NAME)
+        with open(config_file, "w") as file:
+            file.write(get_config_file(data_dir) + '\n\n[debug]\nquery_header = true\n')
+        os.environ["CONFRM_CONFIG"] = config_file
+
+        test_file_content = bytearray(os.urandom(100))
+        test_file = os.path.join(data_dir, "test.bin")
+        with open(test_file, "wb") as file_ptr:
+            file_ptr.write(test_file_content)
+
+        with TestClient(APP) as client:
+
+            response = client.put("/package/" +
+                                  "?name=package_a" +
+                                  "&description=some%20description" +
+                                  "&title=Good%20Name" +
+                                  "&platform=esp32")
+            assert response.status_code == 201
+
+            accounts = []
+            for count in range(1, 11):
+
+                with open(test_file, "rb") as file_ptr:
+                    response = client.post("/package_version/" +
+                                           "?name=package_a" +
+                                           "&major=0" +
+                                           "&minor=1" +
+                                           f"&revision={count}" +
+                                           "&set_active=true",
+                                           files={"file": ("filename", file_ptr,
+                                                           "application/binary")})
+                    assert response.status_code == 201
+
+                node_id = f"0:12:3:{count}"
+                response = client.put("/register_node/" +
+                                      f"?node_id={node_id}" +
+                                      "&package=package_a" +
+                                      "&version=0.1.0" +
+                                      "&description=some%20description" +
+                                      "&platform=esp32")
+                assert response.status_code == 200
+                heartbeat = assert_query_budget(response, 3, 1)
+
+                response = client.put("/config/" +
+                                      "?type=node" +
+                                      f"&id={node_id}" +
+                                      "&key=key_a" +
+                                      "&value=value")
+                assert response.status_code == 201
+
+                response = client.get("/check_for_update/" +
+                                      f"?node_id={node_id}" +
+                                      "&package=package_a")
+                assert response.status_code == 200
+                check = assert_query_budget(response, 10, 0)
+
+                response = client.get("/config/" +
+                                      "?key=key_a" +
+                                      "&package=package_a" +
+                                      f"&node_id={node_id}")
+                assert response.status_code == 200
+                config = assert_query_budget(response, 4, 0)
+
+                response = client.get("/config/")
+                assert response.status_code == 200
+                listing = assert_query_budget(response, 4, 0)
+
+                response = client.get("/package/?name=package_a")
+                assert response.status_code == 200
+                package = assert_query_budget(response, 3, 0)
+
+                accounts.append([account["queries"] for account in
+                                 [heartbeat, check, config, listing, package]])
+
+            # Query counts must not grow with the number of rows, the first
+            # pass differs as the tables are being created
+            assert all(account == accounts[1] for account in accounts[1:])
+
+
+def test_presence_tracker():
+    """Tests online / offline tracking of nodes"""
+
+    tracker = PresenceTracker(timeout=60)
+    events = []
+    tracker.add_listener(lambda event, node_id, package: events.append((event, node_id)))
+
+    tracker.heartbeat("node_a", "package_a", now=1000)
+    tracker.heartbeat("node_b", "package_a", now=1010)
+    tracker.heartbeat("node_c", "package_b", now=1020)
+    assert events == [("online", "node_a"), ("online", "node_b"), ("online", "node_c")]
+    assert tracker.online_count(now=1030) == 3
+    assert tracker.online_counts(now=1030) == {"package_a": 2, "package_b": 1}
+
+    # A heartbeat pushes the deadline back, stale deadlines are ignored
+    tracker.heartbeat("node_a", "package_a", now=1050)
+    assert tracker.online_count("package_a", now=1065) == 2
+    assert tracker.online_count("package_a", now=1071) == 1
+    assert events[-1] == ("offline", "node_b")
+    assert tracker.is_online("node_a", now=1071)
+    assert not tracker.is_online("node_b", now=1071)
+
+    # Changing package moves the node between counts
+    tracker.heartbeat("node_c", "package_a", now=1075)
+    assert tracker.online_counts(now=1075) == {"package_a": 2}
+
+    # Coming back online emits an event
+    tracker.heartbeat("node_b", "package_a", now=1080)
+    assert events[-1] == ("online", "node_b")
+
+    # Long idle period expires everything
+    assert tracker.online_count(now=100000) == 0
+    assert tracker.node_count() == 3
+
+    # Rebuild from stored last_seen values
+    tracker.reset()
+    tracker.rebuild([
+        {"node_id": "node_a", "package": "package_a", "last_seen": 1000},
+        {"node_id": "node_b", "package": "package_a", "last_seen": 900},
+        {"node_id": "node_c", "package": "package_b", "last_seen": -1}], now=1030)
+    assert tracker.online_counts(now=1030) == {"package_a": 1}
+    assert tracker.online_count(now=1061) == 0
+
+    # Nodes seen since the reset are newer than the stored state
+    tracker.reset()
+    tracker.heartbeat("node_b", "package_b", now=1000)
+    tracker.rebuild([{"node_id": "node_b", "package": "package_a", "last_seen": 990}], now=1000)
+    assert tracker.online_counts(now=1000) == {"package_b": 1}
+
+
+def test_presence():
+    """Tests the presence endpoint is fed by node registration"""
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        config_file = os.path.join(data_dir, CONFIG_NAME)
+        with open(config_file, "w") as file:
+            file.write(get_config_file(data_dir))
+        os.environ["CONFRM_CONFIG"] = config_file
+
+        with TestClient(APP) as client:
+
+            response = client.get("/presence/")
+            assert response.status_code == 200
+            assert response.json() == {"online": 0, "offline": 0, "packages": {}}
+
+            for node_id in ["0:12:3:4", "1:12:3:4"]:
+                response = client.put("/register_node/" +
+                                      f"?node_id={node_id}" +
+                                      "&package=package_a" +
+                                      "&version=0.1.0" +
+                                      "&description=some%20description" +
+                                      "&platform=esp32")
+                assert response.status_code == 200
+
+            response = client.get("/presence/")
+            assert response.status_code == 200
+            assert response.json() == {"online": 2, "offline": 0, "packages": {"package_a": 2}}
+
+            response = client.get("/presence/?package=package_a")
+            assert response.json()["online"] == 2
+
+            response = client.get("/presence/?node_id=0:12:3:4")
+            assert response.json()["online"]
+
+            response = client.get("/presence/?node_id=9:12:3:4")
+            assert response.status_code == 404
+            assert response.json()["error"] == "confrm-001"
+
+        # Presence is rebuilt from the database on restart
+        with TestClient(APP) as client:
+            wait_ready(client)
+            response = client.get("/presence/?package=package_a")
+            assert response.json()["online"] == 2
+
+
+def test_history_store():
+    """Tests the bounded node history rings and their serialization"""
+
+    store = HistoryStore(heartbeats=4, versions=2)
+    store.record("node_a", "package_a", "0.1.0", 1000)
+    store.record("node_a", "package_a", "0.1.0", 1060)
+    store.record("node_a", "package_a", "0.2.0", 1200)
+    store.record("node_b", "package_a", "0.2.0", 1100)
+
+    timeline = store.node_timeline("node_a")
+    assert timeline["heartbeats"] == [1000, 1060, 1200]
+    assert timeline["heartbeat_interval"] == 140
+    assert timeline["versions"] == [
+        {"time": 1000, "package": "package_a", "version": "0.1.0", "update_duration": 0},
+        {"time": 1200, "package": "package_a", "version": "0.2.0", "update_duration": 140}]
+    assert store.node_timeline("node_a", since=1100)["heartbeats"] == [1200]
+    assert store.node_timeline("node_c") is None
+
+    assert [(x["node_id"], x["time"]) for x in store.version_timeline("package_a", "0.2.0")] == \
+        [("node_b", 1100), ("node_a", 1200)]
+    assert len(store.version_timeline("package_a")) == 3
+    assert store.version_timeline("package_b") == []
+
+    # Oldest entries are overwritten once the rings are full
+    for ind in range(6):
+        store.record("node_a", "package_b", f"1.0.{ind}", 2000 + ind)
+    timeline = store.node_timeline("node_a")
+    assert timeline["heartbeats"] == [2002, 2003, 2004, 2005]
+    assert [x["version"] for x in timeline["versions"]] == ["1.0.4", "1.0.5"]
+
+    # Round trip, including in to a store with smaller rings
+    for (heartbeats, versions) in [(4, 2), (2, 1)]:
+        loaded = HistoryStore(heartbeats=heartbeats, versions=versions)
+        loaded.loads(store.dumps())
+        assert loaded.node_count() == 2
+        expected = store.node_timeline("node_a")
+        timeline = loaded.node_timeline("node_a")
+        assert timeline["heartbeats"] == expected["heartbeats"][-heartbeats:]
+        assert timeline["versions"] == expected["versions"][-versions:]
+
+    with pytest.raises(ValueError):
+        store.loads(b"not a history file")
+
+    # Truncated or corrupt files are refused and leave the store as it was
+    data = store.dumps()
+    for bad in [data[:10], data[:len(data) // 2], data[:-1],
+                data[:16] + b"\xff" * 4 + data[20:]]:
+        with pytest.raises(ValueError):
+            store.loads(bad)
+    assert store.node_count() == 2
+
+    # A file which cannot be read is moved aside and the store starts empty
+    with tempfile.TemporaryDirectory() as data_dir:
+        path = os.path.join(data_dir, "history.bin")
+        with open(path, "wb") as ptr:
+            ptr.write(data[:len(data) // 2])
+        store.load(path)
+        assert store.node_count() == 0
+        assert os.listdir(data_dir) == ["history.bin.corrupt"]
+
+
+def test_history():
+    """Tests the history endpoints are fed by node registration and persisted"""
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        config_file = os.path.join(data_dir, CONFIG_NAME)
+        with open(config_file, "w") as file:
+            file.write(get_config_file(data_dir))
+        os.environ["CONFRM_CONFIG"] = config_file
+
+        with TestClient(APP) as client:
+
+            response = client.put("/package/" +
+                                  "?name=package_a" +
+                                  "&description=some%20description" +
+                                  "&title=Good%20Name" +
+                                  "&platform=esp32")
+            assert response.status_code == 201
+
+            for version in ["0.1.0", "0.1.0", "0.2.0"]:
+                response = client.put("/register_node/" +
+                                      "?node_id=0:12:3:4" +
+                                      "&package=package_a" +
+                                      f"&version={version}" +
+                                      "&description=some%20description" +
+                                      "&platform=esp32")
+                assert response.status_code == 200
+
+            response = client.get("/history/node/?node_id=0:12:3:4")
+            assert response.status_code == 200
+            assert len(response.json()["heartbeats"]) == 3
+            assert [x["version"] for x in response.json()["versions"]] == ["0.1.0", "0.2.0"]
+
+            response = client.get("/history/node/?node_id=9:12:3:4")
+            assert response.status_code == 404
+            assert response.json()["error"] == "confrm-001"
+
+            response = client.get("/history/version/?package=package_a&version=0.2.0")
+            assert response.status_code == 200
+            assert [x["node_id"] for x in response.json()["changes"]] == ["0:12:3:4"]
+
+            response = client.get("/history/version/?package=package_b")
+            assert response.status_code == 404
+            assert response.json()["error"] == "confrm-000"
+
+        # History is saved on shutdown and loaded on startup
+        assert os.path.isfile(os.path.join(data_dir, "history.bin"))
+        with TestClient(APP) as client:
+            response = client.get("/history/node/?node_id=0:12:3:4")
+            assert len(response.json()["heartbeats"]) == 3
+
+
+class FakeZeroconf:
+    """Records the services registered through the AsyncZeroconf API"""
+
+    def __init__(self):
+        self.registered = {}
+        self.closed = False
+
+    async def async_register_service(self, info, allow_name_change=False):  # pylint: disable=W0613
+        self.registered[info.name] = info
+        return asyncio.sleep(0)
+
+    async def async_unregister_service(self, info):
+        del self.registered[info.name]
+        return asyncio.sleep(0)
+
+    async def async_unregister_all_services(self):
+        self.registered = {}
+
+    async def async_close(self):
+        self.closed = True
+
+
+def test_zeroconf():
+    """Tests server and package adverts are batched and kept up to date"""
+
+    fake = FakeZeroconf()
+
+    async def run():
+        advertiser = ConfrmZeroconf(zeroconf_factory=lambda: fake)
+        advertiser.start(8000, [{"name": "package_a", "platform": "esp32"},
+                                {"name": "package_b", "platform": "esp8266"}], "10.0.0.2")
+        await advertiser.wait_idle()
+        names = sorted(fake.registered.keys())
+        assert len(names) == 3
+        assert names[0].startswith("Confrm[package_a-esp32]")
+        assert names[2].endswith("._confrm._tcp.local.")
+        assert fake.registered[names[2]].port == 8000
+
+        # Changes queued before the worker runs are coalesced
+        advertiser.add_package("package_c", "esp32")
+        advertiser.remove_package("package_c", "esp32")
+        advertiser.remove_package("package_b", "esp8266")
+        await advertiser.wait_idle()
+        assert len(fake.registered) == 2
+
+        await advertiser.close()
+        assert fake.closed
+        assert not fake.registered
+
+    asyncio.run(run())
+
+    # Packages added and deleted through the API are advertised
+    fake = FakeZeroconf()
+    original = confrm.confrm.ZEROCONF.zeroconf_factory
+    confrm.confrm.ZEROCONF.zeroconf_factory = lambda: fake
+    try:
+        with tempfile.TemporaryDirectory() as data_dir:
+            config_file = os.path.join(data_dir, CONFIG_NAME)
+            with open(config_file, "w") as file:
+                file.write(get_config_file(data_dir).replace("enabled = false", "enabled = true"))
+            os.environ["CONFRM_CONFIG"] = config_file
+
+            def wait_for(count):
+                deadline = time.time() + 5
+                while len(fake.registered) != count and time.time() < deadline:
+                    time.sleep(0.01)
+                return len(fake.registered)
+
+            with TestClient(APP) as client:
+                assert wait_for(1) == 1
+                response = client.put("/package/" +
+                                      "?name=package_a" +
+                                      "&description=some%20description" +
+                                      "&title=Good%20Name" +
+                                      "&platform=esp32")
+                assert response.status_code == 201
+                assert wait_for(2) == 2
+                assert fake.registered[
+                    "Confrm[package_a-esp32]._arduino._tcp.local."].port == 8001
+
+                response = client.delete("/package/?name=package_a")
+                assert response.status_code == 200
+                assert wait_for(1) == 1
+
+            assert fake.closed
+    finally:
+        confrm.confrm.ZEROCONF.zeroconf_factory = original
+
+
+def test_ready():
+    """Tests the readiness endpoint reports the warm-up of each component"""
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        config_file = os.path.join(data_dir, CONFIG_NAME)
+        with open(config_file, "w") as file:
+            file.write(get_config_file(data_dir))
+        os.environ["CONFRM_CONFIG"] = config_file
+
+        with TestClient(APP) as client:
+            response = client.put("/register_node/" +
+                                  "?node_id=0:12:3:4" +
+                                  "&package=package_a" +
+                                  "&version=0.1.0" +
+                                  "&description=some%20description" +
+                                  "&platform=esp32")
+            assert response.status_code == 200
+
+            response = wait_ready(client)
+            assert response.status_code == 200
+            assert response.json()["ready"]
+            assert response.json()["components"]["presence"]["state"] == "ready"
+
+        # Presence is rebuilt in the background after a restart
+        with TestClient(APP) as client:
+            response = wait_ready(client)
+            assert response.status_code == 200
+            response = client.get("/presence/?package=package_a")
+            assert response.json()["online"] == 1
+
+            confrm.confrm.WARMUP.reset()
+            response = client.get("/ready/")
+            assert response.status_code == 503
+            assert not response.json()["ready"]
+            assert response.json()["components"]["presence"]["state"] == "pending"
+
+
+def test_static():
+    """Tests dashboard assets are served compressed with strong ETags"""
+
+    assert accepted_encoding("gzip, deflate, br", ["gzip", "br"]) == "br"
+    assert accepted_encoding("gzip;q=1.0, br;q=0", ["gzip", "br"]) == "gzip"
+    assert accepted_encoding("", ["gzip"]) == "identity"
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        config_file = os.path.join(data_dir, CONFIG_NAME)
+        with open(config_file, "w") as file:
+            file.write(get_config_file(data_dir))
+        os.environ["CONFRM_CONFIG"] = config_file
+
+        with TestClient(APP) as client:
+            response = client.get("/")
+            assert response.status_code == 200
+            assert response.headers["cache-control"] == "no-cache"
+            assert response.headers["content-encoding"] == "gzip"
+            # Asset URLs carry their content hash
+            match = re.search(r'src="/static/js/confrm.js\?v=([0-9a-f]+)"', response.text)
+            assert match is not None
+
+            response = client.get(f"/static/js/confrm.js?v={match.group(1)}")
+            assert response.status_code == 200
+            assert "immutable" in response.headers["cache-control"]
+
+            # Templates are served from memory and revalidated by ETag
+            response = client.get("/static/templates/nodes.html")
+            assert response.status_code == 200
+            etag = response.headers["etag"]
+            response = client.get("/static/templates/nodes.html",
+                                  headers={"If-None-Match": etag})
+            assert response.status_code == 304
+
+            response = client.get("/static/missing.js")
+            assert response.status_code == 404
+
+    # Precompressed variants are served in place of large files
+    with tempfile.TemporaryDirectory() as temp_dir:
+        directory = os.path.join(temp_dir, "dashboard")
+        shutil.copytree(os.path.join(DASHBOARD_DIR, "js"), directory)
+        assert compress_directory(directory) > 0
+
+        app = FastAPI()
+        app.mount("/static", DashboardFiles(directory=directory))
+        with TestClient(app) as client:
+            for (encoding, expected) in [("gzip", "gzip"), ("identity", None)]:
+                response = client.get("/static/jquery-3.5.1.min.js",
+                                      headers={"Accept-Encoding": encoding})
+                assert response.status_code == 200
+                assert response.headers.get("content-encoding") == expected
+                assert response.headers["vary"] == "Accept-Encoding"
+                assert response.headers["content-type"].startswith(
+                    ("application/javascript", "text/javascript"))
+                with open(os.path.join(directory, "jquery-3.5.1.min.js"), "rb") as ptr:
+                    assert response.content == ptr.read()
+
+
+def test_dashboard_state():
+    """Tests the aggregated dashboard state matches the separate endpoints and
+    is revalidated by ETag"""
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        config_file = os.path.join(data_dir, CONFIG_NAME)
+        with open(config_file, "w") as file:
+            file.write(get_config_file(data_dir) + '\n\n[debug]\nquery_header = true\n')
+        os.environ["CONFRM_CONFIG"] = config_file
+
+        test_file = os.path.join(data_dir, "test.bin")
+        with open(test_file, "wb") as file_ptr:
+            file_ptr.write(bytearray(os.urandom(100)))
+
+        with TestClient(APP) as client:
+
+            response = client.put("/package/" +
+                                  "?name=package_a" +
+                                  "&description=some%20description" +
+                                  "&title=Good%20Name" +
+                                  "&platform=esp32")
+            assert response.status_code == 201
+
+            for revision in range(2):
+                with open(test_file, "rb") as file_ptr:
+                    response = client.post("/package_version/" +
+                                           "?name=package_a" +
+                                           "&major=0" +
+                                           "&minor=1" +
+                                           f"&revision={revision}" +
+                                           "&set_active=true",
+                                           files={"file": ("filename", file_ptr,
+                                                           "application/binary")})
+                    assert response.status_code == 201
+
+            response = client.put("/register_node/" +
+                                  "?node_id=0:12:3:4" +
+                                  "&package=package_a" +
+                                  "&version=0.1.0" +
+                                  "&description=some%20description" +
+                                  "&platform=esp32")
+            assert response.status_code == 200
+
+            response = client.put("/config/?type=global&key=key_a&value=value_a")
+            assert response.status_code == 201
+            response = client.put("/config/?type=package&id=package_a&key=key_a&value=value_b")
+            assert response.status_code == 201
+
+            response = client.get("/dashboard_state/")
+            assert response.status_code == 200
+            state = response.json()
+            assert state["info"] == client.get("/info/").json()
+            assert state["packages"] == client.get("/packages/").json()
+            assert state["nodes"] == client.get("/nodes/").json()
+            assert state["configs"] == client.get("/config/").json()
+            assert state["nodes_summary"] == {
+                "nodes": 1, "packages": {"package_a": {"nodes": 1, "versions": {"0.1.0": 1}}}}
+            assert state["configs_summary"] == {
+                "configs": 2, "types": {"global": 1, "package": 1}}
+            assert_query_budget(response, 4, 0)
+
+            # Unchanged state is not rebuilt or sent again
+            etag = response.headers["etag"]
+            response = client.get("/dashboard_state/", headers={"If-None-Match": etag})
+            assert response.status_code == 304
+            assert not response.content
+            assert_query_budget(response, 0, 0)
+
+            response = client.put("/node_title/?node_id=0:12:3:4&title=Kitchen")
+            assert response.status_code == 200
+            response = client.get("/dashboard_state/", headers={"If-None-Match": etag})
+            assert response.status_code == 200
+            assert response.headers["etag"] != etag
+            assert response.json()["nodes"][0]["title"] == "Kitchen"
+
+
+def start_primary(data_dir: str):
+    """Starts a confrm server in a subprocess, returns (process, url)"""
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    config_file = os.path.join(data_dir, CONFIG_NAME)
+    with open(config_file, "w") as file:
+        file.write(get_config_file(data_dir) + '\n\n[admin]\ntoken = "secret"\n')
+    env = dict(os.environ, CONFRM_CONFIG=config_file)
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "confrm:APP",
+                                "--host", "127.0.0.1", "--port", str(port),
+                                "--log-level", "warning"], env=env)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 20
+    while True:
+        try:
+            requests.get(f"{url}/time/", timeout=1)
+            break
+        except requests.ConnectionError:
+            assert time.time() < deadline, "Primary did not start"
+            time.sleep(0.1)
+    return (process, url)
+
+
+def test_replica():
+    """Tests a replica follows a primary and forwards admin writes to it"""
+
+    change_log = ChangeLog(size=2)
+    for doc_id in range(3):
+        change_log.record("config", doc_id, {"key": "key_a"})
+    assert change_log.since(0) is None
+    assert [change[0] for change in change_log.since(1)] == [2, 3]
+    assert change_log.since(2, limit=1) == [(3, "config", 2, {"key": "key_a"})]
+    assert change_log.since(3) == []
+    assert change_log.since(4) is None
+
+    with tempfile.TemporaryDirectory() as primary_dir, \
+            tempfile.TemporaryDirectory() as data_dir:
+
+        (process, url) = start_primary(primary_dir)
+        try:
+            response = requests.put(f"{url}/package/?name=package_a&description=description"
+                                    "&title=Title&platform=esp32")
+            assert response.status_code == 201
+            content = os.urandom(1000)
+            response = requests.post(f"{url}/package_version/?name=package_a&major=0&minor=1"
+                                     "&revision=0&set_active=true",
+                                     files={"file": ("filename", content,
+                                                     "application/binary")})
+            assert response.status_code == 201
+
+            config_file = os.path.join(data_dir, CONFIG_NAME)
+            with open(config_file, "w") as file:
+                file.write(get_config_file(data_dir) +
+                           f'\n\n[replica]\nprimary = "{url}"\ntoken = "secret"\ninterval = 0.1\n')
+            os.environ["CONFRM_CONFIG"] = config_file
+
+            def wait_for(func):
+                deadline = time.time() + 10
+                while not func():
+                    assert time.time() < deadline
+                    time.sleep(0.05)
+
+            with TestClient(APP) as client:
+                wait_for(lambda: client.get("/replica/").json()["synced"])
+
+                # Device endpoints are served from the local copy
+                response = client.get("/check_for_update/?package=package_a&node_id=0:12:3:4")
+                assert response.status_code == 200
+                assert response.json()["current_version"] == "0.1.0"
+                response = client.get(f"/blob/?package=package_a&blob={response.json()['blob']}")
+                assert response.content == content
+
+                # Admin writes go to the primary and come back through the change log
+                response = client.put("/config/?type=global&key=key_a&value=value_a")
+                assert response.status_code == 201
+                response = requests.get(f"{url}/config/?key=key_a")
+                assert response.json() == {"value": "value_a"}
+                wait_for(lambda: client.get("/config/?key=key_a").status_code == 200)
+
+                # Errors from the primary are passed back
+                response = client.put("/package/?name=package_a&description=description"
+                                      "&title=Title&platform=esp32")
+                assert response.status_code == 400
+                assert response.json()["error"] == "confrm-003"
+
+                response = client.post("/package_version/?name=package_a&major=0&minor=2"
+                                       "&revision=0&set_active=true",
+                                       files={"file": ("filename", content,
+                                                       "application/binary")})
+                assert response.status_code == 201
+                wait_for(lambda: client.get("/package/?name=package_a").json()[
+                    "current_version"] == "0.2.0")
+
+                # Nodes polling the replica are told about the rollout
+                assert confrm.confrm.POLLING.in_rollout("package_a", "0.1.0", time.time())
+
+                response = client.delete("/package_version/?package=package_a&version=0.1.0")
+                assert response.status_code == 200
+                wait_for(lambda: len(os.listdir(os.path.join(data_dir, "blob"))) == 1)
+
+                # Heartbeats stay local
+                response = client.put("/register_node/?node_id=0:12:3:4&package=package_a"
+                                      "&version=0.2.0&description=description&platform=esp32")
+                assert response.status_code == 200
+                assert requests.get(f"{url}/nodes/").json() == {}
+
+                # Canaries are the primary's, a replica does not claim them
+                response = client.post("/package_version/?name=package_a&major=0&minor=3"
+                                       "&revision=0&canary_next=true",
+                                       files={"file": ("filename", content,
+                                                       "application/binary")})
+                assert response.status_code == 201
+                wait_for(lambda: client.get("/canary/?node_id=*").status_code == 200)
+                response = client.get("/check_for_update/?package=package_a&node_id=0:12:3:4")
+                assert response.json()["current_version"] == "0.2.0"
+                assert [doc["node_id"] for doc in confrm.confrm.DB.table("canary").all()] == ["*"]
+                response = client.put("/register_node/?node_id=0:12:3:4&package=package_a"
+                                      "&version=0.2.0&description=description&platform=esp32")
+                assert response.status_code == 200
+                assert requests.get(f"{url}/canary/?node_id=*").status_code == 200
+                response = client.delete("/package_version/?package=package_a&version=0.3.0")
+                assert response.status_code == 200
+                wait_for(lambda: len(os.listdir(os.path.join(data_dir, "blob"))) == 1)
+
+                # Batches go to the primary or stay local, never both
+                response = client.post("/batch/", json={"operations": [
+                    {"method": "PUT", "path": "/config/",
+                     "params": {"type": "global", "key": "key_b", "value": "value_b"}}]})
+                assert response.status_code == 200
+                assert requests.get(f"{url}/config/?key=key_b").json() == {"value": "value_b"}
+                response = client.post("/batch/", json={"operations": [
+                    {"method": "PUT", "path": "/node_title/",
+                     "params": {"node_id": "0:12:3:4", "title": "Kitchen"}}]})
+                assert response.status_code == 200
+                assert client.get("/nodes/?node_id=0:12:3:4").json()["title"] == "Kitchen"
+                response = client.post("/batch/", json={"operations": [
+                    {"method": "PUT", "path": "/config/",
+                     "params": {"type": "global", "key": "key_c", "value": "value_c"}},
+                    {"method": "PUT", "path": "/node_title/",
+                     "params": {"node_id": "0:12:3:4", "title": "Hall"}}]})
+                assert response.status_code == 400
+                assert response.json()["error"] == "confrm-047"
+                assert requests.get(f"{url}/config/?key=key_c").status_code == 404
+                assert client.get("/nodes/?node_id=0:12:3:4").json()["title"] == "Kitchen"
+
+                status = client.get("/replica/").json()
+                assert status["replica"]
+                assert status["blobs_fetched"] == 3
+
+                # Scrubs run on the primary, quarantine marks come back
+                (version,) = confrm.confrm.DB.table("package_versions").all()
+                with open(os.path.join(primary_dir, "blob", version["blob_id"]), "wb") as ptr:
+                    ptr.write(base64.b64encode(b"corrupt"))
+                response = client.post("/scrub/", headers={"X-Confrm-Admin-Token": "secret"})
+                assert response.status_code == 200
+                assert response.json()["quarantined"] == 1
+                wait_for(lambda: "quarantined" in
+                         confrm.confrm.DB.table("package_versions").all()[0])
+
+            # A replica starting again does not fetch the blobs of quarantined versions
+            os.remove(os.path.join(data_dir, "blob", version["blob_id"]))
+            with TestClient(APP) as client:
+                wait_for(lambda: client.get("/replica/").json()["synced"])
+                status = client.get("/replica/").json()
+                assert status["last_error"] is None
+                assert status["blobs_fetched"] == 0
+        finally:
+            process.terminate()
+            process.wait()
+
+
+class OffloadProxy:  # pylint: disable=R0903
+    """ASGI test double of a reverse proxy honouring X-Accel-Redirect and
+    X-Sendfile, serving the file in place of the empty response"""
+
+    def __init__(self, app, blob_dir: str, prefix: str = "/confrm-blob/"):
+        self.app = app
+        self.blob_dir = blob_dir
+        self.prefix = prefix
+        self.offloaded = 0
+
+    async def __call__(self, scope, receive, send):
+
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = {}
+
+        async def intercept(message):
+            if message["type"] == "http.response.start":
+                start.update(message)
+                return
+            headers = {name.decode().lower(): value.decode()
+                       for (name, value) in start["headers"]}
+            if "x-accel-redirect" in headers:
+                assert headers["x-accel-redirect"].startswith(self.prefix)
+                path = os.path.join(self.blob_dir,
+                                    headers["x-accel-redirect"][len(self.prefix):])
+            elif "x-sendfile" in headers:
+                path = headers["x-sendfile"]
+            else:
+                await send(start)
+                await send(message)
+                return
+
+            assert message.get("body", b"") == b""
+            self.offloaded += 1
+            with open(path, "rb") as ptr:
+                body = ptr.read()
+            await send({"type": "http.response.start", "status": 200,
+                        "headers": [(b"content-type", b"application/octet-stream"),
+                                    (b"content-length", str(len(body)).encode()),
+                                    (b"x-md5", headers["x-md5"].encode())]})
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, intercept)
+
+
+def test_blob_offload():
+    """Tests blob downloads are handed to the reverse proxy when configured"""
+
+    for mode in ["x-accel-redirect", "x-sendfile"]:
+        with tempfile.TemporaryDirectory() as data_dir:
+            config_file = os.path.join(data_dir, CONFIG_NAME)
+            with open(config_file, "w") as file:
+                file.write(get_config_file(data_dir) + f'\n[blob]\noffload = "{mode}"\n')
+            os.environ["CONFRM_CONFIG"] = config_file
+
+            content = os.urandom(1000)
+            test_file = os.path.join(data_dir, "test.bin")
+            with open(test_file, "wb") as file_ptr:
+                file_ptr.write(content)
+
+            proxy = OffloadProxy(APP, os.path.join(data_dir, "blob"))
+            with TestClient(proxy) as client:
+
+                response = client.put("/package/" +
+                                      "?name=package_a" +
+                                      "&description=some%20description" +
+                                      "&title=Good%20Name" +
+                                      "&platform=esp32")
+                assert response.status_code == 201
+
+                with open(test_file, "rb") as file_ptr:
+                    response = client.post("/package_version/" +
+                                           "?name=package_a" +
+                                           "&major=0" +
+                                           "&minor=1" +
+                                           "&revision=0",
+                                           files={"file": ("filename", file_ptr,
+                                                           "application/binary")})
+                    assert response.status_code == 201
+
+                versions = confrm.confrm.DB.table("package_versions")
+                blob = versions.get(doc_id=1)["blob_id"]
+
+                # Blobs are stored raw, so the proxy can send them as they are
+                with open(os.path.join(data_dir, "blob", blob), "rb") as ptr:
+                    assert ptr.read() == content
+
+                response = client.get(f"/blob/?package=package_a&blob={blob}")
+                assert response.status_code == 200
+                assert response.content == content
+                assert response.headers["x-md5"] == hashlib.md5(content).hexdigest()
+                assert proxy.offloaded == 1
+
+                # Blob of another package is not offloaded
+                response = client.put("/package/" +
+                                      "?name=package_b" +
+                                      "&description=some%20description" +
+                                      "&title=Other" +
+                                      "&platform=esp32")
+                assert response.status_code == 201
+                response = client.get(f"/blob/?package=package_b&blob={blob}")
+                assert response.json()["ok"] is False
+                assert proxy.offloaded == 1
+
+                # Blobs written base64 encoded by older versions are served in
+                # process, concurrent downloads leave them as they are
+                versions.update(lambda doc: (doc.pop("encoding"), doc.pop("md5")), doc_ids=[1])
+                with open(os.path.join(data_dir, "blob", blob), "wb") as ptr:
+                    ptr.write(base64.b64encode(content))
+
+                results = []
+
+                def download():
+                    response = client.get(f"/blob/?package=package_a&blob={blob}")
+                    results.append((response.status_code, response.content))
+
+                threads = [threading.Thread(target=download) for _ in range(8)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                assert results == [(200, content)] * 8
+                assert proxy.offloaded == 1
+                assert "encoding" not in versions.get(doc_id=1)
+                with open(os.path.join(data_dir, "blob", blob), "rb") as ptr:
+                    assert ptr.read() == base64.b64encode(content)
+
+            # Converted at startup, then offloaded
+            with TestClient(proxy) as client:
+                versions = confrm.confrm.DB.table("package_versions")
+                assert versions.get(doc_id=1)["encoding"] == "raw"
+                with open(os.path.join(data_dir, "blob", blob), "rb") as ptr:
+                    assert ptr.read() == content
+
+                # Readers holding the version from before the conversion still
+                # get the content, replicas convert while serving
+                stale = dict(versions.get(doc_id=1), encoding="base64")
+                assert confrm.confrm.read_blob(stale) == content
+
+                response = client.get(f"/blob/?package=package_a&blob={blob}")
+                assert response.content == content
+                assert response.headers["x-md5"] == hashlib.md5(content).hexdigest()
+                assert proxy.offloaded == 2
+
+                # Blobs which do not match their hash are left for the scrubber
+                versions.update(lambda doc: (doc.pop("encoding"), doc.pop("md5")), doc_ids=[1])
+                with open(os.path.join(data_dir, "blob", blob), "wb") as ptr:
+                    ptr.write(base64.b64encode(b"corrupt"))
+
+            with TestClient(proxy) as client:
+                versions = confrm.confrm.DB.table("package_versions")
+                assert "encoding" not in versions.get(doc_id=1)
+                with open(os.path.join(data_dir, "blob", blob), "rb") as ptr:
+                    assert ptr.read() == base64.b64encode(b"corrupt")
+
+
+def test_chunked_upload():
+    """Tests package versions can be uploaded in chunks and resumed"""
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        config_file = os.path.join(data_dir, CONFIG_NAME)
+        with open(config_file, "w") as file:
+            file.write(get_config_file(data_dir))
+        os.environ["CONFRM_CONFIG"] = config_file
+
+        content = os.urandom(10000)
+        sha256 = hashlib.sha256(content).hexdigest()
+
+        with TestClient(APP) as client:
+
+            response = client.post("/upload/?name=package_a&major=0&minor=1&revision=0")
+            assert response.status_code == 404
+            assert response.json()["error"] == "confrm-000"
+
+            response = client.put("/package/" +
+                                  "?name=package_a" +
+                                  "&description=some%20description" +
+                                  "&title=Good%20Name" +
+                                  "&platform=esp32")
+            assert response.status_code == 201
+
+            response = client.post("/upload/?name=package_a&major=0&minor=1&revision=0" +
+                                   "&set_active=true")
+            assert response.status_code == 201
+            upload_id = response.json()["upload_id"]
+            assert response.json()["offset"] == 0
+
+            response = client.put(f"/upload/?upload_id={upload_id}&offset=0",
+                                  content=content[:4000])
+            assert response.status_code == 200
+            assert response.json()["offset"] == 4000
+
+            # Chunks must continue from what was received
+            response = client.put(f"/upload/?upload_id={upload_id}&offset=0",
+                                  content=content[:4000])
+            assert response.status_code == 409
+            assert response.json()["error"] == "confrm-035"
+            assert response.json()["offset"] == 4000
+
+            response = client.get(f"/upload/?upload_id={upload_id}")
+            assert response.json()["offset"] == 4000
+            response = client.put(f"/upload/?upload_id={upload_id}&offset=4000",
+                                  content=content[4000:])
+            assert response.json()["offset"] == 10000
+
+            # Nothing is created until finalized
+            assert client.get("/package/?name=package_a").json()["versions"] == []
+
+            response = client.post(f"/upload/finalize/?upload_id={upload_id}&hash={sha256}")
+            assert response.status_code == 201
+            assert os.listdir(os.path.join(data_dir, "uploads")) == []
+
+            response = client.get("/package/?name=package_a").json()
+            assert response["current_version"] == "0.1.0"
+            version = confrm.confrm.DB.table("package_versions").get(doc_id=1)
+            assert version["hash"] == sha256
+            assert version["md5"] == hashlib.md5(content).hexdigest()
+            response = client.get(f"/blob/?package=package_a&blob={version['blob_id']}")
+            assert response.content == content
+
+            response = client.get(f"/upload/?upload_id={upload_id}")
+            assert response.status_code == 404
+            assert response.json()["error"] == "confrm-034"
+
+            # A version which exists cannot be uploaded again
+            response = client.post("/upload/?name=package_a&major=0&minor=1&revision=0")
+            assert response.status_code == 400
+            assert response.json()["error"] == "confrm-006"
+
+            # Wrong hash discards the upload
+            response = client.post("/upload/?name=package_a&major=0&minor=2&revision=0")
+            upload_id = response.json()["upload_id"]
+            client.put(f"/upload/?upload_id={upload_id}&offset=0", content=content[1:])
+            response = client.post(f"/upload/finalize/?upload_id={upload_id}&hash={sha256}")
+            assert response.status_code == 400
+            assert response.json()["error"] == "confrm-036"
+            assert client.get(f"/upload/?upload_id={upload_id}").status_code == 404
+            assert len(confrm.confrm.DB.table("package_versions")) == 1
+
+            # Sessions receiving a chunk cannot be abandoned
+            response = client.post("/upload/?name=package_a&major=0&minor=2&revision=0")
+            upload_id = response.json()["upload_id"]
+            session = confrm.confrm.UPLOADS.get(upload_id)
+            session.busy = True
+            response = client.delete(f"/upload/?upload_id={upload_id}")
+            assert response.status_code == 409
+            assert response.json()["error"] == "confrm-048"
+            session.busy = False
+            assert client.delete(f"/upload/?upload_id={upload_id}").status_code == 200
+            assert os.listdir(os.path.join(data_dir, "uploads")) == []
+
+            # Abandoned sessions expire
+            response = client.post("/upload/?name=package_a&major=0&minor=2&revision=0")
+            upload_id = response.json()["upload_id"]
+            assert len(os.listdir(os.path.join(data_dir, "uploads"))) == 1
+            assert confrm.confrm.UPLOADS.expire(time.time() + 10) == 0
+            assert confrm.confrm.UPLOADS.expire(time.time() + 3601) == 1
+            assert client.get(f"/upload/?upload_id={upload_id}").status_code == 404
+            assert os.listdir(os.path.join(data_dir, "uploads")) == []
+
+            # Files of earlier runs are removed at startup, directories are left
+            os.mkdir(os.path.join(data_dir, "uploads", "directory"))
+            open(os.path.join(data_dir, "uploads", "left_behind"), "wb").close()
+
+        with TestClient(APP) as client:
+            assert os.listdir(os.path.join(data_dir, "uploads")) == ["directory"]
+
+
+def wait_job(client, package: str, version: str, timeout: float = 10):
+    """Waits for the processing job of a version to finish, returns it"""
+    deadline = time.time() + timeout
+    while True:
+        job = client.get(f"/jobs/?package={package}&version={version}").json()[0]
+        if job["state"] in ("done", "failed") or time.time() > deadline:
+            return job
+        time.sleep(0.01)
+
+
+def test_processing():
+    """Tests uploaded versions are processed in the background and only made
+    active once the required stages are done"""
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        image = os.path.join(data_dir, "image.bin")
+        with open(image, "wb") as ptr:
+            ptr.write(bytes([0xE9, 3, 2, 0x20]) + os.urandom(70000))
+        result = chunk_digests(image, {})
+        assert len(result["digests"]) == 2
+        assert image_header(image, {"platform": "esp32"})["segments"] == 3
+        assert image_header(image, {"platform": "unknown"})["format"] == "unknown"
+        with open(image, "r+b") as ptr:
+            ptr.write(b"\x00")
+        with pytest.raises(StageError):
+            image_header(image, {"platform": "ESP32"})
+        open(image, "wb").close()
+        with pytest.raises(StageError):
+            image_header(image, {"platform": "other"})
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        config_file = os.path.join(data_dir, CONFIG_NAME)
+        with open(config_file, "w") as file:
+            file.write(get_config_file(data_dir) +
+                       '\n[processing]\nrequired = ["digests", "image_header"]\n' +
+                       'retries = 1\nretry_delay = 0.01\nactivate_wait = 10\n')
+        os.environ["CONFRM_CONFIG"] = config_file
+
+        bad_file = os.path.join(data_dir, "bad.bin")
+        with open(bad_file, "wb") as ptr:
+            ptr.write(bytes([0]) + os.urandom(1000))
+        good_file = os.path.join(data_dir, "good.bin")
+        with open(good_file, "wb") as ptr:
+            ptr.write(bytes([0xE9, 1, 2, 0x20]) + os.urandom(1000))
+
+        with TestClient(APP) as client:
+
+            response = client.put("/package/" +
+                                  "?name=package_a" +
+                                  "&description=some%20description" +
+                                  "&title=Good%20Name" +
+                                  "&platform=esp32")
+            assert response.status_code == 201
+
+            # Failing a required stage leaves the version inactive
+            with open(bad_file, "rb") as file_ptr:
+                response = client.post("/package_version/" +
+                                       "?name=package_a&major=0&minor=1&revision=0" +
+                                       "&set_active=true",
+                                       files={"file": ("filename", file_ptr,
+                                                       "application/binary")})
+            assert response.status_code == 202
+            assert response.json()["warning"] == "confrm-038"
+            assert client.get("/package/?name=package_a").json()["current_version"] == ""
+
+            job = client.get("/jobs/?package=package_a&version=0.1.0").json()[0]
+            assert job["state"] == "failed"
+            assert not job["eligible"]
+            assert job["stages"]["digests"]["state"] == "done"
+            assert job["stages"]["image_header"]["attempts"] == 1
+
+            response = client.put("/set_active_version/?package=package_a&version=0.1.0")
+            assert response.status_code == 409
+            assert response.json()["error"] == "confrm-037"
+
+            with open(good_file, "rb") as file_ptr:
+                response = client.post("/package_version/" +
+                                       "?name=package_a&major=0&minor=2&revision=0",
+                                       files={"file": ("filename", file_ptr,
+                                                       "application/binary")})
+            assert response.status_code == 201
+            job = wait_job(client, "package_a", "0.2.0")
+            assert job["eligible"]
+            assert job["stages"]["image_header"]["result"]["segments"] == 1
+            response = client.put("/set_active_version/?package=package_a&version=0.2.0")
+            assert response.json()["ok"]
+
+            # Errors other than the blob failing a stage are retried
+            confrm.confrm.PIPELINE.submit("package_a", "9.9.9", "missing", "esp32")
+            job = wait_job(client, "package_a", "9.9.9")
+            assert job["state"] == "failed"
+            assert job["stages"]["digests"]["attempts"] == 2
+
+            # Jobs interrupted by a restart are resumed, those kept in the main
+            # database by older servers are moved to the jobs file
+            jobs = confrm.confrm.PIPELINE.table
+            job = jobs.get(Query().version == "0.2.0")
+            jobs.remove(doc_ids=[job.doc_id])
+            confrm.confrm.DB.table("jobs").insert(Document(dict(
+                job, state="running",
+                stages={"digests": {"state": "done", "attempts": 1},
+                        "image_header": {"state": "pending", "attempts": 0}}),
+                doc_id=job.doc_id))
+
+        with TestClient(APP) as client:
+            assert "jobs" not in confrm.confrm.DB.tables()
+            job = wait_job(client, "package_a", "0.2.0")
+            assert job["state"] == "done"
+            assert job["stages"]["image_header"]["attempts"] == 1
+
+            # A version deleted while waiting for its job cannot be made active
+            assert not confrm.confrm.PIPELINE.is_eligible(dict(job, state="deleted"))
+
+            response = client.delete("/package_version/?package=package_a&version=0.1.0")
+            assert response.status_code == 200
+            assert client.get("/jobs/?package=package_a&version=0.1.0").json() == []
+
+            # Changes made to the package while waiting for processing are kept,
+            # a package deleted meanwhile is not brought back
+            pipeline = confrm.confrm.PIPELINE
+            packages = confrm.confrm.DB.table("packages")
+
+            async def wait_and_edit(*args):
+                packages.update({"description": "changed"}, Query().name == "package_a")
+                return await type(pipeline).wait(pipeline, *args)
+
+            async def wait_and_delete(*args):
+                packages.remove(Query().name == "package_a")
+                return await type(pipeline).wait(pipeline, *args)
+
+            try:
+                pipeline.wait = wait_and_edit
+                with open(good_file, "rb") as file_ptr:
+                    response = client.post("/package_version/" +
+                                           "?name=package_a&major=0&minor=3&revision=0" +
+                                           "&set_active=true",
+                                           files={"file": ("filename", file_ptr,
+                                                           "application/binary")})
+                assert response.status_code == 201
+                package_doc = client.get("/package/?name=package_a").json()
+                assert package_doc["description"] == "changed"
+                assert package_doc["current_version"] == "0.3.0"
+
+                pipeline.wait = wait_and_delete
+                response = client.put("/set_active_version/?package=package_a&version=0.2.0")
+                assert response.json() == {"ok": False, "info": "Package does not exist"}
+                assert packages.get(Query().name == "package_a") is None
+            finally:
+                del pipeline.wait
+
+
+def test_export_import():
+    """Tests servers are copied by streaming an export into an import, which
+    resumes after an interruption without resending blobs"""
+
+    admin = {"X-Confrm-Admin-Token": "secret"}
+    contents = [os.urandom(100000), os.urandom(2000)]
+
+    with tempfile.TemporaryDirectory() as source_dir, \
+            tempfile.TemporaryDirectory() as target_dir:
+
+        def configure(data_dir):
+            config_file = os.path.join(data_dir, CONFIG_NAME)
+            with open(config_file, "w") as file:
+                file.write(get_config_file(data_dir) + '\n[admin]\ntoken = "secret"\n')
+            os.environ["CONFRM_CONFIG"] = config_file
+
+        configure(source_dir)
+        with TestClient(APP) as client:
+            response = client.put("/package/" +
+                                  "?name=package_a" +
+                                  "&description=some%20description" +
+                                  "&title=Good%20Name" +
+                                  "&platform=esp32")
+            assert response.status_code == 201
+            for (revision, content) in enumerate(contents):
+                response = client.post("/package_version/" +
+                                       f"?name=package_a&major=0&minor=1&revision={revision}" +
+                                       "&set_active=true",
+                                       files={"file": ("filename", content,
+                                                       "application/binary")})
+                assert response.status_code == 201
+            response = client.put("/config/?type=global&key=key_a&value=value_a")
+            assert response.status_code == 201
+
+            # Blobs stored base64 encoded by older versions are exported raw
+            versions = confrm.confrm.DB.table("package_versions")
+            blob_id = versions.get(doc_id=2)["blob_id"]
+            with open(os.path.join(source_dir, "blob", blob_id), "wb") as ptr:
+                ptr.write(base64.b64encode(contents[1]))
+            versions.update(lambda doc: doc.pop("encoding"), doc_ids=[2])
+
+            assert client.get("/export/").status_code == 403
+            response = client.get("/export/", headers=admin)
+            assert response.status_code == 200
+            assert response.headers["content-type"] == "application/x-tar"
+            archive = response.content
+
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+            names = tar.getnames()
+            assert names[-1] == "metadata.ndjson"
+            assert sorted(names[:-1]) == sorted(
+                "blobs/" + hashlib.sha256(content).hexdigest() for content in contents)
+            assert tar.extractfile(
+                "blobs/" + hashlib.sha256(contents[1]).hexdigest()).read() == contents[1]
+
+        configure(target_dir)
+        with TestClient(APP) as client:
+
+            # Interrupted after the first blob
+            response = client.put("/import/", headers=admin, content=archive[:101500])
+            assert response.status_code == 400
+            assert response.json()["error"] == "confrm-039"
+            assert response.json()["result"]["blobs"] == 1
+            assert client.get("/packages/").json() == {}
+            have = client.get("/import/hashes/", headers=admin).json()["hashes"]
+            assert len(have) == 1
+
+        configure(source_dir)
+        with TestClient(APP) as client:
+            response = client.post("/export/", headers=admin, json={"have": have})
+            assert len(response.content) < len(archive) - 90000
+            archive = response.content
+
+        configure(target_dir)
+        with TestClient(APP) as client:
+            response = client.put("/import/", headers=admin, content=archive)
+            assert response.status_code == 200
+            result = response.json()
+            assert result["blobs"] == 1
+            assert result["imported"] == {"packages": 1, "package_versions": 2,
+                                          "config": 1, "canary": 0}
+            assert result["missing_blobs"] == 0
+            assert os.listdir(os.path.join(target_dir, "import")) == []
+
+            response = client.get("/check_for_update/?node_id=0:12:3:4&package=package_a")
+            assert response.json()["current_version"] == "0.1.1"
+            response = client.get(f"/blob/?package=package_a&blob={response.json()['blob']}")
+            assert response.content == contents[1]
+            assert client.get("/config/?type=global&key=key_a").json()["value"] == "value_a"
+
+            # Importing again changes nothing
+            response = client.put("/import/", headers=admin, content=archive)
+            assert response.json()["skipped"]["package_versions"] == 2
+            assert len(confrm.confrm.DB.table("package_versions")) == 2
+
+            response = client.put("/import/", headers=admin, content=b"not an archive" * 100)
+            assert response.status_code == 400
+
+    # Copy between running servers with the command line tool
+    with tempfile.TemporaryDirectory() as source_dir, \
+            tempfile.TemporaryDirectory() as target_dir:
+        (source, source_url) = start_primary(source_dir)
+        (target, target_url) = start_primary(target_dir)
+        try:
+            response = requests.put(f"{source_url}/package/?name=package_b&title=B" +
+                                    "&description=d&platform=esp32")
+            assert response.status_code == 201
+            response = requests.post(f"{source_url}/package_version/" +
+                                     "?name=package_b&major=1&minor=0&revision=0",
+                                     files={"file": ("filename", contents[0])})
+            assert response.status_code == 201
+
+            for _ in range(2):
+                output = subprocess.run([sys.executable, "-m", "confrm.transfer", "copy",
+                                         source_url, target_url, "--token", "secret"],
+                                        check=True, stdout=subprocess.PIPE)
+            # The second copy sends no blobs and skips everything
+            result = json.loads(output.stdout)
+            assert result["blobs"] == 0
+            assert result["skipped"]["package_versions"] == 1
+
+            response = requests.get(f"{target_url}/package/?name=package_b")
+            assert response.json()["versions"][0]["number"] == "1.0.0"
+        finally:
+            for process in (source, target):
+                process.terminate()
+                process.wait()
+
+
+def test_snapshots():
+    """Tests snapshots are consistent copies taken while the server runs"""
+
+    admin = {"X-Confrm-Admin-Token": "secret"}
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        config_file = os.path.join(data_dir, CONFIG_NAME)
+        with open(config_file, "w") as file:
+            file.write(get_config_file(data_dir) + '\n[admin]\ntoken = "secret"\n' +
+                       f'\n[snapshot]\nkeep = 2\ncommand = "{sys.executable} -c pass"\n')
+        os.environ["CONFRM_CONFIG"] = config_file
+
+        with TestClient(APP) as client:
+            response = client.put("/package/" +
+                                  "?name=package_a" +
+                                  "&description=some%20description" +
+                                  "&title=Good%20Name" +
+                                  "&platform=esp32")
+            assert response.status_code == 201
+            response = client.post("/package_version/?name=package_a&major=0&minor=1&revision=0",
+                                   files={"file": ("filename", os.urandom(1000),
+                                                   "application/binary")})
+            assert response.status_code == 201
+
+            assert client.post("/snapshots/").status_code == 403
+            response = client.post("/snapshots/", headers=admin)
+            assert response.status_code == 201
+            manifest = response.json()
+            assert manifest["missing_blobs"] == []
+            assert manifest["writes_held_seconds"] > 0
+
+            # Blobs are linked, not copied
+            snapshot_dir = os.path.join(data_dir, "snapshots", manifest["name"])
+            blob_id = manifest["blobs"][0]["blob_id"]
+            assert os.stat(os.path.join(snapshot_dir, "blob", blob_id)).st_ino == \
+                os.stat(os.path.join(data_dir, "blob", blob_id)).st_ino
+
+            # Later writes do not change it
+            client.put("/package/?name=package_b&description=d&title=B&platform=esp32")
+            with open(os.path.join(snapshot_dir, "confrm_db.json")) as ptr:
+                assert len(json.load(ptr)["packages"]) == 1
+
+            # Snapshots taken during writes hold whole databases
+            stop = []
+
+            def write():
+                nodes = confrm.confrm.DB.table("nodes")
+                count = 0
+                while not stop:
+                    nodes.insert({"node_id": str(count), "data": "x" * 1000})
+                    count += 1
+
+            writer = threading.Thread(target=write)
+            writer.start()
+            try:
+                names = [client.post("/snapshots/", headers=admin).json()["name"]
+                         for _ in range(3)]
+            finally:
+                stop.append(True)
+                writer.join()
+            for name in names[1:]:
+                with open(os.path.join(data_dir, "snapshots", name, "confrm_db.json")) as ptr:
+                    assert len(json.load(ptr)["packages"]) == 2
+
+            # Only the newest are kept
+            response = client.get("/snapshots/", headers=admin)
+            assert [snapshot["name"] for snapshot in response.json()] == names[1:]
+            assert response.json()[0]["blob_count"] == 1
+
+            with confrm.confrm.SNAPSHOTS._lock:  # pylint: disable=W0212
+                response = client.post("/snapshots/", headers=admin)
+            assert response.status_code == 409
+            assert response.json()["error"] == "confrm-041"
+
+
+def test_batch():
+    """Tests batched operations are applied together in one write"""
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        config_file = os.path.join(data_dir, CONFIG_NAME)
+        with open(config_file, "w") as file:
+            file.write(get_config_file(data_dir) + '\n[debug]\nquery_header = true\n')
+        os.environ["CONFRM_CONFIG"] = config_file
+
+        with TestClient(APP) as client:
+            for name in ["package_a", "package_b"]:
+                response = client.put(f"/package/?name={name}&description=d&title=T" +
+                                      "&platform=esp32")
+                assert response.status_code == 201
+                for revision in range(3):
+                    response = client.post("/package_version/" +
+                                           f"?name={name}&major=0&minor=1&revision={revision}" +
+                                           "&set_active=true",
+                                           files={"file": ("filename", os.urandom(100),
+                                                           "application/binary")})
+                    assert response.status_code == 201
+            response = client.put("/register_node/?node_id=0:12:3:4&package=package_a" +
+                                  "&version=0.1.2&description=d&platform=esp32")
+            assert response.status_code == 200
+
+            operations = [
+                {"method": "PUT", "path": "/config/",
+                 "params": {"type": "global", "key": f"key_{index}", "value": index}}
+                for index in range(5)
+            ] + [
+                {"method": "PUT", "path": "/config/",
+                 "params": {"type": "package", "id": "package_b", "key": "key_p", "value": "p"}},
+                {"method": "PUT", "path": "/node_title/",
+                 "params": {"node_id": "0:12:3:4", "title": "Kitchen"}},
+                {"method": "PUT", "path": "/node_package/",
+                 "params": {"node_id": "0:12:3:4", "package": "package_b", "version": "0.1.0"}},
+                {"method": "DELETE", "path": "/package_version/",
+                 "params": {"package": "package_a", "version": "0.1.0"}},
+            ]
+            seq = confrm.confrm.CHANGE_LOG.seq
+            response = client.post("/batch/", json={"operations": operations})
+            assert response.status_code == 200
+            # One write of the database, and one of the jobs file for the deleted version
+            assert assert_query_budget(response, 200, 2)["writes"] == 2
+            # Only the documents written are recorded for replicas
+            changes = confrm.confrm.CHANGE_LOG.since(seq)
+            assert [(table, doc_id) for (_, table, doc_id, _) in changes] == \
+                [("config", doc_id) for doc_id in range(1, 7)] + [("package_versions", 1)]
+            assert changes[3][3]["value"] == "3"
+            assert changes[6][3] is None
+            assert [result["status"] for result in response.json()["results"]] == \
+                [201] * 6 + [200] * 3
+            assert client.get("/config/?type=global&key=key_3").json()["value"] == "3"
+            assert client.get("/nodes/?node_id=0:12:3:4").json()["title"] == "Kitchen"
+            confrm.confrm.SWEEPER.sweep(grace=0)
+            assert len(os.listdir(os.path.join(data_dir, "blob"))) == 5
+
+            # A failing operation rolls back the whole batch
+            response = client.post("/batch/", json={"operations": [
+                {"method": "DELETE", "path": "/config/",
+                 "params": {"type": "global", "key": "key_0"}},
+                {"method": "DELETE", "path": "/package_version/",
+                 "params": {"package": "package_a", "version": "0.1.1"}},
+                {"method": "DELETE", "path": "/config/",
+                 "params": {"type": "global", "key": "not_there"}},
+                {"method": "PUT", "path": "/set_active_version/",
+                 "params": {"package": "package_a", "version": "0.1.1"}},
+                {"method": "PUT", "path": "/config/",
+                 "params": {"type": "global", "key": "key_x", "value": "x", "other": 1}},
+            ]})
+            assert response.status_code == 400
+            assert response.json()["error"] == "confrm-042"
+            assert [result["status"] for result in response.json()["results"]] == \
+                [200, 200, 404, 400, 400]
+            assert response.json()["results"][3]["body"]["error"] == "confrm-043"
+            assert assert_query_budget(response, 200, 0)["writes"] == 0
+            assert client.get("/config/?type=global&key=key_0").status_code == 200
+            assert len(client.get("/package/?name=package_a").json()["versions"]) == 2
+            assert len(os.listdir(os.path.join(data_dir, "blob"))) == 5
+
+            # Searches within a rolled back transaction are not cached past it
+            canaries = confrm.confrm.DB.table("canary")
+            with pytest.raises(ValueError):
+                with confrm.confrm.DB.transaction():
+                    canaries.insert({"package": "package_x", "version": "0.1.0",
+                                     "node_id": "0:12:3:4", "force": True})
+                    assert len(canaries.search(Query().package == "package_x")) == 1
+                    raise ValueError("Rolled back")
+            assert canaries.search(Query().package == "package_x") == []
+            assert canaries.all() == []
+
+            response = client.post("/batch/", json={"operations": []})
+            assert response.status_code == 400
+            assert response.json()["error"] == "confrm-043"
+
+            # Packages are deleted with their versions and configs in one write,
+            # and the jobs of the versions in the jobs file
+            response = client.delete("/package/?name=package_b")
+            assert response.status_code == 200
+            assert assert_query_budget(response, 200, 4)["writes"] == 4
+            confrm.confrm.SWEEPER.sweep(grace=0)
+            assert len(os.listdir(os.path.join(data_dir, "blob"))) == 2
+            response = client.get("/config/?type=package&id=package_b&key=key_p")
+            assert response.status_code == 404
+
+
+def test_blob_gc():
+    """Tests unreferenced blobs are removed after the grace period"""
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        config_file = os.path.join(data_dir, CONFIG_NAME)
+        with open(config_file, "w") as file:
+            file.write(get_config_file(data_dir) + '\n[admin]\ntoken = "secret"\n' +
+                       '\n[blob_gc]\ngrace = 60\n')
+        os.environ["CONFRM_CONFIG"] = config_file
+
+        with TestClient(APP) as client:
+            response = client.put("/package/?name=package_a&description=d&title=T" +
+                                  "&platform=esp32")
+            assert response.status_code == 201
+            for revision in range(2):
+                response = client.post("/package_version/" +
+                                       f"?name=package_a&major=0&minor=1&revision={revision}",
+                                       files={"file": ("filename", os.urandom(1000),
+                                                       "application/binary")})
+                assert response.status_code == 201
+
+            # Left behind by a crash an hour ago, and by a write in progress
+            blob_dir = os.path.join(data_dir, "blob")
+            for name in ["crashed", "crashed.tmp", "writing.tmp"]:
+                with open(os.path.join(blob_dir, name), "wb") as ptr:
+                    ptr.write(b"x" * 100)
+            for name in ["crashed", "crashed.tmp"]:
+                os.utime(os.path.join(blob_dir, name), (time.time() - 3600,) * 2)
+
+            # Deleted versions keep their blob for the grace period
+            response = client.delete("/package_version/?package=package_a&version=0.1.0")
+            assert response.status_code == 200
+            assert len(os.listdir(blob_dir)) == 5
+
+            assert client.post("/blob_gc/").status_code == 403
+            response = client.post("/blob_gc/", headers={"X-Confrm-Admin-Token": "secret"})
+            assert response.status_code == 200
+            # The grace period starts when the sweeper first finds a file
+            assert response.json()["last_reclaimed_files"] == 0
+            assert response.json()["unreferenced"] == 4
+            assert response.json()["unreferenced_bytes"] == 1300
+            assert len(os.listdir(blob_dir)) == 5
+
+            confrm.confrm.SWEEPER.sweep(grace=0)
+            assert len(os.listdir(blob_dir)) == 1
+            status = client.get("/blob_gc/").json()
+            assert status["reclaimed_files"] == 4
+            assert status["reclaimed_bytes"] == 1300
+            assert "confrm_blob_reclaimed_bytes_total" in client.get("/metrics").text
+
+            # The remaining version is still served
+            version = confrm.confrm.DB.table("package_versions").all()[0]
+            response = client.get(f"/blob/?package=package_a&blob={version['blob_id']}")
+            assert response.status_code == 200
+
+
+def test_scrub():
+    """Tests corrupt blobs are found in the background and quarantined"""
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        config_file = os.path.join(data_dir, CONFIG_NAME)
+        with open(config_file, "w") as file:
+            file.write(get_config_file(data_dir) + '\n[admin]\ntoken = "secret"\n' +
+                       '\n[scrub]\nrate = 0\n')
+        os.environ["CONFRM_CONFIG"] = config_file
+        metrics.REGISTRY.clear()
+        headers = {"X-Confrm-Admin-Token": "secret"}
+
+        with TestClient(APP) as client:
+            response = client.put("/package/?name=package_a&description=d&title=T" +
+                                  "&platform=other")
+            assert response.status_code == 201
+            for revision in range(2):
+                response = client.post("/package_version/" +
+                                       f"?name=package_a&major=0&minor=1&revision={revision}" +
+                                       "&set_active=true",
+                                       files={"file": ("filename", os.urandom(100000),
+                                                       "application/binary")})
+                assert response.status_code == 201
+            response = client.put("/register_node/?node_id=0:12:3:4&package=package_a" +
+                                  "&version=0.1.1&description=d&platform=other")
+            assert response.status_code == 200
+
+            assert client.post("/scrub/").status_code == 403
+            response = client.post("/scrub/", headers=headers)
+            assert response.status_code == 200
+            assert response.json()["last_verified"] == 2
+            assert response.json()["quarantined"] == 0
+
+            # Unchanged blobs are not read again
+            response = client.post("/scrub/", headers=headers)
+            assert response.json()["last_verified"] == 0
+            assert response.json()["last_cached"] == 2
+
+            # Corrupt the active version, keeping its size
+            query = Query()
+            version = confrm.confrm.DB.table("package_versions").get(query.revision == 1)
+            path = os.path.join(data_dir, "blob", version["blob_id"])
+            with open(path, "r+b") as ptr:
+                ptr.seek(5000)
+                byte = ptr.read(1)
+                ptr.seek(5000)
+                ptr.write(bytes([byte[0] ^ 0xFF]))
+
+            # Downloads are not hashed, the scrubber finds the change
+            response = client.get(f"/blob/?package=package_a&blob={version['blob_id']}")
+            assert response.status_code == 200
+            response = client.post("/scrub/", headers=headers)
+            assert response.json()["last_verified"] == 1
+            assert response.json()["quarantined"] == 1
+            assert not os.path.exists(path)
+            assert os.path.isfile(os.path.join(data_dir, "quarantine", version["blob_id"]))
+            assert "confrm_blob_quarantined_total 1" in client.get("/metrics").text
+
+            response = client.get(f"/blob/?package=package_a&blob={version['blob_id']}")
+            assert response.status_code == 409
+            assert response.json()["error"] == "confrm-044"
+            response = client.get("/check_for_update/?package=package_a&node_id=0:12:3:4")
+            assert response.status_code == 409
+            assert response.json()["error"] == "confrm-044"
+            response = client.put("/set_active_version/?package=package_a&version=0.1.1")
+            assert response.status_code == 409
+            response = client.get("/package/?name=package_a")
+            assert response.json()["versions"][0]["quarantined"]["reason"] == \
+                "hash does not match"
+
+            # The other version can still be used
+            assert client.put("/set_active_version/?package=package_a&version=0.1.0").json() \
+                == {"ok": True}
+            response = client.get("/check_for_update/?package=package_a&node_id=0:12:3:4")
+            assert response.status_code == 200
+            assert response.json()["current_version"] == "0.1.0"
+
+        # The cache survives a restart
+        with TestClient(APP) as client:
+            response = client.post("/scrub/", headers=headers)
+            assert response.json()["last_verified"] == 0
+            assert response.json()["last_cached"] == 1
+
+
+def test_blob_cache():
+    """Tests hot blobs are served from memory within the byte budget"""
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        config_file = os.path.join(data_dir, CONFIG_NAME)
+        with open(config_file, "w") as file:
+            file.write(get_config_file(data_dir) +
+                       '\n[blob_cache]\nbudget = 2500\nmax_size = 1500\n')
+        os.environ["CONFRM_CONFIG"] = config_file
+        metrics.REGISTRY.clear()
+
+        with TestClient(APP) as client:
+            response = client.put("/package/?name=package_a&description=d&title=T" +
+                                  "&platform=other")
+            assert response.status_code == 201
+            images = {}
+            for (revision, size) in enumerate([1000, 1000, 2000]):
+                images[revision] = os.urandom(size)
+                response = client.post("/package_version/" +
+                                       f"?name=package_a&major=0&minor=1&revision={revision}",
+                                       files={"file": ("filename", images[revision],
+                                                       "application/binary")})
+                assert response.status_code == 201
+            blobs = {doc["revision"]: doc["blob_id"]
+                     for doc in confrm.confrm.DB.table("package_versions").all()}
+
+            def download(revision):
+                response = client.get(f"/blob/?package=package_a&blob={blobs[revision]}")
+                assert response.status_code == 200
+                assert response.content == images[revision]
+                assert response.headers["x-MD5"] == hashlib.md5(images[revision]).hexdigest()
+
+            # Setting the active version reads it in to the cache
+            response = client.put("/set_active_version/?package=package_a&version=0.1.0")
+            assert response.json() == {"ok": True}
+            deadline = time.time() + 10
+            while "confrm_blob_cache_bytes 1000\n" not in client.get("/metrics").text:
+                assert time.time() < deadline
+                time.sleep(0.01)
+            download(0)
+            download(0)
+            download(1)
+            download(1)
+            text = client.get("/metrics").text
+            assert "confrm_blob_cache_hits_total 3\n" in text
+            assert "confrm_blob_cache_misses_total 1\n" in text
+            assert "confrm_blob_cache_bytes 2000\n" in text
+
+            # Blobs over max_size are always read from disk
+            download(2)
+            download(2)
+            assert "confrm_blob_cache_misses_total 3\n" in client.get("/metrics").text
+
+            # The least recently used blob makes room for another
+            confrm.confrm.BLOB_CACHE.max_size = 2500
+            download(2)
+            download(1)
+            text = client.get("/metrics").text
+            assert "confrm_blob_cache_evictions_total 3\n" in text
+            assert "confrm_blob_cache_bytes 1000\n" in text
+
+            # Deleted versions leave the cache
+            response = client.delete("/package_version/?package=package_a&version=0.1.1")
+            assert response.status_code == 200
+            assert "confrm_blob_cache_bytes 0\n" in client.get("/metrics").text
+
+    # Concurrent misses read the file once
+    reads = []
+
+    def load():
+        reads.append(1)
+        time.sleep(0.05)
+        return b"data"
+
+    async def concurrent():
+        cache = BlobCache()
+        cache.configure({"budget": 100})
+        return await asyncio.gather(*[cache.get("blob", load) for _ in range(5)])
+
+    results = asyncio.run(concurrent())
+    assert len(reads) == 1
+    assert all(result is results[0] for result in results)
+
+    # Blobs which cannot be read are logged and left to their downloads
+    def missing():
+        raise FileNotFoundError("missing")
+
+    async def prewarm():
+        cache = BlobCache()
+        cache.configure({"budget": 100})
+        await cache.prewarm("blob", missing)
+        return len(cache._entries)  # pylint: disable=W0212
+
+    assert asyncio.run(prewarm()) == 0
+
+
+def test_shaping():
+    """Tests bandwidth limits of blob downloads"""
+
+    bucket = TokenBucket(1000, 100)
+    assert bucket.reserve(100) == 0
+    assert bucket.reserve(500) == pytest.approx(0.5, abs=0.01)
+
+    shaper = Shaper()
+    shaper.configure({"subnets": {"192.168.0.0/16": 1000, "192.168.1.0/24": 2000}})
+    assert [b.rate for b in shaper.buckets("package_a", "192.168.1.5")] == [0, 0, 2000]
+    assert [b.rate for b in shaper.buckets("package_a", "192.168.2.5")] == [0, 0, 1000]
+    assert [b.rate for b in shaper.buckets("package_a", "testclient")] == [0, 0]
+    with pytest.raises(ValueError):
+        shaper.update({"subnets": {"192.168.1.0/33": 10}})
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        config_file = os.path.join(data_dir, CONFIG_NAME)
+        with open(config_file, "w") as file:
+            file.write(get_config_file(data_dir) + '\n[admin]\ntoken = "secret"\n' +
+                       '\n[shaping]\nburst = 4096\n\n[shaping.packages]\npackage_a = 20000\n')
+        os.environ["CONFRM_CONFIG"] = config_file
+        headers = {"X-Confrm-Admin-Token": "secret"}
+
+        with TestClient(APP) as client:
+            response = client.put("/package/?name=package_a&description=d&title=T" +
+                                  "&platform=other")
+            assert response.status_code == 201
+            image = os.urandom(12288)
+            response = client.post("/package_version/?name=package_a&major=0&minor=1&revision=0",
+                                   files={"file": ("filename", image, "application/binary")})
+            assert response.status_code == 201
+            blob = confrm.confrm.DB.table("package_versions").all()[0]["blob_id"]
+
+            # The burst is sent at once, the rest at 20000 bytes per second
+            start = time.perf_counter()
+            response = client.get(f"/blob/?package=package_a&blob={blob}")
+            assert response.content == image
+            assert time.perf_counter() - start >= 0.35
+
+            assert client.put("/shaping/", json={"rate": 1}).status_code == 403
+            response = client.put("/shaping/", json={"rate": -1}, headers=headers)
+            assert response.status_code == 400
+            assert response.json()["error"] == "confrm-045"
+            response = client.put("/shaping/", json={"packages": {"package_a": 0}},
+                                  headers=headers)
+            assert response.status_code == 200
+            assert response.json()["packages"] == {}
+            assert client.get("/shaping/").json()["burst"] == 4096
+
+            start = time.perf_counter()
+            response = client.get(f"/blob/?package=package_a&blob={blob}")
+            assert response.content == image
+            assert time.perf_counter() - start < 0.3
+
+
+def test_rate_limit():
+    """Tests nodes calling device endpoints too often are refused"""
+
+    limiter = RateLimiter()
+    limiter.configure({"node_rate": 1, "node_burst": 1, "max_keys": 2})
+    for node_id in ["a", "b", "c"]:
+        assert limiter.check(node_id, "10.0.0.1") == (0.0, "")
+    assert len(limiter) == 2
+    assert limiter.check("c", "10.0.0.1")[1] == "node"
+    # The bucket of node a was dropped, it starts again with a full one
+    assert limiter.check("a", "10.0.0.1") == (0.0, "")
+
+    # Refused nodes are kept within max_throttled, most refused first
+    limiter.configure({"max_throttled": 2})
+    for node_id in ["a", "b", "b", "c", "c", "c"]:
+        limiter.refused(node_id, "node")
+    assert [(entry["node_id"], entry["refused"]) for entry in limiter.throttled()] == \
+        [("c", 3), ("b", 2)]
+
+    limiter.configure({"max_lag": 0.5})
+    metrics.LOOP_LAG.set(value=1.0)
+    assert limiter.check("a", "10.0.0.1") == (1.0, "overloaded")
+    metrics.LOOP_LAG.set(value=0.0)
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        config_file = os.path.join(data_dir, CONFIG_NAME)
+        with open(config_file, "w") as file:
+            file.write(get_config_file(data_dir) +
+                       '\n[rate_limit]\nnode_rate = 0.1\nnode_burst = 3\n')
+        os.environ["CONFRM_CONFIG"] = config_file
+        metrics.REGISTRY.clear()
+
+        with TestClient(APP) as client:
+            response = client.put("/package/?name=package_a&description=d&title=T" +
+                                  "&platform=other")
+            assert response.status_code == 201
+            for node_id in ["0:12:3:4", "0:12:3:5"]:
+                response = client.put(f"/register_node/?node_id={node_id}" +
+                                      "&package=package_a&version=&description=d&platform=other")
+                assert response.status_code == 200
+
+            for _ in range(2):
+                response = client.get("/time/?node_id=0:12:3:4")
+                assert response.status_code == 200
+            response = client.get("/check_for_update/?package=package_a&node_id=0:12:3:4")
+            assert response.status_code == 429
+            assert response.json()["error"] == "confrm-046"
+            assert 1 <= int(response.headers["retry-after"]) <= 10
+
+            # Other nodes and the dashboard are not affected
+            response = client.get("/time/?node_id=0:12:3:5")
+            assert response.status_code == 200
+            response = client.get("/nodes/")
+            assert response.status_code == 200
+
+            text = client.get("/metrics").text
+            assert 'confrm_rate_limited_total{reason="node"} 1' in text
+            (entry,) = client.get("/rate_limit/").json()["throttled"]
+            assert (entry["node_id"], entry["refused"], entry["reason"]) == \
+                ("0:12:3:4", 1, "node")
+
+
+def test_next_check_in():
+    """Tests nodes are told when to check in from the fleet size, load and rollouts"""
+
+    scheduler = PollScheduler()
+    scheduler.configure({"target_rate": 10})
+    assert 270 <= scheduler.next_check_in("a", False, 5, 0) <= 330
+    assert scheduler.next_check_in("a", False, 5, 0) == scheduler.next_check_in("a", False, 5, 0)
+    assert 900 <= scheduler.next_check_in("a", False, 10000, 0) <= 1100
+    assert 27 <= scheduler.next_check_in("a", True, 5, 0) <= 33
+    assert 900 <= scheduler.next_check_in("a", True, 10000, 0) <= 1100
+    assert 540 <= scheduler.next_check_in("a", False, 5, 0.2) <= 660
+    assert scheduler.next_check_in("a", False, 10 ** 6, 0) == 3600
+
+    # Nodes are spread across the jitter
+    intervals = [scheduler.next_check_in(f"0:12:3:{ind}", False, 5, 0) for ind in range(100)]
+    assert min(intervals) < 285 and max(intervals) > 315
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        config_file = os.path.join(data_dir, CONFIG_NAME)
+        with open(config_file, "w") as file:
+            file.write(get_config_file(data_dir))
+        os.environ["CONFRM_CONFIG"] = config_file
+
+        with TestClient(APP) as client:
+
+            def register(version):
+                response = client.put("/register_node/?node_id=0:12:3:4&package=package_a" +
+                                      f"&version={version}&description=d&platform=other")
+                assert response.status_code == 200
+                return response.json()["next_check_in"]
+
+            response = client.put("/package/?name=package_a&description=d&title=T" +
+                                  "&platform=other")
+            assert response.status_code == 201
+            assert 270 <= register("") <= 330
+            for minor in [1, 2]:
+                response = client.post("/package_version/" +
+                                       f"?name=package_a&major=0&minor={minor}&revision=0",
+                                       files={"file": ("filename", os.urandom(100),
+                                                       "application/binary")})
+                assert response.status_code == 201
+
+            # Nodes running another version than the one just set active check in sooner
+            response = client.put("/set_active_version/?package=package_a&version=0.2.0")
+            assert response.json() == {"ok": True}
+            assert 27 <= register("0.1.0") <= 33
+            response = client.get("/check_for_update/?package=package_a&node_id=0:12:3:4")
+            assert response.json()["current_version"] == "0.2.0"
+            assert 27 <= response.json()["next_check_in"] <= 33
+            assert 270 <= register("0.2.0") <= 330
+
+            # Forcing a node to a version puts it in the rollout
+            response = client.put("/node_package/?node_id=0:12:3:4&package=package_a" +
+                                  "&version=0.1.0")
+            assert response.status_code == 200
+            response = client.get("/check_for_update/?package=package_a&node_id=0:12:3:4")
+            assert response.json()["force"]
+            assert 27 <= response.json()["next_check_in"] <= 33